@@ -17,12 +17,18 @@
 #  Experiments are parsed with the following grammar:
 #     Experiment = Containers
 #     Containers = Container { , Container }
-#     Container  = Share [ Worker Repeat ]
-#     Share      = Integer
+#     Container  = Share [ Worker Repeat ] [ ( Containers ) ]
+#     Share      = Integer [ p ] [ S ]
 #     Repeat     = [ * Integer ]
-#     Worker     = rdseq [.Wmode] | rdrand Delay | wrseq [. Wmode] | sleep
+#     Worker     = rdseq [. Rmode] | rdrand Delay | wrseq [. Wmode] |
+#                  io_load_read Delay | io_load_write Delay | sleep
 #     Delay      = [ .delay Integer ]
-#     Wmode     = buf | sync | dir
+#     Rmode      = buf | dir
+#     Wmode      = buf | sync | dir
+#
+#  Share is the container's weight, MIN_VALID_WEIGHT..MAX_VALID_WEIGHT.
+#  p (or P) makes the container high priority, and S (or s) makes its tasks
+#  share sync queues.  Nested containers can be nested again, to any depth.
 #
 #  TODO:
 #      Add support for io class
@@ -30,8 +36,11 @@
 #      Do more testing on non fakenuma systems
 
 
-import getopt, glob, logging, os, re, subprocess, sys, time, traceback, math
-import cgroup, cpuset, error, utils
+import errno, getopt, glob, json, logging, math, os, re, select
+import struct, subprocess, sys, threading, time, traceback, zlib
+import blkio_stats, cgroup, cpuset, error, file_pool, results_db
+import stats_sampler, utils
+import worker_supervisor
 
 # Size of allocated containers for workers. We chose 360mb because it's small
 # enough to allow lots of workers on systems with less memory, and it's
@@ -40,7 +49,8 @@ import cgroup, cpuset, error, utils
 CONTAINER_MBYTES = 360
 NODE_MBYTES = 120
 
-MAX_VALID_WEIGHT = 1000 # kernel limits the max value to be 1000 (min to 100)
+MIN_VALID_WEIGHT = 100  # kernel limits the min value to be 100
+MAX_VALID_WEIGHT = 1000 # kernel limits the max value to be 1000
 
 TEST_CGROUP_PREFIX = 'blkcgroupt'
 
@@ -48,25 +58,80 @@ TEST_CGROUP_PREFIX = 'blkcgroupt'
 # TODO(teravest): Set this up from kernel version instead.
 BLKIO_CGROUP_NAME = 'io'
 
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+LOG_DATE_FORMAT = '%H:%M:%S'
+
+# Directory on the workvol holding input files kept across runs with -k.
+INPUT_POOL_DIR = 'blkcgroup_test_pool'
+
+# Name of the file where each shard process leaves its results for the parent.
+SHARD_RESULTS_FILE = 'shard_results'
+
+# Name of the file in the workdir recording the experiments finished so far.
+CHECKPOINT_FILE = 'checkpoint.json'
+
+# Disk bandwidth that dry-run duration estimates assume, in MB/s.
+ESTIMATED_DISK_MB_PER_SECOND = 25
+
 def usage(argv):
     """Prints usage information to stderr."""
-    sys.stderr.write('%s [-cgh] [-o file]: Runs a blkcgroup isolation test\n'
+    sys.stderr.write('%s [-cghknr] [-d dbfile] [-o file] [-w vol,...]: '
+                     'Runs a blkcgroup isolation test\n'
                      '-c: Cleans test data before running\n'
+                     '-d dbfile: Records results in an SQLite database\n'
                      '-g: Adds Google-specific support code\n'
+                     '-k: Keeps worker input files for reuse by later runs\n'
+                     '-n: Prints what the experiments would do, without '
+                     'running them\n'
                      '-o file: Creates autotest output file\n'
+                     '-r: Resumes an interrupted run, skipping finished '
+                     'experiments\n'
+                     '-w vol,...: Shards experiments across the disks holding '
+                     'these volumes\n'
                      '-h: Prints help information\n' % argv[0])
 
 
-def delete_test_containers():
-    """Deletes all test containers that could be created by this test."""
-    for r in ('cpuset', 'io'):
-        cgroups = glob.glob('/dev/cgroup/%s/%s*' % (r, TEST_CGROUP_PREFIX))
-        for cgroup in cgroups:
-          igroups = glob.glob('%s/%s*' %
-                              (cgroup, TEST_CGROUP_PREFIX))
-          for igroup in igroups:
-            os.rmdir(igroup)
-          os.rmdir(cgroup)
+def delete_test_containers(prefix=None):
+    """Deletes all test containers that could be created by this test.
+       With a prefix, only deletes the containers that setup_containers
+       created with that prefix.
+    """
+    if prefix is None:
+        pattern = TEST_CGROUP_PREFIX + '*'
+    else:
+        pattern = prefix + '[0-9]*'
+    cpuset.discover_container_style()
+    if not cpuset.super_root_path:
+        return  # no cgroups, so no test containers either
+    roots = set(cpuset.full_path(cpuset.tree_root(tree, cpuset.SUPER_ROOT))
+                for tree in ('cpuset', BLKIO_CGROUP_NAME))
+    for r in roots:
+        cgroups = glob.glob(os.path.join(r, pattern))
+        for path in cgroups:
+            delete_cgroup_tree(path)
+
+
+def delete_cgroup_tree(path):
+    """Deletes a test cgroup and all test cgroups nested within it,
+       killing any workers left behind in them.
+    """
+    for inner in glob.glob('%s/%s*' % (path, TEST_CGROUP_PREFIX)):
+        delete_cgroup_tree(inner)
+    tasks = os.path.join(path, 'tasks')
+    if cgroup.version() == 2:
+        tasks = os.path.join(path, 'cgroup.procs')
+    for pid in open(tasks).read().split():
+        utils.kill_pid(int(pid))
+    # Killed tasks leave the cgroup only once they have exited.
+    for attempt in xrange(50):
+        try:
+            cgroup.fs.rmdir(path)
+            return
+        except OSError, e:
+            if e.errno != errno.EBUSY:
+                raise
+        time.sleep(0.1)
+    cgroup.fs.rmdir(path)
 
 
 def setup_logging(debug=False):
@@ -74,10 +139,9 @@ def setup_logging(debug=False):
 
     Logs data to filename. Logs debug data if debug is True.
     """
-    format_string = '%(asctime)s %(levelname)s %(message)s'
-    logging.basicConfig(format=format_string,
+    logging.basicConfig(format=LOG_FORMAT,
                         stream=sys.stdout,
-                        datefmt='%H:%M:%S')
+                        datefmt=LOG_DATE_FORMAT)
 
     # Enable debug logs only if specified.
     if debug:
@@ -86,91 +150,228 @@ def setup_logging(debug=False):
         logging.getLogger().setLevel(logging.INFO)
 
 
-def expect_delim(text, delim):
-    """Require text to start with delim, and return text with delim stripped.
+def tag_logging(tag):
+    """Prefixes every log message of this process with tag.
+
+    Used by shard processes so that interleaved output from several disks
+    can be told apart.
+    """
+    format_string = LOG_FORMAT.replace('%(message)s',
+                                       '[%s] %%(message)s' % tag)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(format_string,
+                                               LOG_DATE_FORMAT))
+
+
+# Kinds of experiment tokens, and the patterns matching them.  A share is the
+# container's weight followed by its flags, eg '500', '500p' or '140S'.
+TOKEN_PATTERNS = [
+    ('space', r'\s+'),
+    ('share', r'\d+[A-Za-z]*'),
+    ('word', r'[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)?'),
+    ('punct', r'[,*()]'),
+]
+TOKEN_RE = re.compile('|'.join('(?P<%s>%s)' % (kind, pattern)
+                               for kind, pattern in TOKEN_PATTERNS))
+
+# Known workers, with the variants each accepts after a '.'.  'delay'
+# variants carry a number of milliseconds, as in rdrand.delay400.
+WORKER_VARIANTS = {
+    'rdseq': ('', 'buf', 'dir'),
+    'rdrand': ('', 'delay'),
+    'wrseq': ('', 'buf', 'sync', 'dir'),
+    'io_load_read': ('', 'delay'),
+    'io_load_write': ('', 'delay'),
+    'sleep': ('',),
+}
+
+
+def tokenize_experiment(text):
+    """Split an experiment into (kind, value, column) tokens.
+
+    A share's digits and flags form one token; the repeat count after '*'
+    is a plain integer, when it is all digits.  The list ends with an
+    ('end', '', column) token.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m:
+            raise experiment_error(text, pos,
+                                   'unexpected character %r' % text[pos])
+        kind = m.lastgroup
+        if kind != 'space':
+            if (kind == 'share' and tokens and tokens[-1][1] == '*' and
+                m.group().isdigit()):
+                kind = 'integer'
+            tokens.append((kind, m.group(), pos))
+        pos = m.end()
+    tokens.append(('end', '', len(text)))
+    return tokens
+
+
+def experiment_error(text, pos, message):
+    """Get a ValueError pointing at column pos of experiment text."""
+    return ValueError('%s at column %d of experiment\n    %s\n    %s^' %
+                      (message, pos + 1, text, ' ' * pos))
+
+
+def check_worker(text, pos, worker):
+    """Raise a ValueError unless worker names a known worker and variant."""
+    name, dot, variant = worker.partition('.')
+    if name not in WORKER_VARIANTS:
+        raise experiment_error(text, pos, 'unknown worker %s' % name)
+    allowed = WORKER_VARIANTS[name]
+    if variant.startswith('delay') and 'delay' in allowed:
+        if not variant[5:].isdigit():
+            raise experiment_error(text, pos, 'bad delay in worker %s' %
+                                   worker)
+    elif variant not in allowed or (dot and not variant):
+        raise experiment_error(text, pos, 'unknown variant %s of worker %s' %
+                               (variant, name))
+
+
+class experiment_parser(object):
+    """Recursive-descent parser for the experiment grammar at the top of this
+       file.  Containers can be nested to any depth.
     """
-    if text[0] != delim:
-        raise ValueError, 'missing %s at %s' % (delim, text)
-    return text[1:]
 
-def parse_integer(text):
-    """Split a string, parsing off the integer at the beginning.
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize_experiment(text)
+        self.next = 0
 
-    For example, '90% rdseq, 10% seq' becomes (90, '% rdseq, 10% seq')
-    """
-    value = re.match('\d*', text).group()
-    return int(value), text[len(value):]
 
-def parse_container(text):
-    """Split a string, parsing off the integer at the beginning along
-    with an optional P/p flag to indicate that the group should be
-    high priority.
+    def peek(self):
+        return self.tokens[self.next]
 
-    For example, '90% rdseq, 10% seq' becomes (90, 2, '% rdseq, 10% seq')
-                 '90p% rdseq, 10% seq' becomes (90, 1, '% rdseq, 10% seq')
-    """
-    weight, text = parse_integer(text)
-    if text.startswith('P') or text.startswith('p'):
-        priority = 1
-        text = text[1:]
-    else:
-        priority = 2
-    if text.startswith('S') or text.startswith('s'):
-        shared_sync_queues = True
-    else:
-        shared_sync_queues = False
-    return {
-        'weight': weight,
-        'priority': priority,
-        'shared_sync_queues': shared_sync_queues
-    }, text
-
-def parse_name(text):
-    """Split an arbitrary (maybe empty) word from the beginning of a string."""
-    lth = 0
-    while text[lth] not in ' ,*%();':
-        lth += 1
-    return text[:lth], text[lth:]
-
-
-def parse_containers(text):
-    """Parse worker containers in an experiment."""
-    containers = []
-    while True:
-        container, text = parse_container(text.lstrip())
-        options, text = parse_name(text)
-        # This is where we would hook in options for limiting.
 
-        worker, text = parse_name(text.lstrip())
+    def take(self):
+        token = self.tokens[self.next]
+        self.next += 1
+        return token
+
+
+    def expect(self, kind, value=None):
+        """Take the next token, which must be of the given kind and value."""
+        token = self.peek()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise self.error(token, 'expected %s' % (value or kind))
+        return self.take()
+
+
+    def accept(self, value):
+        """Take the next token if it is the given punctuation."""
+        if self.peek()[1] == value and self.peek()[0] == 'punct':
+            return self.take()
+        return None
+
+
+    def error(self, token, message):
+        if token[0] == 'end':
+            found = 'end of experiment'
+        else:
+            found = repr(token[1])
+        return experiment_error(self.text, token[2],
+                                '%s, found %s' % (message, found))
+
+
+    def parse(self):
+        """Parse the whole experiment, returning its tree of containers."""
+        containers = self.containers()
+        self.expect('end')
+        return containers
+
+
+    def containers(self):
+        containers = [self.container()]
+        while self.accept(','):
+            containers.append(self.container())
+        return containers
+
+
+    def container(self):
+        kind, share, pos = self.expect('share')
+        weight = int(re.match(r'\d+', share).group())
+        if not MIN_VALID_WEIGHT <= weight <= MAX_VALID_WEIGHT:
+            raise experiment_error(self.text, pos,
+                                   'weight %d outside of %d..%d' %
+                                   (weight, MIN_VALID_WEIGHT,
+                                    MAX_VALID_WEIGHT))
+        flags = share[len(str(weight)):]
+        for flag in flags:
+            if flag not in 'pPsS' or flags.lower().count(flag.lower()) > 1:
+                raise experiment_error(self.text, pos,
+                                       'bad container flags %s' % flags)
+        container = {
+            'weight': weight,
+            'priority': 2,
+            'shared_sync_queues': 's' in flags.lower(),
+        }
+        if 'p' in flags.lower():
+            container['priority'] = 1
+
         repeat = 0
-        if worker:
-            repeat = 1
-            if text[0] == '*':
-                repeat, text = parse_integer(text[1:])
-            text = text.lstrip()
+        if self.peek()[0] == 'word':
+            kind, worker, pos = self.take()
+            check_worker(self.text, pos, worker)
             container['worker'] = worker
+            repeat = 1
+            if self.accept('*'):
+                kind, count, pos = self.expect('integer')
+                repeat = int(count)
+                if repeat < 1:
+                    raise experiment_error(self.text, pos,
+                                           'repeat count must be positive')
         container['worker_repeat'] = repeat
 
         # Parse the containers within the nested group.
-        # We only support one level of nesting.
-        inner = []
-        if text[0] == '(':
-            inner, text = parse_containers(text[1:])
-            text = expect_delim(text.lstrip(), ')').lstrip()
-        container['nest'] = inner
-
-        containers.append(container)
-        if text[0] != ',':
-            break
-        text = text[1:]
-    return containers, text
+        container['nest'] = []
+        if self.accept('('):
+            container['nest'] = self.containers()
+            self.expect('punct', ')')
+        return container
 
 
 def parse_experiment(text):
-    """Parse an experiment and require that all input is consumed."""
-    exper, text = parse_containers(text + ';')
-    text = expect_delim(text, ';')
-    return exper
+    """Parse an experiment and require that all input is consumed.
+
+    Raises a ValueError pointing at the problem for invalid experiments.
+    """
+    return experiment_parser(text).parse()
+
+
+def inner_workers(tree, path=''):
+    """Get the positions, like '2' or '1.3', of the containers of tree that
+       hold both workers and nested containers.
+    """
+    found = []
+    for i, container in enumerate(tree):
+        position = '%s%d' % (path, i + 1)
+        if 'worker' in container and container['nest']:
+            found.append(position)
+        found.extend(inner_workers(container['nest'], position + '.'))
+    return found
+
+
+def validate_experiments(experiments):
+    """Check a whole list of experiments before running any of them."""
+    unified = cgroup.version() == 2
+    for i, (experiment, allowed_error) in enumerate(experiments):
+        try:
+            tree = parse_experiment(experiment)
+        except ValueError, e:
+            raise ValueError('experiment %d is invalid: %s' % (i, e))
+        if unified and inner_workers(tree):
+            # cgroup2 only lets leaf cgroups hold processes.
+            raise ValueError('experiment %d is invalid: cgroup v2 cannot run '
+                             'workers in containers with nested containers, '
+                             'as container %s of %r does' %
+                             (i, ', '.join(inner_workers(tree)), experiment))
+        if not isinstance(allowed_error, (int, long)) or allowed_error < 0:
+            raise ValueError('experiment %d has bad allowed error %r' %
+                             (i, allowed_error))
 
 
 def plan_container_size(container):
@@ -199,7 +400,8 @@ def setup_container(container, cname, device,
     weight = container['weight']
 
     path = cpuset.create_container_cpuset(
-                   cname, 'cpuset', root=my_cpu_parent.name, mbytes=mbytes)
+                   cname, 'cpuset', root=my_cpu_parent.name, mbytes=mbytes,
+                   cpus=container.get('cpus'), mems=container.get('mems'))
 
     blk_path = cpuset.create_container_blkio(
                    device, cname, 'io',
@@ -220,42 +422,343 @@ def setup_container(container, cname, device,
     container['name'] = name  # eg g0/g1
 
 
-def setup_containers(tree, device,
-                     root_name, my_cpu_parent, my_blkio_parent):
-    """Recursive top-down tree walk, creating all containers & cgroups
-       needed for one experiment.  my_*_parent describe the existing cpu
-       cgroup and io cgroup of this subtree's parent container.
+def plan_cpus(container, parent):
+    """Describe the cpus setup_container would give container."""
+    if container.get('cpus') is not None:
+        return ','.join(map(str, container['cpus']))
+    return '<cpus of %s>' % parent
+
+
+def plan_cgroup_ops(tree, device, prefix=TEST_CGROUP_PREFIX,
+                    cpu_parent=cpuset.SUPER_ROOT, io_parent=cpuset.SUPER_ROOT):
+    """List the cgroup directories and attribute values that
+       setup_containers would create for an experiment, without creating
+       them.  Values only known at run time are described in <>.
+       cpu_parent and io_parent name the parent containers, like
+       setup_containers' my_*_parent.
     """
+    cpuset.discover_container_style()
+    if cpuset.unified_hierarchy:
+        return plan_cgroup2_ops(tree, device, prefix, cpu_parent)
+    cpu_root = cpuset.tree_root('cpuset', cpu_parent).rstrip('/')
+    io_root = cpuset.tree_root(BLKIO_CGROUP_NAME, io_parent).rstrip('/')
+    knobs = None
+    if os.path.isdir(cpuset.full_path(io_root)):
+        knobs = cgroup.probe().io_knobs(cpuset.full_path(io_root))
+        if 'io.io_service_level' not in knobs:
+            raise error.Error("Kernel predates blkio features or blkio "
+                              "cgroup is mounted separately from cpusets")
+    ops = []
+    for i, container in enumerate(tree):
+        cname = '%s%d' % (prefix, i)
+        cpu_path = os.path.join(cpu_root, cname)
+        io_path = os.path.join(io_root, cname)
+        mbytes = plan_container_size(container)
+
+        ops.append('mkdir %s' % cpuset.full_path(cpu_path))
+        if cpuset.fake_numa_containers:
+            ops.append('%s = 1' % cpuset.cpuset_attr(cpu_path, 'mem_hardwall'))
+            ops.append('%s = <nodes holding %d MB>'
+                       % (cpuset.mems_path(cpu_path), mbytes))
+        else:
+            ops.append('%s = <mems of %s>'
+                       % (cpuset.mems_path(cpu_path),
+                          cpuset.full_path(cpu_root)))
+            ops.append('%s.limit_in_bytes = %d'
+                       % (cpuset.memory_path(cpu_path), mbytes << 20))
+        ops.append('%s = %s' % (cpuset.cpus_path(cpu_path),
+                                plan_cpus(container,
+                                          cpuset.full_path(cpu_root))))
+
+        ops.append('mkdir %s' % cpuset.full_path(io_path))
+        ops.append('%s = %s %d 0 %s'
+                   % (cpuset.blkio_attr(io_path, 'io_service_level'),
+                      device, container['priority'],
+                      container['weight'] / 10))
+        if knobs is None or 'io.shared_sync_queues' in knobs:
+            ops.append('%s = %d'
+                       % (cpuset.blkio_attr(io_path, 'shared_sync_queues'),
+                          container['shared_sync_queues']))
+
+        ops.extend(plan_cgroup_ops(container['nest'], device, prefix,
+                                   os.path.join(cpu_parent, cname),
+                                   os.path.join(io_parent, cname)))
+    return ops
+
+
+def plan_cgroup2_ops(tree, device, prefix=TEST_CGROUP_PREFIX,
+                     parent=cpuset.SUPER_ROOT):
+    """Like plan_cgroup_ops, for the one cgroup2 hierarchy."""
+    if not tree:
+        return []
+    available = cpuset.controllers(cpuset.SUPER_ROOT)
+    scheduler = utils.read_one_line('/sys/block/%s/queue/scheduler' % device)
+    # enable_io_weights switches to bfq where the kernel has it.
+    if 'bfq' in scheduler.replace('[', ' ').replace(']', ' ').split():
+        weight_file = 'io.bfq.weight'
+    else:
+        weight_file = 'io.weight'
+    number = utils.get_device_id(device)
+
+    ops = []
+    changes = ['+' + c for c in ('cpuset', 'memory', 'io') if c in available]
+    if changes:
+        ops.append('%s = %s' % (os.path.join(cpuset.full_path(parent),
+                                             'cgroup.subtree_control'),
+                                ' '.join(changes)))
     for i, container in enumerate(tree):
-        # Create next sibling container at this level
-        setup_container(container, '%s%d' % (TEST_CGROUP_PREFIX, i), device,
-                        root_name, my_cpu_parent, my_blkio_parent)
+        name = os.path.join(parent, '%s%d' % (prefix, i))
+        path = cpuset.full_path(name)
+        ops.append('mkdir %s' % path)
+        ops.append('%s.max = %d' % (cpuset.memory_path(name),
+                                    plan_container_size(container) << 20))
+        if 'cpuset' in available:
+            ops.append('%s = %s' % (cpuset.cpus_path(name),
+                                    plan_cpus(container,
+                                              cpuset.full_path(parent))))
+        ops.append('%s = %s %d' % (os.path.join(path, weight_file), number,
+                                   container['weight']))
+        ops.append('%s = %s' % (os.path.join(path, 'io.prio.class'),
+                                {1: 'promote-to-rt'}.get(
+                                        container['priority'], 'no-change')))
+        ops.extend(plan_cgroup2_ops(container['nest'], device, prefix, name))
+    return ops
+
+
+def timeout_seconds(timeout):
+    """Convert a sleep(1) duration such as '100s' or '2m' to seconds."""
+    m = re.match(r'^(\d+(?:\.\d*)?)([smhd]?)$', timeout)
+    if not m:
+        raise ValueError('bad timeout %s' % timeout)
+    unit = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+    return float(m.group(1)) * unit
+
+
+def run_concurrently(function, items, concurrency):
+    """Call function on every item, with up to concurrency calls at once.
+
+    Once a call raises an exception, no more calls get started, and the
+    exception is raised again after the running calls have finished.
+    """
+    if concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            function(item)
+        return
+
+    pending = list(reversed(items))
+    failures = []
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                if not pending or failures:
+                    return
+                item = pending.pop()
+            try:
+                function(item)
+            except Exception:
+                with lock:
+                    failures.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work)
+               for n in xrange(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def container_levels(tree):
+    """Get the containers of tree level by level, top-down."""
+    levels = []
+    while tree:
+        levels.append(tree)
+        tree = [c for container in tree for c in container['nest']]
+    return levels
 
-        setup_containers(container['nest'], device,
-                         root_name, container['cpu_cgroup'],
-                         container['blkio_cgroup'])
+
+def setup_containers(tree, device,
+                     root_name, my_cpu_parent, my_blkio_parent,
+                     prefix=TEST_CGROUP_PREFIX, concurrency=1):
+    """Create all containers & cgroups needed for one experiment, one
+       level of the tree at a time, so that parents exist before their
+       children.  Up to concurrency containers of a level get created at
+       once.  my_*_parent describe the existing cpu cgroup and io cgroup of
+       the experiment's parent container.
+       prefix names the containers, so that shards on other disks can run
+       their own experiments side by side.
+    """
+    # Look up shared state once, before threads would race to.
+    cpuset.discover_container_style()
+    cgroup.mount_point('cpuset')
+    cgroup.mount_point(BLKIO_CGROUP_NAME)
+
+    def setup(item):
+        container, cname, cpu_parent, io_parent = item
+        setup_container(container, cname, device, root_name, cpu_parent,
+                        io_parent)
+
+    lockfile = None
+    if cpuset.fake_numa_containers:
+        # Keep tests on other disks off the picked mem nodes until all
+        # containers exist.
+        lockfile = cpuset.my_lock('inner')
+    try:
+        if lockfile:
+            assign_mem_nodes(tree, my_cpu_parent, prefix)
+        level = [(container, '%s%d' % (prefix, i), my_cpu_parent,
+                  my_blkio_parent)
+                 for i, container in enumerate(tree)]
+        while level:
+            run_concurrently(setup, level, concurrency)
+            level = [(c, '%s%d' % (prefix, i), container['cpu_cgroup'],
+                      container['blkio_cgroup'])
+                     for container, cname, cpu_parent, io_parent in level
+                     for i, c in enumerate(container['nest'])]
+    finally:
+        if lockfile:
+            cpuset.my_unlock(lockfile)
+
+
+def assign_mem_nodes(tree, my_cpu_parent, prefix=TEST_CGROUP_PREFIX):
+    """Pick the fake numa mem nodes of all containers of tree in one go,
+       into each container's 'mems'.
+    """
+    root = cpuset.tree_root('cpuset', my_cpu_parent.name).rstrip('/')
+    requests = []
+    containers = {}
+    def plan(tree, parent, parent_cpus):
+        for i, container in enumerate(tree):
+            name = os.path.join(parent, '%s%d' % (prefix, i))
+            cpus = container.get('cpus', parent_cpus)
+            requests.append((name, parent, plan_container_size(container),
+                             cpus))
+            containers[name] = container
+            plan(container['nest'], name, cpus)
+    plan(tree, root, cpuset.get_cpus(root))
+    for name, nodes in cpuset.allocate_mem_nodes(requests).items():
+        containers[name]['mems'] = nodes
+
+
+def worker_count(container):
+    """Get the number of workers in a container and its nested ones."""
+    return container['worker_repeat'] + sum(worker_count(c)
+                                            for c in container['nest'])
+
+
+def assign_cpus(tree, cpus, partition=True):
+    """Give the containers of tree cpus, into each container's 'cpus'.
+
+    With partition, siblings split cpus in proportion to their workers,
+    in whole cores kept on one socket where they fit, and nested containers
+    split their parent's share in turn.  Siblings that outnumber the cores
+    all share them.  Otherwise every container gets all of cpus.
+    """
+    parts = None
+    if partition:
+        parts = cpuset.partition_cpus(cpus, [worker_count(c) for c in tree])
+        if parts is None and len(tree) > 1:
+            logging.warn('Too few cores in cpus %s to give %d containers '
+                         'their own', sorted(cpus), len(tree))
+    if parts is None:
+        parts = [set(cpus)] * len(tree)
+    for container, part in zip(tree, parts):
+        container['cpus'] = sorted(part)
+        assign_cpus(container['nest'], part, partition)
+
+
+def all_containers(tree):
+    """Get a flat, top-down list of all containers in tree."""
+    containers = []
+    for container in tree:
+        containers.append(container)
+        containers.extend(all_containers(container['nest']))
+    return containers
+
+
+def sibling_groups(tree):
+    """Get the (name, weight) pairs of each set of sibling containers."""
+    groups = [[(c['name'], c['weight']) for c in tree]]
+    for container in tree:
+        if container['nest']:
+            groups.extend(sibling_groups(container['nest']))
+    return groups
+
+
+def kill_container_tasks(tree):
+    """Terminate every task running in the containers of tree."""
+    for container in all_containers(tree):
+        for task in container['cpu_cgroup'].get_tasks():
+            utils.kill_pid(int(task))
+
+
+# io cgroup counters read before and after every run, for scoring and for
+# the derived metrics.
+SCORED_ATTRS = ('io_service_time', 'io_service_bytes', 'io_serviced',
+                'io_merged', 'io_wait_time', 'timeslice_used',
+                'unaccounted_time')
+
+
+def device_total(lines, device):
+    """Get the Total value for device from the lines of an io attribute,
+       or None if there is none.
+    """
+    return blkio_stats.parse_stat(lines).get(device, {}).get('Total')
+
+
+def read_container_stats(tree, attrs=SCORED_ATTRS):
+    """Snapshot io cgroup counters of all containers of tree at once, as a
+       blkio_stats.stats_snapshot.
+    """
+    reader = cgroup.attr_reader([(c['name'], c['blkio_cgroup'])
+                                 for c in all_containers(tree)], attrs)
+    try:
+        return blkio_stats.stats_snapshot.parse(reader.read(), time.time())
+    finally:
+        reader.close()
 
 
-def measure_containers(tree, device, timevals):
+def measure_containers(tree, device, timevals, stats=None):
     """Measures the 'time' attribute for all containers for a given device.
 
+    stats is the snapshot, or better the delta, to measure; by default
+    the containers' current counters.
     """
-    for container in tree:
-        found_data = False
-        for line in container['blkio_cgroup'].get_attr('io_service_time'):
-            parts = line.split()
-            if parts[0] == device and parts[1] == 'Total':
-                timevals[container['name']] = int(parts[-1])
-                found_data = True
-        if not found_data:
-            timevals[container['name']] = 0
-            logging.warn('No data for container %s.' % container['name'])
+    if stats is None:
+        stats = read_container_stats(tree, ['io_service_time'])
+    for container in all_containers(tree):
+        name = container['name']
+        total = stats.total(name, 'io_service_time', device)
+        if total is None:
+            timevals[name] = 0
+            logging.warn('No data for container %s.' % name)
+        else:
+            timevals[name] = total
 
-        # Recurse to nested containers.
-        measure_containers(container['nest'], device, timevals)
 
+def measure_sampled_window(sampler, device, start, end, timevals):
+    """Measures the service time each sampled container got between
+       times start and end, from the sampler's snapshots.
 
-def measure_timeslice_used(tree, device, timevals):
+       Returns the (start, end) times of the samples used, or None if too
+       few samples were taken in that window.
+    """
+    window = sampler.window(start, end)
+    if not window:
+        return None
+    (first_time, first), (last_time, last) = window
+    delta = blkio_stats.stats_snapshot.parse(last).delta(
+            blkio_stats.stats_snapshot.parse(first))
+    for name in last:
+        timevals[name] = delta.total(name, 'io_service_time', device, 0)
+    return first_time, last_time
+
+
+def measure_timeslice_used(tree, device, timevals, stats=None):
     """Measures the actual timeslice that was charged to the group. This
        is done because we dont charge the first seek to the group and so
        the service_time and actual charged time can diverge outside the
@@ -263,45 +766,67 @@ def measure_timeslice_used(tree, device, timevals):
        any fair scheduling errors.
 
     """
-    for container in tree:
-        found_data = False
-        for line in container['blkio_cgroup'].get_attr('timeslice_used'):
-            parts = line.split()
-            if parts[0] == device:
-                timevals[container['name']] = int(parts[-1])
-                found_data = True
-        if not found_data:
-            timevals[container['name']] = 0
-            logging.warn('No data for container %s.' % container['name'])
-
-        for line in container['blkio_cgroup'].get_attr('unaccounted_time'):
-            parts = line.split()
-            if parts[0] == device:
-                timevals[container['name']] -= int(parts[-1])
-
-        # Recurse to nested containers.
-        measure_timeslice_used(container['nest'], device, timevals)
+    if stats is None:
+        stats = read_container_stats(tree, ['timeslice_used',
+                                            'unaccounted_time'])
+    for container in all_containers(tree):
+        name = container['name']
+        used = stats.total(name, 'timeslice_used', device)
+        if used is None:
+            timevals[name] = 0
+            logging.warn('No data for container %s.' % name)
+        else:
+            timevals[name] = used
+        timevals[name] -= stats.total(name, 'unaccounted_time', device, 0)
 
 
 def get_io_service_bytes(container, device):
     """ Measure the value of io.io_service_bytes for the given device in the
         given container.
     """
-    total = 0
-    for line in container.get_attr('io_service_bytes'):
-        parts = line.split()
-        if parts[0] == device and parts[1] == 'Total':
-            total = float(parts[2])
-    return total
-
+    stat = blkio_stats.parse_stat(container.get_attr('io_service_bytes'))
+    return float(stat.get(device, {}).get('Total', 0))
 
-def release_containers(exper):
-    for container in exper:
-        release_containers(container['nest'])
 
+def release_containers(exper, concurrency=1):
+    """Destroy the containers of an experiment, one level of the tree at a
+       time, bottom-up.  Up to concurrency containers of a level get
+       released at once.
+    """
+    def release(container):
         container['cpu_cgroup'].release()
         container['blkio_cgroup'].release()
 
+    for level in reversed(container_levels(exper)):
+        run_concurrently(release, level, concurrency)
+
+
+def tree_shape(tree):
+    """Get what decides whether an experiment's containers can be reused
+       for another experiment: their nesting, which of them hold workers,
+       since that sets their memory, and the cpus assigned to them.
+    """
+    return tuple(('worker' in c, tuple(c.get('cpus', ())),
+                  tree_shape(c['nest'])) for c in tree)
+
+
+def reuse_containers(old_tree, tree, device):
+    """Give the containers of tree the cgroups of old_tree, which has the
+       same shape, and set their io controls to those tree asks for.
+    """
+    for old_container, container in zip(old_tree, tree):
+        for key in ('cpu_cgroup', 'blkio_cgroup', 'name'):
+            container[key] = old_container[key]
+        path = cpuset.tree_root(BLKIO_CGROUP_NAME,
+                                container['blkio_cgroup'].name)
+        if cpuset.unified_hierarchy:
+            set_controls = cpuset.set_io_weight
+        else:
+            set_controls = cpuset.set_blkio_controls
+        set_controls(path, device, container['weight'],
+                     container['priority'], container['shared_sync_queues'])
+        reuse_containers(old_container['nest'], container['nest'], device)
+
 
 def remove_file(file):
     if os.path.exists(file):
@@ -338,8 +863,25 @@ def score_max_error(tree, timevals):
     return maxerr, actual_weights_str
 
 
+def achieved_shares(tree, timevals):
+    """List (name, weight, achieved DTF) of all containers of tree."""
+    total_time = sum(timevals[c['name']] for c in tree)
+    total_weight = sum(c['weight'] for c in tree)
+    shares = []
+    for container in tree:
+        achieved = timevals[container['name']] * total_weight / float(
+                total_time or 1)
+        shares.append((container['name'], container['weight'], achieved))
+        shares.extend(achieved_shares(container['nest'], timevals))
+    return shares
+
+
 def score_experiment(exper_num, experiment, exper, timevals, allowed_err,
                      autotest_data):
+    """Log achieved DTFs and whether they are within allowed_err.
+
+    Returns whether the experiment passed, and its max DTF error.
+    """
     maxerr_weight, actual_weights  = score_max_error(exper, timevals)
     logging.info('experiment %d achieved DTFs: %s', exper_num, actual_weights)
 
@@ -359,44 +901,211 @@ def score_experiment(exper_num, experiment, exper, timevals, allowed_err,
         autotest_data.append(('%d; %s; %s; %d; %d' %
                              (exper_num, experiment, status, maxerr_weight,
                               allowed_err)))
+    return passing, maxerr_weight
+
+
+# Two-sided 95% quantiles of Student's t distribution, by degrees of freedom.
+T_95 = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+        2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+        2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+        2.042]
+
+
+def confidence_interval(values):
+    """Get mean, sample stddev and 95% confidence interval of the mean.
+
+    The interval is unbounded for a single value.
+    """
+    n = len(values)
+    mean = sum(values) / float(n)
+    if n < 2:
+        return mean, 0.0, float('-inf'), float('inf')
+    stddev = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    if n - 1 < len(T_95):
+        t = T_95[n - 1]
+    else:
+        t = 1.96
+    margin = t * stddev / math.sqrt(n)
+    return mean, stddev, mean - margin, mean + margin
+
+
+def score_trials(exper_num, experiment, errors, allowed_err, autotest_data):
+    """Log the verdict over several trials of one experiment.
+
+    The experiment passes if its mean max DTF error is within allowed_err.
+    """
+    mean, stddev, low, high = confidence_interval(errors)
+    passing = mean <= allowed_err
+    if passing:
+        status = 'PASSED'
+    else:
+        status = 'FAILED'
+
+    logging.info('experiment %d %s: mean max observed error is %.1f, '
+                 'stddev %.1f, 95%% confidence interval %.1f..%.1f over %d '
+                 'trials, allowed is %d', exper_num, status, mean, stddev,
+                 low, high, len(errors), allowed_err)
+
+    if autotest_data is not None:
+        autotest_data.append(('%d; %s; %s; %d; %d' %
+                             (exper_num, experiment, status, round(mean),
+                              allowed_err)))
     return passing
 
 
-def kill_slower_workers(fast_pid, cpu_cgroup, pids_file):
-    moved_pids_file = pids_file + '.moved'
-    try:
-        os.rename(pids_file, moved_pids_file)
-    except OSError:
-        return
-    logging.debug('fastest worker pid %d of container %s'
-                  ' killing all slower workers',
-                  fast_pid, cpu_cgroup.path)
-    for line in open(moved_pids_file):
-        pid = int(line.rstrip())
-        if pid != fast_pid:
-            utils.system('kill %d' % pid, ignore_status=True)
+class start_barrier(object):
+    """Holds workers back until all of them are in place, then lets them go.
+
+    Workers announce that they are in place through one pipe, and then
+    block reading a second pipe whose write end only the harness keeps open;
+    closing it wakes all of them at once.  Each released worker then
+    reports when it actually got going, through a third pipe.
+    """
+
+    def __init__(self):
+        self.ready_read_fd, self.ready_fd = os.pipe()
+        self.wait_fd, self.release_fd = os.pipe()
+        self.times_read_fd, self.times_fd = os.pipe()
 
 
-def run_worker(cmd, cpu_cgroup, blkio_cgroup, pids_file):
-    # main of new process for running an independent worker shell
+    def wait(self):
+        """Called by a worker process: block until the barrier is released.
+        """
+        os.close(self.ready_read_fd)
+        os.close(self.release_fd)
+        os.close(self.times_read_fd)
+        os.write(self.ready_fd, 'R')
+        os.close(self.ready_fd)
+        os.read(self.wait_fd, 1)
+        os.write(self.times_fd, struct.pack('d', time.time()))
+        os.close(self.wait_fd)
+        os.close(self.times_fd)
+
+
+    def release(self, workers=0, ready_timeout=10):
+        """Called by the harness: start all waiting workers.
+
+        First waits up to ready_timeout seconds for the given number of
+        workers to reach the barrier.  Returns the sorted times at which the
+        workers started; released_at holds the time of the release itself.
+        """
+        os.close(self.wait_fd)
+        os.close(self.times_fd)
+        os.close(self.ready_fd)
+        ready = 0
+        deadline = time.time() + ready_timeout
+        while ready < workers:
+            timeout = deadline - time.time()
+            if timeout <= 0 or not select.select([self.ready_read_fd], [],
+                                                 [], timeout)[0]:
+                logging.warn('Only %d of %d workers reached the start '
+                             'barrier', ready, workers)
+                break
+            more = os.read(self.ready_read_fd, 4096)
+            if not more:
+                break
+            ready += len(more)
+        os.close(self.ready_read_fd)
+
+        self.released_at = time.time()
+        os.close(self.release_fd)
+        data = ''
+        while True:
+            more = os.read(self.times_read_fd, 4096)
+            if not more:
+                break
+            data += more
+        os.close(self.times_read_fd)
+        size = struct.calcsize('d')
+        return sorted(struct.unpack('d', data[i:i+size])[0]
+                      for i in xrange(0, len(data) - size + 1, size))
+
+
+def run_worker(cmd, cpu_cgroup, blkio_cgroup, output_file, barrier=None):
+    # main of new process for running an independent worker command, for
+    # systems where spawn_worker_in_cgroups cannot place workers directly.
     logging.debug('Worker running command: %s' % cmd)
     logging.debug('Moving to cpu_cgroup: %s' % cpu_cgroup.path)
     logging.debug('Moving to blkio_cgroup: %s' % blkio_cgroup.path)
     cpu_cgroup.move_my_task_here()
     blkio_cgroup.move_my_task_here()
-    p = subprocess.Popen(cmd.split(),
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT,
-                         close_fds=True)
-    if pids_file:
-        utils.system('echo %d >> %s' % (p.pid, pids_file))
+    if barrier:
+        barrier.wait()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Become the worker, so that the harness can signal and reap it.
+    out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    null_fd = os.open('/dev/null', os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(out_fd, 1)
+    os.dup2(out_fd, 2)
+    os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+    argv = cmd.split()
+    os.execvp(argv[0], argv)
+
+
+def spawn_worker_in_cgroups(cmd, cpu_cgroup, blkio_cgroup, output_file,
+                            barrier=None):
+    """Start a worker command that runs in its cgroups from its first
+       instruction on.
+
+       The forked child moves itself into the cgroups with raw writes to their
+       tasks files, waits at barrier if there is one, and then execs the
+       command straight away, without an intermediate Python worker process.
+       Its output goes to output_file.  Returns the worker's pid.  Raises
+       error.Error if the child could not be placed into its cgroups.
+    """
+    argv = cmd.split()
+    tasks_files = [cpu_cgroup.tasks_file()]
+    if blkio_cgroup.tasks_file() not in tasks_files:
+        tasks_files.append(blkio_cgroup.tasks_file())
+    max_fd = os.sysconf('SC_OPEN_MAX')
+
+    status_r, status_w = os.pipe()
+    pid = os.fork()
+    if not pid:  # we are child process; only use raw os calls from here on
+        try:
+            os.close(status_r)
+            try:
+                my_pid = str(os.getpid())
+                for tasks_file in tasks_files:
+                    fd = os.open(tasks_file, os.O_WRONLY)
+                    try:
+                        os.write(fd, my_pid)
+                    finally:
+                        os.close(fd)
+            except OSError, e:
+                os.write(status_w, 'E%s: %s' % (tasks_file, e.strerror))
+                os._exit(1)
+            os.write(status_w, 'P')
+            os.close(status_w)
+            if barrier:
+                barrier.wait()
+
+            out_fd = os.open(output_file,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            null_fd = os.open('/dev/null', os.O_RDONLY)
+            os.dup2(null_fd, 0)
+            os.dup2(out_fd, 1)
+            os.dup2(out_fd, 2)
+            os.closerange(3, max_fd)
+            os.execvp(argv[0], argv)
+        except OSError, e:
+            os.write(2, 'cannot run %s: %s\n' % (cmd, e.strerror))
+        finally:
+            os._exit(127)
+
+    # we are parent
+    os.close(status_w)
+    status = os.read(status_r, 4096)
+    os.close(status_r)
+    if status != 'P':
+        os.waitpid(pid, 0)
+        raise error.Error('Could not place worker in its cgroups: %s' %
+                          (status[1:] or 'worker died'))
     logging.debug('running "%s" in container %s and io cgroup %s as pid %d',
-                  cmd, cpu_cgroup.path, blkio_cgroup.path, p.pid)
-
-    p.wait()
-    if pids_file:
-        kill_slower_workers(p.pid, cpu_cgroup, pids_file)
-    logging.debug(p.stdout.read())
+                  cmd, cpu_cgroup.path, blkio_cgroup.path, pid)
+    return pid
 
 
 def actual_disk_device(ldevice):
@@ -430,8 +1139,17 @@ def device_holding_file(filename):
     raise ValueError("Could not find device holding %s" % filename)
 
 
+def workvol_device(workvol, google_hacks):
+    """Get the name of the disk device holding workvol."""
+    if google_hacks:
+        return actual_disk_device(device_holding_file(workvol))
+    return device_holding_file(workvol)
+
+
 def enable_blkio_and_cfq(device):
-    """Enable blkio and cfq, when not done by boot command."""
+    """Enable blkio and cfq, when not done by boot command.  With cgroup2,
+       enable bfq, or failing that iocost, whose io weights replace cfq's.
+    """
     # Ensure that the required device is valid block device.
     disk = os.path.join('/sys/block', device)
     if not os.path.exists(disk):
@@ -441,6 +1159,10 @@ def enable_blkio_and_cfq(device):
     if not cgroup.mount_point(BLKIO_CGROUP_NAME):
         raise error.Error('Kernel not compiled with blkio support')
 
+    if cgroup.version() == 2:
+        enable_io_weights(device)
+        return
+
     # Enable cfq scheduling on the block device.
     file = os.path.join(disk, 'queue/scheduler')
     if '[cfq]' in utils.read_one_line(file):
@@ -451,34 +1173,145 @@ def enable_blkio_and_cfq(device):
     utils.write_one_line(file, 'cfq')
 
 
+def enable_io_weights(device):
+    """Make cgroup2 io weights take effect on device, through bfq if the
+       kernel has it, else through iocost.
+    """
+    file = os.path.join('/sys/block', device, 'queue/scheduler')
+    scheduler = utils.read_one_line(file)
+    if '[bfq]' in scheduler:
+        logging.debug('bfq scheduler is already enabled on drive %s', device)
+        return
+    if 'bfq' in scheduler.split():
+        logging.info('Enabling bfq scheduler on drive %s', device)
+        utils.write_one_line(file, 'bfq')
+        return
+
+    qos = os.path.join(cgroup.mount_point(BLKIO_CGROUP_NAME), 'io.cost.qos')
+    if not os.path.exists(qos):
+        raise error.Error('Kernel has neither bfq nor iocost for io weights')
+    number = utils.get_device_id(device)
+    for line in open(qos).readlines():
+        if line.startswith(number + ' ') and 'enable=1' in line.split():
+            logging.debug('iocost is already enabled on drive %s', device)
+            return
+    logging.info('Enabling iocost on drive %s', device)
+    utils.write_one_line(qos, '%s enable=1' % number)
+
+
 
 class test_harness(object):
     def __init__(self, title, post_experiment_cb=None):
         self.title = title
         self._post_experiment_cb = post_experiment_cb
+        self.sampler = None
+        self.planning = False
+        self.results = None
+        self.output_mbytes = 0
+        self.used_input_files = set()
+        # What trials time themselves with.
+        self.clock = time.time
+        # (shape, tree) of the containers kept for the next experiment.
+        self.pooled = None
+
 
+    def some_input_file(self, prefix, mbytes):
+        """Get an input file of at least mbytes.
 
-    def some_zeroed_input_file(self, prefix, mbytes):
-        name = os.path.join(self.workdir,
-                            '%s%d' % (prefix, self.input_file_count))
+        The file's missing data is only written by provision_input_files.
+        """
+        name = self.input_pool.file_name(self.input_data, prefix,
+                                         self.input_file_count)
         self.input_file_count += 1
-        # TODO: use actual disk file size, avoid rebuilding across iterations
-        old_mbytes = self.existing_input_files.get(name, 0)
-        if mbytes > old_mbytes:
-            cmd = ('/bin/dd if=/dev/zero of=%s bs=1M seek=%d count=%d'
-                   % (name, old_mbytes, mbytes-old_mbytes))
-            utils.system(cmd)
-            self.existing_input_files[name] = mbytes
+        self.used_input_files.add(name)
+        if name not in self.existing_input_files:
+            # First use in this run, see what earlier runs left behind.
+            self.existing_input_files[name] = self.input_pool.valid_mbytes(
+                    name, self.input_data)
+        if mbytes > self.existing_input_files[name]:
+            self.pending_input_files[name] = max(
+                    mbytes, self.pending_input_files.get(name, 0))
         return name
 
 
+    def input_fill_cmd(self, name, old_mbytes, mbytes):
+        """Get the command that writes megabytes old_mbytes..mbytes of name.
+        """
+        if self.input_data == 'zero':
+            return ('/bin/dd if=/dev/zero of=%s bs=1M seek=%d count=%d'
+                    % (name, old_mbytes, mbytes-old_mbytes))
+        # Seed from the name, so each file has distinct, repeatable data.
+        seed = zlib.crc32(os.path.basename(name)) & 0xffffffff
+        return ('%s/fill_file -s %d %s %d %d'
+                % (self.srcdir, seed, name, old_mbytes, mbytes))
+
+
+    def provision_input_files(self):
+        """Write the missing tails of all pending input files.
+
+        Up to provision_concurrency files are filled at the same time.
+        """
+        if not self.pending_input_files:
+            return
+        fills = sorted(self.pending_input_files.items())
+        self.pending_input_files = {}
+        total_mbytes = sum(mbytes - self.existing_input_files[name]
+                           for name, mbytes in fills)
+        logging.info('Writing %d MB of %s data into %d input files',
+                     total_mbytes, self.input_data, len(fills))
+
+        start_seconds = time.time()
+        running = []
+        try:
+            while fills or running:
+                while fills and len(running) < self.provision_concurrency:
+                    name, mbytes = fills.pop(0)
+                    cmd = self.input_fill_cmd(name,
+                                              self.existing_input_files[name],
+                                              mbytes)
+                    logging.debug("Running '%s'", cmd)
+                    p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT,
+                                         close_fds=True)
+                    running.append((p, name, mbytes, cmd))
+                time.sleep(0.05)
+                for fill in running[:]:
+                    p, name, mbytes, cmd = fill
+                    if p.poll() is None:
+                        continue
+                    running.remove(fill)
+                    output = p.stdout.read()
+                    p.stdout.close()
+                    if p.returncode:
+                        raise error.Error("Command '%s' returned non-zero "
+                                          "exit status %d: %s" %
+                                          (cmd, p.returncode, output))
+                    logging.debug(output)
+                    self.existing_input_files[name] = mbytes
+                    self.input_pool.record(name, mbytes, self.input_data)
+        finally:
+            # After a failed fill, stop the others rather than leave them
+            # writing behind our back.
+            for p, name, mbytes, cmd in running:
+                if p.poll() is None:
+                    p.kill()
+                p.wait()
+                p.stdout.close()
+
+        seconds = time.time() - start_seconds
+        logging.info('Provisioned %d MB in %.1f seconds, %.1f MB/s',
+                     total_mbytes, seconds, total_mbytes / (seconds or 1))
+
+
     def output_file_name(self, n):
         return os.path.join(self.workdir, 'write%d' % n)
 
 
-    def some_output_file(self):
+    def some_output_file(self, mbytes=0):
+        """Get the name of a new output file, that gets up to mbytes."""
         name = self.output_file_name(self.output_file_count)
         self.output_file_count += 1
+        self.output_mbytes += mbytes
         return name
 
 
@@ -488,6 +1321,34 @@ class test_harness(object):
         self.output_file_count = 0
 
 
+    def evict_caches(self):
+        """Get the test's files out of the page cache before a run.
+
+        With cache_eviction 'files', only this run's input files and any
+        leftover output files get written back and dropped.  With 'all',
+        all of the system's dirty pages and caches are.
+        """
+        start_seconds = time.time()
+        if self.cache_eviction == 'all':
+            logging.info('Flush all read/write caches. This could take a '
+                         'minute.')
+            utils.drop_caches()
+            logging.info('Dropped all caches in %.1f seconds',
+                         time.time() - start_seconds)
+            return
+
+        files = sorted(self.used_input_files)
+        files += glob.glob(os.path.join(self.workdir, 'write*'))
+        resident = 0
+        for name in files:
+            resident += utils.evict_file(name)
+        logging.info('Evicted %d files from the page cache in %.2f seconds',
+                     len(files), time.time() - start_seconds)
+        if resident:
+            logging.warn('%d pages of the test files are still cached',
+                         resident)
+
+
     def setup_worker(self, worker, mbytes):
         # mbytes fixes the effective size of the worker's input or output file.
         #   For workers other than rdseq, this size gets scaled to give
@@ -500,7 +1361,7 @@ class test_harness(object):
 
         # Sequential reads.
         if worker.startswith('rdseq'):
-            file_name = self.some_zeroed_input_file('rddata', mbytes)
+            file_name = self.some_input_file('rddata', mbytes)
             extra_options = ''
 
             if variant == 'dir':
@@ -511,7 +1372,7 @@ class test_harness(object):
 
         # Random reads.
         elif worker.startswith('rdrand'):
-            file_name = self.some_zeroed_input_file('rddata', mbytes)
+            file_name = self.some_input_file('rddata', mbytes)
             log_iosize = 16  # 64Kb/read, is about 8x slower than seq read
             # randomly read 12% of the records of the input file
             #   so that entire file does not get cached,
@@ -530,7 +1391,6 @@ class test_harness(object):
 
         # Sequential write.
         elif worker.startswith('wrseq'):
-            file_name = self.some_output_file()
             extra_options = ''
 
             if variant == 'sync':
@@ -543,13 +1403,14 @@ class test_harness(object):
                 # Buffered mode needs a bigger files which overflow fs cache.
                 mbytes *= 2
 
+            file_name = self.some_output_file(mbytes)
             count = mbytes * 16  # 64K * 16 = 1M
             cmd = ('/bin/dd if=/dev/zero of=%s bs=64K count=%d %s' %
                    (file_name, count, extra_options))
 
         elif worker.startswith('io_load_read'):
             io_load_path = os.path.join(self.srcdir, 'io_load')
-            file_name = self.some_zeroed_input_file('rddata', mbytes)
+            file_name = self.some_input_file('rddata', mbytes)
             delayms = ''
             if variant.startswith('delay'):
                 delayms = '-d %d ' % int(variant[5:])
@@ -565,7 +1426,8 @@ class test_harness(object):
                 delayms = '-d %d ' % int(variant[5:])
 
             # Touch the file so it exists.
-            open(file_name, 'w').close()
+            if not self.planning:
+                open(file_name, 'w').close()
             cmd = '%s %s w %s' % (io_load_path, delayms, file_name)
 
         # Sleep op.
@@ -599,10 +1461,9 @@ class test_harness(object):
             self.setup_worker_files(seq_read_mb, container['nest'])
 
 
-    def enum_worker_runners(self, tree, pids_file, timeout):
+    def enum_worker_runners(self, tree):
         """Recursive top-down walk over an experiment's tree of containers,
            gathering the tasks & arguments for launching all workers.
-           pids_file is '' if slower workers should complete.
         """
         tasks = []
         for container in tree:
@@ -610,34 +1471,103 @@ class test_harness(object):
                 if cmd:
                     tasks.append([cmd,
                                   container['cpu_cgroup'],
-                                  container['blkio_cgroup'],  pids_file])
-
-            # Timeout is empty here because we don't want to recursively
-            # add the sleep code.
-            tasks.extend(self.enum_worker_runners(container['nest'],
-                                                  pids_file, ''))
-
-        if pids_file and timeout:
-            # add pseudo worker to root containers to timeout all workers,
-            # shortens experiment when fastest worker was given low weight
-            cmd = 'sleep %s' % timeout
-            container = tree[0]
-            tasks.append([cmd, cgroup.root_cgroup('cpuset'),
-                          cgroup.root_cgroup(BLKIO_CGROUP_NAME), pids_file])
+                                  container['blkio_cgroup']])
+            tasks.extend(self.enum_worker_runners(container['nest']))
         return tasks
 
 
-    def run_worker_processes_in_parallel(self, runners):
+    def worker_output_file(self, n):
+        return os.path.join(self.workdir, 'worker%d.out' % n)
+
+
+    def launch_workers_directly(self, runners, barrier):
+        """Start every worker already inside its cgroups, held at barrier.
+
+        Returns a map from worker pids to their output files.  Raises
+        error.Error, after stopping any workers it started, if workers
+        cannot be placed directly on this system.
+        """
+        workers = {}
+        for n, (cmd, cpu_cgroup, blkio_cgroup) in enumerate(runners):
+            output_file = self.worker_output_file(n)
+            try:
+                pid = spawn_worker_in_cgroups(cmd, cpu_cgroup, blkio_cgroup,
+                                              output_file, barrier)
+            except error.Error:
+                for pid in workers:
+                    utils.kill_pid(pid)
+                    os.waitpid(pid, 0)
+                barrier.release()
+                raise
+            workers[pid] = output_file
+        return workers
+
+
+    def release_workers(self, barrier, workers):
+        """Let all workers waiting at barrier start, and log how close
+           together they did.
+        """
+        start_times = barrier.release(workers)
+        self.release_time = barrier.released_at
+        if self.sampler:
+            self.sampler.start()
+        self.start_spread = 0.0
+        if start_times:
+            self.start_spread = start_times[-1] - start_times[0]
+            logging.info('%d workers started within %.2f ms of each other, '
+                         'last one %.2f ms after release', len(start_times),
+                         self.start_spread * 1000,
+                         (start_times[-1] - barrier.released_at) * 1000)
+
+
+    def supervise_workers(self, workers, kill_slower, timeout):
+        """Wait for all released workers, a map from pids to output files.
+
+        With kill_slower, the first worker to finish, or reaching timeout
+        seconds, ends all the others.
+        """
+        supervisor = worker_supervisor.worker_supervisor(
+                workers, kill_slower, timeout)
+        supervisor.run(self.release_time)
+        self.first_exit_time = supervisor.end_time
+        self.worker_exit_times = supervisor.exit_times
+        if supervisor.timed_out:
+            logging.info('Workers ended by the %s second timeout', timeout)
+        for pid in sorted(workers, key=supervisor.exit_times.get):
+            logging.debug('worker pid %d exited %.3f seconds after release',
+                          pid, supervisor.exit_times[pid] - self.release_time)
+            logging.debug(open(workers[pid]).read())
+
+
+    def run_worker_processes_in_parallel(self, runners, kill_slower=False,
+                                         timeout=None):
         sys.stdout.flush()
         sys.stderr.flush()
-        pids = []
-        for task in runners:
-            args = task
+        self.release_time = time.time()
+        self.first_exit_time = None
+        if self.direct_launch:
+            barrier = start_barrier()
+            try:
+                workers = self.launch_workers_directly(runners, barrier)
+            except error.Error, e:
+                logging.warn('%s; falling back to starting workers from '
+                             'forked harness processes', e)
+                self.direct_launch = False
+            else:
+                self.release_workers(barrier, len(workers))
+                logging.debug('waiting for worker tasks')
+                self.supervise_workers(workers, kill_slower, timeout)
+                return
+
+        barrier = start_barrier()
+        workers = {}
+        for n, task in enumerate(runners):
+            args = task + [self.worker_output_file(n)]
             logging.debug('running worker args: %s' % args)
             pid = os.fork()
             if not pid:  # we are child process
                 try:
-                    run_worker(*args)
+                    run_worker(*(args + [barrier]))
                 except Exception, e:
                     exc_type, exc_value, exc_tb = sys.exc_info()
                     logging.error("*** Traceback:")
@@ -650,21 +1580,64 @@ class test_harness(object):
                     sys.exit(1)
                 sys.exit(0)
             # we are parent
-            pids.append(pid)
+            workers[pid] = args[-1]
 
+        self.release_workers(barrier, len(workers))
         logging.debug('waiting for worker tasks')
-        for pid in pids:
-            pid, status = os.waitpid(pid, 0)
+        self.supervise_workers(workers, kill_slower, timeout)
 
 
     def run_single_experiment(self, exper_num, experiment, seq_read_mb,
                               kill_slower, timeout, allowed_error,
                               autotest_data):
-        """Run a single experiment involving one round of concurrent execution
-           of IO workers in competing containers.
+        """Run a single experiment, as one or more trials.
+
+        At least self.trials trials get run.  While the confidence interval
+        of the max DTF error still straddles allowed_error, more trials get
+        added, up to self.max_trials.
         """
         logging.info('----- Running experiment %d: %s', exper_num, experiment)
 
+        self.trial_num = 0
+        if self.max_trials <= 1:
+            passing, maxerr = self.run_trial(exper_num, experiment,
+                                             seq_read_mb, kill_slower,
+                                             timeout, allowed_error,
+                                             autotest_data)
+            errors = [maxerr]
+        else:
+            errors = []
+            while len(errors) < self.max_trials:
+                logging.info('--- Trial %d of experiment %d', len(errors),
+                             exper_num)
+                self.trial_num = len(errors)
+                passing, maxerr = self.run_trial(exper_num, experiment,
+                                                 seq_read_mb, kill_slower,
+                                                 timeout, allowed_error, None)
+                errors.append(maxerr)
+                if len(errors) < self.trials:
+                    continue
+                mean, stddev, low, high = confidence_interval(errors)
+                if not low <= allowed_error < high:
+                    break
+            passing = score_trials(exper_num, experiment, errors,
+                                   allowed_error, autotest_data)
+
+        if self.results:
+            self.results.record_experiment(self.run_id, exper_num,
+                                           experiment, passing,
+                                           sum(errors) / float(len(errors)),
+                                           allowed_error, len(errors))
+        if passing:
+            self.passed_experiments += 1
+        self.tried_experiments += 1
+
+
+    def run_trial(self, exper_num, experiment, seq_read_mb, kill_slower,
+                  timeout, allowed_error, autotest_data):
+        """Run one round of concurrent execution of IO workers in competing
+           containers.  Returns whether it passed, and its max DTF error.
+        """
         # Given the experiment parameters generate a exper map based off the
         # tests grammar.
         exper = parse_experiment(experiment)
@@ -672,16 +1645,12 @@ class test_harness(object):
         # Generate user space commands to be executed per worker.
         logging.info('Creating initial file set.')
         self.input_file_count = self.output_file_count = 0
+        self.output_mbytes = 0
+        self.used_input_files = set()
         self.setup_worker_files(seq_read_mb, exper)
-        if kill_slower:
-            pids_file = os.path.join(self.workdir, 'pids_file')
-            remove_file(pids_file)
-            remove_file(pids_file + '.moved')
-        else:
-            pids_file = ''
+        self.provision_input_files()
 
-        logging.info('Flush all read/write caches. This could take a minute.')
-        utils.drop_caches()
+        self.evict_caches()
 
         # Generate class cgroup_access objects or cpuset and blkio.
         parent_cpu_cgroup = cgroup.root_cgroup('cpuset')
@@ -690,38 +1659,68 @@ class test_harness(object):
         logging.info('parent_cpu_cgroup: ' + parent_cpu_cgroup.path +
                      ' parent_blkio_cgroup: ' + parent_blkio_cgroup.path)
 
-        logging.info('Create all required containers.')
-        setup_containers(exper, self.device,
-            parent_cpu_cgroup.name, parent_cpu_cgroup, parent_blkio_cgroup)
+        self.acquire_containers(exper, parent_cpu_cgroup,
+                                parent_blkio_cgroup)
 
         # Add all required workers  & parameters to the tasks list.
-        runners = self.enum_worker_runners(exper, pids_file, timeout)
+        runners = self.enum_worker_runners(exper)
+
+        # The sampler gets started when the workers are released.
+        self.sampler = None
+        if self.sample_interval:
+            self.sampler = stats_sampler.stats_sampler(
+                    [(c['name'], c['blkio_cgroup'])
+                     for c in all_containers(exper)],
+                    self.sample_interval)
+        if self.converge_tolerance is not None:
+            service_time = lambda values: device_total(
+                    values.get('io_service_time', []), self.device) or 0
+            monitor = stats_sampler.convergence_monitor(
+                    sibling_groups(exper), service_time,
+                    self.converge_tolerance, self.converge_duration,
+                    self.converge_max_seconds,
+                    lambda: kill_container_tasks(exper))
+            self.sampler.on_sample = monitor.check
 
         logging.info('Run the actual experiment now, launching all worker '
                      'processes.')
-        start_seconds = time.time()
+        # Score on counter deltas, not on new cgroups starting from zero.
+        start_stats = read_container_stats(exper)
+        start_seconds = self.clock()
         start_bytes = get_io_service_bytes(parent_blkio_cgroup, self.device)
-        self.run_worker_processes_in_parallel(runners)
+        self.run_worker_processes_in_parallel(
+                runners, kill_slower, timeout and timeout_seconds(timeout))
+        if self.sampler:
+            self.sampler.stop()
 
         logging.info('All workers have now completed or been killed by fastest '
                      'worker.')
-        seconds_elapsed = time.time() - start_seconds
+        seconds_elapsed = self.clock() - start_seconds
         end_bytes = get_io_service_bytes(parent_blkio_cgroup, self.device)
         mbytes_delta = (end_bytes - start_bytes) / math.pow(1024, 2)
         logging.info('Experiment completed in %.1f seconds', seconds_elapsed)
         throughput = mbytes_delta / seconds_elapsed
         logging.info('Aggregate Throughput = %f MB/s', throughput)
 
+        stats = read_container_stats(exper).delta(start_stats)
+        for name in sorted(stats.containers()):
+            metrics = stats.derived(name, self.device)
+            logging.debug('container %s: %s', name,
+                          ', '.join('%s %.1f' % item
+                                    for item in sorted(metrics.items())))
+
         timevals = {}
-        measure_containers(exper, self.device, timevals)
+        measure_containers(exper, self.device, timevals, stats)
+        if self.steady_state_start is not None:
+            self.measure_steady_state(timevals)
         if self._post_experiment_cb:
             self._post_experiment_cb(exper, self.device)
 
         # Score the experiment.
         logging.debug('Scoring the experiment.')
-        passing = score_experiment(exper_num, experiment,
-                                   exper, timevals, allowed_error,
-                                   autotest_data)
+        passing, maxerr = score_experiment(exper_num, experiment,
+                                           exper, timevals, allowed_error,
+                                           autotest_data)
 
         if not passing:
             # Since we dont charge the first seek to the group, there are some
@@ -732,20 +1731,458 @@ class test_harness(object):
             logging.warn('Service times not proportional. Re-scoring based on'
                          ' timeslice_used.')
             timeslices = {}
-            measure_timeslice_used(exper, self.device, timeslices)
+            measure_timeslice_used(exper, self.device, timeslices, stats)
             score_experiment(exper_num, experiment, exper, timeslices,
                              allowed_error, None)
 
-        if passing:
-            self.passed_experiments += 1
-        self.tried_experiments += 1
+        if self.results:
+            self.results.record_trial(self.run_id, exper_num, experiment,
+                                      self.trial_num, passing, maxerr,
+                                      allowed_error, throughput,
+                                      seconds_elapsed,
+                                      achieved_shares(exper, timevals))
 
         self.remove_output_files()
-        release_containers(exper)
+        if self.reuse_containers:
+            self.pooled = (tree_shape(exper), exper)
+        else:
+            release_containers(exper, self.setup_concurrency)
+        return passing, maxerr
+
+
+    def acquire_containers(self, exper, parent_cpu_cgroup,
+                           parent_blkio_cgroup):
+        """Create the containers of an experiment, or take over those of the
+           last one when it had the same shape.
+
+        Only one tree gets kept, as the containers of every shape use the
+        same names.  Its counters are not reset: trials only score what
+        changed since they started.
+        """
+        self.place_cpus(exper, parent_cpu_cgroup)
+
+        if self.pooled and self.pooled[0] == tree_shape(exper):
+            logging.info('Reusing the containers of the last experiment.')
+            reuse_containers(self.pooled[1], exper, self.device)
+            self.pooled = None
+            return
+
+        self.release_pooled_containers()
+        logging.info('Create all required containers.')
+        setup_containers(exper, self.device,
+            parent_cpu_cgroup.name, parent_cpu_cgroup, parent_blkio_cgroup,
+            self.cgroup_prefix, self.setup_concurrency)
+
+
+    def place_cpus(self, exper, parent_cpu_cgroup):
+        """Give the containers of exper their cpus, unless they all share
+           those of parent_cpu_cgroup.
+        """
+        if self.cpu_placement == 'partition' or self.exclude_irq_cpus:
+            assign_cpus(exper, self.worker_cpus(parent_cpu_cgroup),
+                        self.cpu_placement == 'partition')
+
+
+    def worker_cpus(self, parent_cpu_cgroup):
+        """Get the cpus of parent_cpu_cgroup that workers may use: all, or
+           with exclude_irq_cpus, those not handling the device's
+           interrupts, if any are left.
+        """
+        cpus = cpuset.get_cpus(cpuset.tree_root('cpuset',
+                                                parent_cpu_cgroup.name))
+        if self.exclude_irq_cpus:
+            irq_cpus = cpuset.device_irq_cpus(self.device)
+            if irq_cpus and not cpus - irq_cpus:
+                logging.warn('Interrupts of %s go to all cpus, keeping them',
+                             self.device)
+            else:
+                cpus -= irq_cpus
+        return cpus
+
+
+    def release_pooled_containers(self):
+        """Destroy the containers kept for reuse, if any."""
+        if self.pooled:
+            release_containers(self.pooled[1], self.setup_concurrency)
+            self.pooled = None
+
+
+    def measure_steady_state(self, timevals):
+        """Replace timevals by the service times of the steady-state window.
+
+        The window starts steady_state_start seconds after the workers were
+        released, and ends when the first worker finished.  timevals is left
+        alone if the sampler did not cover that window.
+        """
+        start = self.release_time + self.steady_state_start
+        end = self.first_exit_time or time.time()
+        window_timevals = {}
+        window = measure_sampled_window(self.sampler, self.device, start, end,
+                                        window_timevals)
+        if not window:
+            logging.warn('Too few samples between %.1f and %.1f seconds, '
+                         'scoring the whole run', start - self.release_time,
+                         end - self.release_time)
+            return
+        logging.info('Scoring steady-state window from %.1f to %.1f seconds',
+                     window[0] - self.release_time,
+                     window[1] - self.release_time)
+        timevals.update(window_timevals)
+
+
+    def disk_device(self, workvol, google_hacks):
+        """Get the name of the disk device that experiments on workvol use.
+        """
+        return workvol_device(workvol, google_hacks)
+
+
+    def setup_workvol(self, workvol, google_hacks):
+        """Prepare the scratch directory on workvol and the disk holding it."""
+        # Create the test directory on the workvol.
+        if not os.path.exists(workvol):
+            raise error.Error('Machine does not have %s' % workvol)
+
+        self.workdir = os.path.join(workvol, 'blkcgroup_test_tmp')
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+        elif self.resume:
+            # Keep the checkpoint and input files, and clean up after the
+            # experiment that got interrupted.
+            delete_test_containers(self.cgroup_prefix)
+            for name in glob.glob(os.path.join(self.workdir, 'write*')):
+                os.remove(name)
+        else:
+            # Remove all previous content from "workdir"s subdirectories.
+            utils.empty_dir(self.workdir)
+
+        # Get get the underlying device name where the workvol is located.
+        self.device = self.disk_device(workvol, google_hacks)
+
+        self.input_pool = self.open_input_pool(workvol)
+        if not os.path.exists(self.input_pool.pool_dir):
+            os.makedirs(self.input_pool.pool_dir)
+
+        enable_blkio_and_cfq(self.device)
+
+        logging.debug('Measuring IO on disk %s', self.device)
+
+
+    def open_input_pool(self, workvol):
+        """Get the pool of input files for workvol, without changing it."""
+        # Input files live in the workdir, unless they are kept across runs.
+        if self.keep_input_files:
+            pool_dir = os.path.join(workvol, INPUT_POOL_DIR)
+        else:
+            pool_dir = os.path.join(workvol, 'blkcgroup_test_tmp')
+        return file_pool.input_file_pool(pool_dir, self.device)
+
+
+    def plan_experiment_list(self, numbered_experiments, seq_read_mb,
+                             kill_slower, timeout):
+        """Expand (number, experiment) pairs into what running them would
+           take, without touching the system.  Returns a list of per
+           experiment plans, and the MB of input data that would get written.
+        """
+        self.input_file_count = self.output_file_count = 0
+        self.existing_input_files = {}
+        self.pending_input_files = {}
+        plans = []
+        self.planning = True
+        try:
+            for i, (experiment, allowed_error) in numbered_experiments:
+                exper = parse_experiment(experiment)
+                self.input_file_count = self.output_file_count = 0
+                self.output_mbytes = 0
+                self.setup_worker_files(seq_read_mb, exper)
+                self.place_cpus(exper, cgroup.root_cgroup('cpuset'))
+
+                # Each container with workers moves about seq_read_mb.
+                busy = len([c for c in all_containers(exper)
+                            if [cmd for cmd in c['worker_cmds'] if cmd]])
+                seconds = busy * seq_read_mb / float(
+                        ESTIMATED_DISK_MB_PER_SECOND)
+                if kill_slower and timeout:
+                    seconds = min(seconds, timeout_seconds(timeout))
+                if self.converge_max_seconds:
+                    seconds = min(seconds, self.converge_max_seconds)
+
+                plans.append({
+                    'number': i,
+                    'experiment': experiment,
+                    'cgroup_ops': plan_cgroup_ops(exper, self.device,
+                                                  self.cgroup_prefix),
+                    'memory_mbytes': sum(plan_container_size(c)
+                                         for c in exper),
+                    'output_mbytes': self.output_mbytes,
+                    'trial_seconds': seconds,
+                })
+        finally:
+            self.planning = False
+        input_mbytes = sum(mbytes - self.existing_input_files[name]
+                           for name, mbytes in
+                           self.pending_input_files.items())
+        self.pending_input_files = {}
+        return plans, input_mbytes
+
+
+    def check_plan(self, plans, input_mbytes, workvol):
+        """Reject experiments that would run out of disk space on workvol
+           or out of memory for their containers.
+        """
+        st = os.statvfs(workvol)
+        free_mbytes = (st.f_bavail * st.f_frsize) >> 20
+        disk_mbytes = input_mbytes + max([p['output_mbytes'] for p in plans]
+                                         or [0])
+        if disk_mbytes > free_mbytes:
+            raise error.Error('Experiments need %d MB on %s, which only has '
+                              '%d MB free' % (disk_mbytes, workvol,
+                                              free_mbytes))
+
+        total_mbytes = utils.memtotal() >> 10
+        for plan in plans:
+            if plan['memory_mbytes'] > total_mbytes:
+                raise error.Error('Experiment %d needs %d MB for its '
+                                  'containers, the machine has %d MB' %
+                                  (plan['number'], plan['memory_mbytes'],
+                                   total_mbytes))
+
+
+    def report_plan(self, plans, input_mbytes, workvol):
+        """Log what running the planned experiments on workvol would do."""
+        for plan in plans:
+            logging.info('----- Experiment %d: %s', plan['number'],
+                         plan['experiment'])
+            for op in plan['cgroup_ops']:
+                logging.info('  %s', op)
+            logging.info('  %d MB container memory, %d MB output files, '
+                         'about %d seconds per trial', plan['memory_mbytes'],
+                         plan['output_mbytes'], plan['trial_seconds'])
+
+        st = os.statvfs(workvol)
+        logging.info('Disk: %d MB of new input files and up to %d MB of '
+                     'output files, %d MB free on %s', input_mbytes,
+                     max([p['output_mbytes'] for p in plans] or [0]),
+                     (st.f_bavail * st.f_frsize) >> 20, workvol)
+        logging.info('Memory: up to %d MB for containers, %d MB total',
+                     max([p['memory_mbytes'] for p in plans] or [0]),
+                     utils.memtotal() >> 10)
+        seconds = input_mbytes / float(ESTIMATED_DISK_MB_PER_SECOND)
+        trial_seconds = sum(p['trial_seconds'] for p in plans)
+        logging.info('Duration: about %d minutes at %d MB/s, up to %d '
+                     'minutes with extra trials',
+                     (seconds + trial_seconds * self.trials) / 60,
+                     ESTIMATED_DISK_MB_PER_SECOND,
+                     (seconds + trial_seconds * self.max_trials) / 60)
+
+
+    def plan_workvol(self, workvol, google_hacks, numbered_experiments,
+                     seq_read_mb, kill_slower, timeout):
+        """Report, and check, what running experiments on workvol would do,
+           without running them or changing anything.
+        """
+        if not os.path.exists(workvol):
+            raise error.Error('Machine does not have %s' % workvol)
+        self.workdir = os.path.join(workvol, 'blkcgroup_test_tmp')
+        self.device = self.disk_device(workvol, google_hacks)
+        self.input_pool = self.open_input_pool(workvol)
+        if not self.keep_input_files and not self.resume:
+            # setup_workvol would empty the workdir first.
+            self.input_pool.files = {}
+        cpuset.discover_container_style()
+
+        numbered_experiments = [[i, list(experiment)]
+                                for i, experiment in numbered_experiments]
+        done = self.read_checkpoint(numbered_experiments, seq_read_mb)
+        plans, input_mbytes = self.plan_experiment_list(
+                [(i, e) for i, e in numbered_experiments if i not in done],
+                seq_read_mb, kill_slower, timeout)
+        self.report_plan(plans, input_mbytes, workvol)
+        self.check_plan(plans, input_mbytes, workvol)
+
+
+    def read_checkpoint(self, numbered_experiments, seq_read_mb):
+        """Get the results of the experiments that an interrupted run of
+           the same experiments finished, keyed by experiment number.
+        """
+        path = os.path.join(self.workdir, CHECKPOINT_FILE)
+        if not self.resume or not os.path.exists(path):
+            return {}
+        checkpoint = json.load(open(path))
+        if (checkpoint['experiments'] != numbered_experiments or
+            checkpoint['seq_read_mb'] != seq_read_mb):
+            raise error.Error('%s is from a different list of experiments; '
+                              'run without -r to start over' % path)
+        return dict((int(i), result)
+                    for i, result in checkpoint['done'].items())
+
+
+    def write_checkpoint(self, numbered_experiments, seq_read_mb, done):
+        """Record finished experiments, replacing the old checkpoint
+           atomically.  Input files are recorded by the input file pool.
+        """
+        path = os.path.join(self.workdir, CHECKPOINT_FILE)
+        checkpoint = open(path + '.tmp', 'w')
+        try:
+            json.dump({'experiments': numbered_experiments,
+                       'seq_read_mb': seq_read_mb,
+                       'done': done}, checkpoint)
+        finally:
+            checkpoint.close()
+        os.rename(path + '.tmp', path)
+
+
+    def run_experiment_list(self, numbered_experiments, seq_read_mb,
+                            kill_slower, timeout, autotest_data):
+        """Run (number, experiment) pairs against the current device.
+
+        Leaves a checkpoint in the workdir after every experiment, so that
+        an interrupted run can be resumed with -r.
+        """
+        numbered_experiments = [[i, list(experiment)]
+                                for i, experiment in numbered_experiments]
+        done = self.read_checkpoint(numbered_experiments, seq_read_mb)
+        if done:
+            logging.info('Resuming, %d experiments already finished',
+                         len(done))
+        plans, input_mbytes = self.plan_experiment_list(
+                [(i, e) for i, e in numbered_experiments if i not in done],
+                seq_read_mb, kill_slower, timeout)
+        self.check_plan(plans, input_mbytes, self.workdir)
+
+        self.input_file_count = self.output_file_count = 0
+        self.tried_experiments  = 0
+        self.passed_experiments = 0
+
+        self.results = None
+        if self.results_path:
+            self.results = results_db.results_db(self.results_path)
+            self.run_id = self.results.start_run(
+                    self.title, self.device,
+                    results_db.environment_fingerprint(self.device,
+                                                       seq_read_mb))
+
+        try:
+            for i, experiment in numbered_experiments:
+                workers, allowed_error = experiment
+                if i in done:
+                    logging.info('Skipping experiment %d, finished earlier', i)
+                    self.tried_experiments += 1
+                    self.passed_experiments += done[i]['passed']
+                    autotest_data.extend(str(item)
+                                         for item in done[i]['autotest_data'])
+                    continue
+
+                passed = self.passed_experiments
+                first_output = len(autotest_data)
+                self.run_single_experiment(i, workers, seq_read_mb,
+                                           kill_slower, timeout, allowed_error,
+                                           autotest_data)
+                done[i] = {'passed': self.passed_experiments - passed,
+                           'autotest_data': autotest_data[first_output:]}
+                self.write_checkpoint(numbered_experiments, seq_read_mb, done)
+        finally:
+            self.release_pooled_containers()
+
+
+    def run_shard(self, workvol, device, numbered_experiments, google_hacks,
+                  seq_read_mb, kill_slower, timeout):
+        """main of a shard process: runs its share of experiments on one disk.
+
+        Leaves the counts and autotest data in the shard's workdir, for
+        run_sharded_experiments to merge.
+        """
+        tag_logging(device)
+        self.cgroup_prefix = TEST_CGROUP_PREFIX + device
+        self.setup_workvol(workvol, google_hacks)
+        logging.info('Shard running %d experiments', len(numbered_experiments))
+
+        autotest_data = []
+        self.run_experiment_list(numbered_experiments, seq_read_mb,
+                                 kill_slower, timeout, autotest_data)
+
+        results = open(os.path.join(self.workdir, SHARD_RESULTS_FILE), 'w')
+        try:
+            json.dump({'tried': self.tried_experiments,
+                       'passed': self.passed_experiments,
+                       'autotest_data': autotest_data}, results)
+        finally:
+            results.close()
+
+
+    def run_sharded_experiments(self, experiments, workvols, google_hacks,
+                                seq_read_mb, kill_slower, timeout,
+                                autotest_data):
+        """Split experiments across several disks, one shard process per disk.
+
+        Each shard gets its own workdir on its volume and its own
+        blkcgroupt<device> cgroup names, so shards never touch each other's
+        files or containers.  Experiments keep their global numbering.
+        """
+        devices = [workvol_device(workvol, google_hacks)
+                   for workvol in workvols]
+        for device in devices:
+            if devices.count(device) > 1:
+                raise error.Error('Several work volumes are on disk %s' %
+                                  device)
+
+        numbered = list(enumerate(experiments))
+        shards = {}
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for n, workvol in enumerate(workvols):
+            pid = os.fork()
+            if not pid:  # we are the shard process
+                status = 1
+                try:
+                    self.run_shard(workvol, devices[n],
+                                   numbered[n::len(workvols)], google_hacks,
+                                   seq_read_mb, kill_slower, timeout)
+                    status = 0
+                except Exception:
+                    logging.error('shard for %s failed:\n%s', workvol,
+                                  traceback.format_exc())
+                sys.stdout.flush()
+                os._exit(status)
+            shards[pid] = workvol
+
+        logging.info('Waiting for %d shards', len(shards))
+        self.tried_experiments = self.passed_experiments = 0
+        failed_shards = []
+        shard_data = []
+        while shards:
+            pid, status = os.wait()
+            if pid not in shards:
+                continue
+            workvol = shards.pop(pid)
+            workdir = os.path.join(workvol, 'blkcgroup_test_tmp')
+            results_file = os.path.join(workdir, SHARD_RESULTS_FILE)
+            if status or not os.path.exists(results_file):
+                # Keep its workdir and checkpoint, for resuming with -r.
+                failed_shards.append(workvol)
+            else:
+                results = json.load(open(results_file))
+                self.tried_experiments += results['tried']
+                self.passed_experiments += results['passed']
+                shard_data.extend(results['autotest_data'])
+                utils.remove_tree(workdir)
+
+        # Present merged results in experiment order.
+        shard_data.sort(key=lambda item: int(item.split(';', 1)[0]))
+        autotest_data.extend(str(item) for item in shard_data)
+        if failed_shards:
+            raise error.Error('Shards for %s did not complete' %
+                              ', '.join(failed_shards))
 
 
     def run_experiments(self, experiments, seq_read_mb, workvol,
-                        kill_slower=False, timeout=''):
+                        kill_slower=False, timeout='', input_data='random',
+                        provision_concurrency=4, setup_concurrency=8,
+                        sample_interval=0,
+                        steady_state_start=None, converge_tolerance=None,
+                        converge_duration=10, converge_max_seconds=None,
+                        trials=1, max_trials=None, cache_eviction='files',
+                        reuse_containers=False, cpu_placement='shared',
+                        exclude_irq_cpus=False):
         """Execute a previously-generated list of experiments.
 
         experiments: a list of (string, number) tuples to run as tests.
@@ -754,7 +2191,9 @@ class test_harness(object):
             input/output data files for all workers within one container.
             For workers other than rdseq, this gets automatically adjusted
             to give run times approximately equal to rdseq.
-        workvol: the mounted volume that will be tested.
+        workvol: the mounted volume that will be tested.  A list of volumes
+            on different disks splits the experiments across those disks,
+            running them in parallel.  The -w option overrides this.
         kill_slower: finished worker kills all unfinished sibling workers.
             This shortens runs but does not affect the DTF statistics.
         timeout = '': run fastest worker to completion
@@ -762,10 +2201,50 @@ class test_harness(object):
             Keeps 25_25_25_25% experiment from taking 4x longer than 95_5%.
             This should be set longer than most experiments, and long enough
             to reach steady state and good measurements on all experiments.
+        input_data = 'random': fill input files with incompressible data
+        input_data = 'zero': fill input files with zeroes, using dd
+        provision_concurrency: how many input files get filled at once.
+        setup_concurrency: how many containers of one level of an
+            experiment's tree get created, or released, at once.
+        sample_interval: seconds between snapshots of all containers' io
+            counters while workers run; 0 takes no snapshots.
+        steady_state_start: if set, score experiments only on the service
+            time containers got from this many seconds after the start until
+            the first worker finished.  Samples every second unless
+            sample_interval says otherwise.
+        converge_tolerance: if set, stop each experiment early once every
+            container's running share (in weight units, like allowed errors)
+            has stayed within a band this wide for converge_duration
+            seconds, or after converge_max_seconds at the latest.  Samples
+            every second unless sample_interval says otherwise.
+        trials: how many times to run each experiment.  Experiments are
+            then scored on the mean of their trials' max DTF errors.
+        max_trials: if more than trials, keep adding trials to experiments
+            while the 95% confidence interval of their max DTF error still
+            includes allowed_error, up to this many.
+        cache_eviction = 'files': before each run, drop just the test's
+            own input and output files from the page cache
+        cache_eviction = 'all': sync and drop all of the system's caches
+        reuse_containers: keep the containers of an experiment for the
+            next trial or experiment when its tree has the same shape, only
+            setting their weights, priorities and shared sync queues anew.
+        cpu_placement = 'shared': every container gets all of the cpus
+        cpu_placement = 'partition': sibling containers split the cpus in
+            proportion to their workers, in whole cores on one socket where
+            they fit
+        exclude_irq_cpus: keep workers off the cpus that handle the
+            interrupts of the disk under test.
         """
+        if input_data not in ('random', 'zero'):
+            raise ValueError('unknown input_data %s' % input_data)
+        if cache_eviction not in ('files', 'all'):
+            raise ValueError('unknown cache_eviction %s' % cache_eviction)
+        if cpu_placement not in ('shared', 'partition'):
+            raise ValueError('unknown cpu_placement %s' % cpu_placement)
 
         try:
-            opts, args = getopt.getopt(sys.argv[1:], 'cgho:', ['help'])
+            opts, args = getopt.getopt(sys.argv[1:], 'cd:ghknro:w:',
+                                       ['help'])
         except getopt.GetoptError, err:
             print str(err)
             usage(sys.argv)
@@ -774,65 +2253,94 @@ class test_harness(object):
         cleanup = False
         google_hacks = False
         autotest_output = False
+        dry_run = False
+        self.keep_input_files = False
+        self.resume = False
+        self.results_path = None
+        if isinstance(workvol, basestring):
+            workvols = [workvol]
+        else:
+            workvols = list(workvol)
 
         for o, a in opts:
             if o == '-c':
                 cleanup = True
+            elif o == '-d':
+                self.results_path = os.path.abspath(a)
             elif o == '-g':
                 google_hacks = True
+            elif o == '-k':
+                self.keep_input_files = True
+            elif o == '-n':
+                dry_run = True
             elif o == '-o':
                 autotest_output = a
+            elif o == '-r':
+                self.resume = True
+            elif o == '-w':
+                workvols = a.split(',')
             elif o in ('-h', '--help'):
                 usage(sys.argv)
                 sys.exit()
             else:
                 assert False, 'unhandled option: ' + o
 
-        if cleanup:
+        if cleanup and not dry_run:
             delete_test_containers()
         logging.info('Starting test "%s"', self.title)
 
-        # Create the test directory on the workvol.
-        if not os.path.exists(workvol):
-            raise error.Error('Machine does not have %s' % workvol)
-
-        self.workdir = os.path.join(workvol, 'blkcgroup_test_tmp')
-        if not os.path.exists(self.workdir):
-            os.makedirs(self.workdir)
-        else:
-            # Remove all previous content from "workdir"s subdirectories.
-            utils.system('rm -rf %s/*' % self.workdir)
-
-        # Get get the underlying device name where the workvol is located.
-        if google_hacks:
-          self.device = actual_disk_device(device_holding_file(workvol))
-        else:
-          self.device = device_holding_file(workvol)
-
-        enable_blkio_and_cfq(self.device)
-
-        logging.debug('Measuring IO on disk %s', self.device)
-
         # Setup test specific parameters.
         self.srcdir = os.getcwd()
-        self.input_file_count = self.output_file_count = 0
-        self.existing_input_files = {}
-        self.tried_experiments  = 0
-        self.passed_experiments = 0
+        self.cgroup_prefix = TEST_CGROUP_PREFIX
+        self.input_data = input_data
+        self.cache_eviction = cache_eviction
+        self.provision_concurrency = provision_concurrency
+        self.setup_concurrency = setup_concurrency
+        self.reuse_containers = reuse_containers
+        self.cpu_placement = cpu_placement
+        self.exclude_irq_cpus = exclude_irq_cpus
+        self.direct_launch = True
+        self.steady_state_start = steady_state_start
+        self.converge_tolerance = converge_tolerance
+        self.converge_duration = converge_duration
+        self.converge_max_seconds = converge_max_seconds
+        self.trials = trials
+        self.max_trials = max(trials, max_trials or trials)
+        if not sample_interval and (steady_state_start is not None or
+                                    converge_tolerance is not None):
+            sample_interval = 1
+        self.sample_interval = sample_interval
 
         logging.info('%d total experiment runs', len(experiments))
 
-        # TODO: Before running all experiments, validate them to fail early on
-        # a bad experiment list.
+        # Fail early on a bad experiment list, not hours into the run.
+        validate_experiments(experiments)
+
+        if dry_run:
+            numbered = list(enumerate(experiments))
+            for n, workvol in enumerate(workvols):
+                if len(workvols) > 1:
+                    self.cgroup_prefix = (TEST_CGROUP_PREFIX +
+                                          workvol_device(workvol,
+                                                         google_hacks))
+                self.plan_workvol(workvol, google_hacks,
+                                  numbered[n::len(workvols)], seq_read_mb,
+                                  kill_slower, timeout)
+            return
 
         autotest_data = []
 
-        # Iterate over all experiments.
-        for i, experiment in enumerate(experiments):
-            workers, allowed_error = experiment
-            self.run_single_experiment(i, workers, seq_read_mb,
-                                       kill_slower, timeout, allowed_error,
-                                       autotest_data)
+        if len(workvols) > 1:
+            self.run_sharded_experiments(experiments, workvols, google_hacks,
+                                         seq_read_mb, kill_slower, timeout,
+                                         autotest_data)
+        else:
+            self.setup_workvol(workvols[0], google_hacks)
+            # Iterate over all experiments.
+            self.run_experiment_list(enumerate(experiments), seq_read_mb,
+                                     kill_slower, timeout, autotest_data)
+            # All done, a later -r has nothing to resume.
+            remove_file(os.path.join(self.workdir, CHECKPOINT_FILE))
 
         # We have to do file output after all the worker threads are done and we
         # won't create any more. Printing during score_experiment() caused
@@ -853,4 +2361,5 @@ class test_harness(object):
 
 
         # Cleanup.
-        utils.system('rm -rf %s' % self.workdir)
+        if len(workvols) == 1:
+            utils.remove_tree(self.workdir)
@@ -0,0 +1,226 @@
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# Parsing of io cgroup stat files into typed records, and snapshots of them
+# that can be subtracted from each other.
+#
+# Stat files come in three shapes, all keyed by device:
+#     sda 1234                          one value per device
+#     sda Read 12 / sda Total 34        one value per device and category
+#     sda read 1 5 0 2                  a histogram per device and category
+# A device-less 'Total 46' line sums a category file over all devices.
+# Parsed stats are {device: {category: value}}, with category '' for
+# single values and device '' for the overall total.  Values are ints, or
+# tuples of ints for histograms.
+#
+# The cgroup2 io.stat file instead holds all counters of all devices, one
+# line per device:
+#     8:0 rbytes=1459200 wbytes=314773504 rios=192 wios=353 dbytes=0 dios=0
+# io_stat_attr_lines translates it into the lines of the v1 attributes.
+
+
+# Stats that hold a current level rather than a running count.  Deltas
+# keep their latest value instead of subtracting.
+GAUGES = ('avg_queue_size', 'avg_queue_size_self', 'io_queued',
+          'io_queued_self', 'io_service_level', 'shared_sync_queues')
+
+# The io.stat keys that v1 attributes translate from, summed into a Total,
+# with the category of each key.  Service time comes from iocost's
+# cost.usage, in microseconds, when the kernel has it.  Otherwise the
+# bytes transferred stand in for it, since a container's share of those
+# is the closest measure of the device share it got.
+IO_STAT_ATTRS = {
+    'io_service_bytes': (('rbytes', 'Read'), ('wbytes', 'Write')),
+    'io_serviced': (('rios', 'Read'), ('wios', 'Write')),
+    'io_service_time': (('cost.usage', None),),
+    'timeslice_used': (('cost.usage', None),),
+}
+SERVICE_TIME_FALLBACK = 'io_service_bytes'
+
+
+def parse_stat(lines):
+    """Parse the lines of one stat file into {device: {category: value}}.
+    """
+    stat = {}
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == 'Total' and len(parts) == 2:
+            device, category, numbers = '', 'Total', parts[1:]
+        elif len(parts) == 2:
+            device, category, numbers = parts[0], '', parts[1:]
+        else:
+            device, category, numbers = parts[0], parts[1], parts[2:]
+        try:
+            values = [int(n) for n in numbers]
+        except ValueError:
+            continue  # not a counter, eg a setting
+        if len(values) == 1:
+            value = values[0]
+        else:
+            value = tuple(values)
+        stat.setdefault(device, {})[category] = value
+    return stat
+
+
+def parse_io_stat(lines):
+    """Parse the lines of a cgroup2 io.stat file into
+       {'major:minor': {key: value}}.
+    """
+    stat = {}
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        counters = stat.setdefault(parts[0], {})
+        for part in parts[1:]:
+            key, sep, value = part.partition('=')
+            try:
+                counters[key] = int(value)
+            except ValueError:
+                continue
+    return stat
+
+
+def io_stat_attr_lines(io_stat, attr):
+    """Get the lines that v1 attribute attr would hold, from io.stat
+       counters parsed by parse_io_stat and keyed by device name.
+    """
+    lines = []
+    for device, counters in sorted(io_stat.items()):
+        keys = IO_STAT_ATTRS[attr]
+        if not any(key in counters for key, category in keys):
+            if attr not in ('io_service_time', 'timeslice_used'):
+                continue
+            keys = IO_STAT_ATTRS[SERVICE_TIME_FALLBACK]
+        total = 0
+        for key, category in keys:
+            value = counters.get(key, 0)
+            if key == 'cost.usage':
+                value *= 1000  # usecs to the nsecs of v1
+            if category:
+                lines.append('%s %s %d' % (device, category, value))
+            total += value
+        lines.append('%s Total %d' % (device, total))
+    return lines
+
+
+def subtract(after, before):
+    """Get after - before, for ints or histogram tuples."""
+    if isinstance(after, tuple):
+        if not isinstance(before, tuple) or len(before) != len(after):
+            return after
+        return tuple(a - b for a, b in zip(after, before))
+    return after - before
+
+
+class stats_snapshot(object):
+    """Parsed stats of a set of containers, taken at one time.
+
+    stats is {container name: {attr: {device: {category: value}}}}.
+    """
+
+    def __init__(self, stats, time=None):
+        self.stats = stats
+        self.time = time
+
+
+    @classmethod
+    def parse(cls, raw, time=None):
+        """Parse raw {container name: {attr: lines}}, as read by
+           cgroup.attr_reader or sampled by stats_sampler.
+        """
+        return cls(dict((name, dict((attr, parse_stat(lines))
+                                    for attr, lines in attrs.items()))
+                        for name, attrs in raw.items()), time)
+
+
+    def containers(self):
+        return self.stats.keys()
+
+
+    def get(self, container, attr, device, category='Total', default=None):
+        """Get one value, or default if it was not read."""
+        try:
+            return self.stats[container][attr][device][category]
+        except KeyError:
+            return default
+
+
+    def total(self, container, attr, device, default=None):
+        """Get a device's Total of a category stat, or its only value."""
+        categories = self.device_stat(container, attr, device)
+        return categories.get('Total', categories.get('', default))
+
+
+    def device_stat(self, container, attr, device):
+        """Get all categories of one attribute for one device."""
+        return self.stats.get(container, {}).get(attr, {}).get(device, {})
+
+
+    def delta(self, before):
+        """Get what changed since an earlier snapshot, as a snapshot.
+
+        Counters missing from before count from zero.  Gauges keep their
+        value in this snapshot.
+        """
+        stats = {}
+        for name, attrs in self.stats.items():
+            old_attrs = before.stats.get(name, {})
+            for attr, devices in attrs.items():
+                old_devices = old_attrs.get(attr, {})
+                for device, categories in devices.items():
+                    old_categories = old_devices.get(device, {})
+                    delta = stats.setdefault(name, {}).setdefault(
+                            attr, {}).setdefault(device, {})
+                    for category, value in categories.items():
+                        if attr in GAUGES or category not in old_categories:
+                            delta[category] = value
+                        else:
+                            delta[category] = subtract(
+                                    value, old_categories[category])
+        time = None
+        if self.time is not None and before.time is not None:
+            time = self.time - before.time
+        return stats_snapshot(stats, time)
+
+
+    def derived(self, container, device):
+        """Get metrics computed from a container's counters for a device.
+
+        Best used on deltas.  Metrics whose inputs were not read, or are
+        zero, are left out.
+        """
+        get = lambda attr: self.total(container, attr, device)
+        serviced = get('io_serviced')
+        service_bytes = get('io_service_bytes')
+        merged = get('io_merged')
+        service_time = get('io_service_time')
+        wait_time = get('io_wait_time')
+        metrics = {}
+        if serviced:
+            if service_bytes is not None:
+                metrics['avg_request_bytes'] = service_bytes / float(serviced)
+            if merged is not None:
+                metrics['merge_ratio'] = merged / float(serviced + merged)
+            if service_time is not None:
+                metrics['avg_service_ns'] = service_time / float(serviced)
+            if wait_time is not None:
+                metrics['avg_wait_ns'] = wait_time / float(serviced)
+        if service_bytes and self.time:
+            metrics['mbytes_per_second'] = (service_bytes / float(self.time) /
+                                          2**20)
+        return metrics
@@ -18,33 +18,200 @@
 #   and other subsystems each have their own hierarchy and mount point.
 # This grouping of subsystems is learned, not hard-coded.
 # Most subsystem tests will work with both joint and separate hierarchies,
+# and with the single unified hierarchy of cgroup2, which gets used when no
+# v1 hierarchy handles io.
 
 
-import logging, os
-import error, utils
+import ctypes, errno, glob, logging, os, re
+import blkio_stats, error, utils
 
-# Global cache of all the cgroups and their associated mount points.
-cached_mounts = {}
+# Global cache of the kernel's cgroup hierarchies, as found by probe().
+cached_capabilities = None
+# Bytes attr_reader reads at a time, which is all a cgroup seq_file hands
+# out per read.
+PAGE_SIZE = 4096
+# Global cache of block device names, by 'major:minor' number.
+cached_device_names = {}
+
+
+class cgroup_fs(object):
+    """Makes and removes cgroup directories, which the kernel fills with
+       and empties of their attribute files.  Replaced by simulators that
+       serve a fake cgroup tree from ordinary directories.
+    """
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+
+# How cgroups get made and removed.
+fs = cgroup_fs()
+
+
+def unescape_mount_field(field):
+    """Undo the octal escapes of spaces and such in a mountinfo field."""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+# Options of v1 cgroup mounts that name no subsystem, for kernels without
+# /proc/cgroups.  Options with a '=', like name=systemd, name none either.
+MOUNT_FLAGS = ('rw', 'ro', 'all', 'none', 'noprefix', 'clone_children',
+               'xattr', 'cpuset_v2_mode', 'favordynmods')
+
+
+def kernel_subsystems(filename='/proc/cgroups'):
+    """Get the names of the kernel's cgroup subsystems, or None if it does
+       not list them.
+    """
+    if not os.path.exists(filename):
+        return None
+    return set(line.split()[0] for line in open(filename).readlines()
+               if line.strip() and not line.startswith('#'))
+
+
+def mountinfo_hierarchies(filename='/proc/self/mountinfo'):
+    """List the (filesystem type, mount point, controllers) of the cgroup
+       and cpuset filesystems that are mounted, in mount order.  Controllers
+       of cgroup2 come from its cgroup.controllers.
+    """
+    hierarchies = []
+    subsystems = kernel_subsystems()
+    for line in open(filename).readlines():
+        # eg '35 24 0:30 / /dev/cgroup/io rw - cgroup none rw,io'
+        fields = line.split()
+        if '-' not in fields[6:]:
+            continue
+        separator = fields.index('-', 6)
+        mount_pt = unescape_mount_field(fields[4])
+        fs_type = fields[separator + 1]
+        options = fields[separator + 3].split(',')
+        if fs_type == 'cgroup':
+            if subsystems is None:
+                controllers = [o for o in options
+                               if '=' not in o and o not in MOUNT_FLAGS]
+            else:
+                controllers = [o for o in options if o in subsystems]
+        elif fs_type == 'cgroup2':
+            filename = os.path.join(mount_pt, 'cgroup.controllers')
+            controllers = []
+            if os.path.exists(filename):
+                controllers = utils.read_one_line(filename).split()
+        elif fs_type == 'cpuset':
+            controllers = ['cpuset']
+        else:
+            continue
+        hierarchies.append((fs_type, mount_pt, controllers))
+    return hierarchies
+
+
+class capabilities(object):
+    """What the kernel's cgroup hierarchies offer the test.
+
+    Worked out once from the mounted hierarchies, a list of (filesystem
+    type, mount point, controllers).  The io attribute files are learned
+    from the first cgroup asked about, since all non-root cgroups of a
+    hierarchy have the same ones.
+    """
+
+    def __init__(self, hierarchies):
+        self.hierarchies = hierarchies
+        # mount point of the cgroup2 hierarchy, if it can control io
+        self.unified = ''
+        self.unified_controllers = []
+        for fs_type, mount_pt, controllers in hierarchies:
+            if fs_type == 'cgroup2' and 'io' in controllers:
+                self.unified = mount_pt
+                self.unified_controllers = controllers
+                break
+        self.version = 1
+        if self.unified and not [h for h in hierarchies
+                                 if h[0] == 'cgroup' and 'io' in h[2]]:
+            self.version = 2
+        logging.debug('using cgroup v%d', self.version)
+
+        self.mounts = {}
+        for fs_type, mount_pt, controllers in hierarchies:
+            if self.version == 2 or fs_type == 'cgroup2':
+                continue
+            for subsystem in controllers:
+                self.mounts.setdefault(subsystem, mount_pt)
+
+        # The old cpuset filesystem, and noprefix mounts, name attributes
+        # cpus and mems rather than cpuset.cpus and cpuset.mems.
+        self.cpuset_prefix = 'cpuset.'
+        if self.version == 1 and 'cpuset' in self.mounts and \
+           os.path.exists(os.path.join(self.mounts['cpuset'], 'cpus')):
+            self.cpuset_prefix = ''
+        self.knobs = None
+
+
+    def mount_point(self, subsystem):
+        """Get the mount point of the hierarchy handling subsystem, or ''."""
+        if self.version == 2:
+            return self.unified
+        return self.mounts.get(subsystem, '')
+
+
+    def has(self, subsystem):
+        """Tell whether the test's cgroups can use subsystem."""
+        if self.version == 2:
+            return subsystem in self.unified_controllers
+        return subsystem in self.mounts
+
+
+    def prefix(self, subsystem):
+        """Get qualifier for subsystem's attribute names."""
+        if subsystem == 'cpuset':
+            return self.cpuset_prefix
+        return subsystem + '.'
+
+
+    def io_knobs(self, path):
+        """Get the names of the io attribute files that cgroups have, as
+           found in cgroup path when first asked.
+        """
+        if self.knobs is None:
+            self.knobs = frozenset(name for name in os.listdir(path)
+                                   if name.startswith('io.'))
+            logging.debug('io attributes: %s', ' '.join(sorted(self.knobs)))
+        return self.knobs
+
+
+def probe():
+    """Get the capabilities of the kernel's cgroups, probed on first use."""
+    global cached_capabilities
+    if cached_capabilities is None:
+        cached_capabilities = capabilities(mountinfo_hierarchies())
+    return cached_capabilities
+
+
+def unified_mount():
+    """Get the mount point of the cgroup2 hierarchy, or '' if there is none
+       or it cannot control io.
+    """
+    return probe().unified
+
+
+def version():
+    """Get 2 if the test's cgroups live in the unified cgroup2 hierarchy,
+       else 1.
+    """
+    return probe().version
 
 
 def mount_point(subsystem):
     """Get mount point for the cgroup hierarchy handling a particular subsystem.
     """
-    if subsystem not in cached_mounts:
-        cached_mounts[subsystem] = ''
-        for mounts in open('/proc/mounts').readlines():
-            name, mount_pt, fs, options, junk = mounts.split(None, 4)
-            if (fs == 'cgroup' and subsystem in options.split(',')  or
-                fs == 'cpuset' == subsystem):
-                    cached_mounts[subsystem] = mount_pt
-                    break
-
-    if cached_mounts[subsystem] == '':
+    mount_pt = probe().mount_point(subsystem)
+    if mount_pt == '':
         # Error out if no mount_point found.
         raise error.Error('Could not find an associated mount point for '
                           'subsystem: %s' % subsystem)
-
-    return cached_mounts[subsystem]
+    return mount_pt
 
 
 def my_container():
@@ -73,15 +240,22 @@ def root_cgroup(subsystem):
 def cgroup(subsystem, name):
     """Get a cgroup accessor for the subsystem for cgroup name."""
     path = os.path.join(mount_point(subsystem), name)
+    if version() == 2:
+        return cgroup2_accessor(subsystem, path)
     return cgroup_accessor(subsystem, path)
 
 
+def device_name(number):
+    """Get the name of the block device numbered 'major:minor', eg sda."""
+    if number not in cached_device_names:
+        path = os.path.realpath(os.path.join('/sys/dev/block', number))
+        cached_device_names[number] = os.path.basename(path)
+    return cached_device_names[number]
+
+
 def subsystem_prefix(subsystem):
     """Get qualifier for subsystem's attribute names."""
-    filename = os.path.join(mount_point('cpuset'), 'cpus')
-    if subsystem == 'cpuset' and os.path.exists(filename):
-        return ''  # old non-cgroup style
-    return subsystem + '.'
+    return probe().prefix(subsystem)
 
 
 class cgroup_accessor(object):
@@ -92,23 +266,27 @@ class cgroup_accessor(object):
     settings.
     """
 
+    # The attribute that moves tasks into this cgroup.
+    TASKS = 'tasks'
+
     def __init__(self, subsystem, path):
-        mount = mount_point(subsystem)
+        caps = probe()
+        mount = caps.mount_point(subsystem)
         self.subsystem = subsystem
         self.path = path
         self.name = path[len(mount)+1:]
-        self.cpuset_hierarchy = mount == mount_point('cpuset')
-        self.subsystem_prefix = subsystem_prefix(subsystem)
+        self.cpuset_hierarchy = mount == caps.mount_point('cpuset')
+        self.subsystem_prefix = caps.prefix(subsystem)
 
 
     def parent(self):
         """Get the parent of this cgroup."""
-        return cgroup_accessor(self.subsystem, os.path.dirname(self.path))
+        return self.__class__(self.subsystem, os.path.dirname(self.path))
 
 
     def child(self, name):
         """Get the child of this cgroup that has the requested name."""
-        return cgroup_accessor(self.subsystem, os.path.join(self.path, name))
+        return self.__class__(self.subsystem, os.path.join(self.path, name))
 
 
     def _attr_file(self, attr, prefix):
@@ -124,6 +302,11 @@ class cgroup_accessor(object):
         return [value.rstrip() for value in open(filename).readlines()]
 
 
+    def parse_attrs(self, attrs, lines):
+        """Get {attr: lines} for attrs, from the lines of their one file."""
+        return dict((attr, lines) for attr in attrs)
+
+
     def put_attr(self, attr, values, prefix='default'):
         """Set the value of a given cgorup attribute."""
         filename = self._attr_file(attr, prefix)
@@ -131,9 +314,14 @@ class cgroup_accessor(object):
             utils.write_one_line(filename, value)
 
 
+    def tasks_file(self):
+        """Get the name of the file that moves tasks into this cgroup."""
+        return self._attr_file(self.TASKS, '')
+
+
     def get_tasks(self):
         """Get the value of the 'tasks' cgorup attribute."""
-        return self.get_attr('tasks', '')
+        return self.get_attr(self.TASKS, '')
 
 
     def put_tasks(self, tasks):
@@ -146,7 +334,7 @@ class cgroup_accessor(object):
         """
         for task in tasks:
             try:
-                self.put_attr('tasks', [task], '')
+                self.put_attr(self.TASKS, [task], '')
             except Exception:
                 if utils.pid_is_alive(task):
                     raise   # task exists but couldn't move it
@@ -171,8 +359,142 @@ class cgroup_accessor(object):
         """
         if os.path.exists(self.path):
             # Transfer any survivor tasks (e.g. me) to parent
-            self.parent().put_tasks(self.get_tasks())
+            self.survivor_cgroup().put_tasks(self.get_tasks())
 
             # remove the now-empty outermost cgroup of this subtree
-            os.rmdir(self.path)
+            fs.rmdir(self.path)
             logging.debug('Deleted cgroup %s', self.path)
+
+
+    def survivor_cgroup(self):
+        """Get the cgroup that takes the tasks left behind on release."""
+        return self.parent()
+
+
+class cgroup2_accessor(cgroup_accessor):
+    """An accessor for a cgroup of the unified cgroup2 hierarchy.
+
+    All subsystems share the one hierarchy, and processes move through
+    cgroup.procs.  The io counters that v1 kept in a file each all come from
+    io.stat, translated into the lines of the v1 attributes.
+    """
+
+    TASKS = 'cgroup.procs'
+
+    def _attr_file(self, attr, prefix):
+        if attr in blkio_stats.IO_STAT_ATTRS and prefix in ('default', 'io.'):
+            return os.path.join(self.path, 'io.stat')
+        return cgroup_accessor._attr_file(self, attr, prefix)
+
+
+    def get_attr(self, attr, prefix='default'):
+        if self._attr_file(attr, prefix) != os.path.join(self.path, 'io.stat'):
+            return cgroup_accessor.get_attr(self, attr, prefix)
+        if self.name:
+            lines = cgroup_accessor.get_attr(self, 'stat', 'io.')
+        else:
+            lines = self.root_io_stat()
+        return self.parse_attrs([attr], lines)[attr]
+
+
+    def parse_attrs(self, attrs, lines):
+        io_stat = dict((device_name(number), counters) for number, counters
+                       in blkio_stats.parse_io_stat(lines).items())
+        return dict((attr, blkio_stats.io_stat_attr_lines(io_stat, attr))
+                    for attr in attrs)
+
+
+    def root_io_stat(self):
+        """Get io.stat lines for the root cgroup, which has no io.stat,
+           from the block devices' own counters.
+        """
+        lines = []
+        for stat in glob.glob('/sys/block/*/stat'):
+            disk = os.path.dirname(stat)
+            number = utils.read_one_line(os.path.join(disk, 'dev'))
+            fields = [int(n) for n in utils.read_one_line(stat).split()]
+            lines.append('%s rbytes=%d wbytes=%d rios=%d wios=%d' %
+                         (number, fields[2] << 9, fields[6] << 9,
+                          fields[0], fields[4]))
+        return lines
+
+
+    def survivor_cgroup(self):
+        # Processes may not live in the parent, if it has nested cgroups
+        # with controllers enabled; only the root is exempt.
+        return self.__class__(self.subsystem, mount_point(self.subsystem))
+
+
+class attr_reader(object):
+    """Reads the same attributes of a set of cgroups, again and again.
+
+    Every attribute file stays open, and each read re-reads it from offset 0
+    with pread, a page at a time, into one shared buffer of fixed size, so
+    taking a snapshot costs two system calls per file of up to a page: one
+    for the data and one finding the end.  Attributes held in one file, like the io.stat counters of
+    cgroup2, cost one file between them.  cgroups is a list of (name,
+    cgroup accessor) pairs.  Attributes that a cgroup does not have are left
+    out of its snapshots.
+    """
+
+    def __init__(self, cgroups, attrs, prefix='default'):
+        self.files = []  # (name, accessor, fd, attrs)
+        self.missing = set()
+        self.buffer = ctypes.create_string_buffer(PAGE_SIZE)
+        for name, accessor in cgroups:
+            by_file = {}
+            for attr in attrs:
+                filename = accessor._attr_file(attr, prefix)
+                if filename in by_file:
+                    by_file[filename][3].append(attr)
+                    continue
+                try:
+                    fd = os.open(filename, os.O_RDONLY)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        self.close()
+                        raise
+                    self.missing.add(attr)
+                    continue
+                by_file[filename] = (name, accessor, fd, [attr])
+                self.files.append(by_file[filename])
+        if self.missing:
+            logging.debug('cgroups lack attributes %s',
+                          ', '.join(sorted(self.missing)))
+
+
+    def _pread(self, fd):
+        """Read a whole attribute file, from offset 0 until end of file.
+
+        Files of more than a page come back a page or so at a time, so
+        short reads carry on at the next offset.
+        """
+        chunks = []
+        offset = 0
+        while True:
+            n = utils.libc.pread64(fd, self.buffer, PAGE_SIZE, offset)
+            if n < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            if n == 0:
+                return ''.join(chunks)
+            chunks.append(ctypes.string_at(self.buffer, n))
+            offset += n
+
+
+    def read(self):
+        """Snapshot all attributes, as {name: {attr: lines}}."""
+        snapshot = {}
+        for name, accessor, fd, attrs in self.files:
+            values = snapshot.get(name)
+            if values is None:
+                values = snapshot[name] = {}
+            lines = [line.rstrip() for line in self._pread(fd).splitlines()]
+            values.update(accessor.parse_attrs(attrs, lines))
+        return snapshot
+
+
+    def close(self):
+        for name, accessor, fd, attrs in self.files:
+            os.close(fd)
+        self.files = []
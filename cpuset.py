@@ -16,7 +16,7 @@
 # A basic cpuset/cgroup container manager for limiting memory use during tests.
 
 import glob, fcntl, logging, os, re
-import error, utils
+import cgroup, error, utils
 
 SUPER_ROOT = ''      # root of all containers or cgroups
 NO_LIMIT = (1 << 63) - 1   # containername/memory.limit_in_bytes if no limit
@@ -24,21 +24,37 @@ NO_LIMIT = (1 << 63) - 1   # containername/memory.limit_in_bytes if no limit
 super_root_path = ''    # usually '/dev/cgroup'; '/dev/cpuset' on 2.6.18
 cpuset_prefix   = None  # usually 'cpuset.'; '' on 2.6.18
 fake_numa_containers = False # container mem via numa=fake mem nodes, else pages
+unified_hierarchy = False  # cgroup2, with cpus, mems, memory and io in one
 mem_isolation_on = False
 node_mbytes = 0         # mbytes in one typical mem node
 root_container_bytes = 0  # squishy limit on effective size of root container
+cached_topology = None  # numa_topology of the mem nodes, once looked up
+cached_cpu_cores = None  # {cpu: (socket, core's cpus)}, once looked up
+
+# numa distance from a node to itself, and between fake nodes carved out of
+# the same physical node.
+LOCAL_DISTANCE = 10
 
 
 def discover_container_style():
     """Fetch information about containers and cache in global state."""
     global super_root_path, cpuset_prefix
-    global mem_isolation_on, fake_numa_containers
+    global mem_isolation_on, fake_numa_containers, unified_hierarchy
     global node_mbytes, root_container_bytes
 
     if super_root_path != '':
         return  # already looked up
 
-    if os.path.exists('/dev/cgroup/tasks') or \
+    caps = cgroup.probe()
+    if caps.version == 2:
+        # all controllers in the one cgroup2 hierarchy, memcg style:
+        super_root_path = caps.unified
+        cpuset_prefix = 'cpuset.'
+        unified_hierarchy = True
+        fake_numa_containers = False
+        mem_isolation_on = caps.has('memory')
+
+    elif os.path.exists('/dev/cgroup/tasks') or \
        os.path.exists('/dev/cgroup/cpuset/tasks'):
         # running on 2.6.26 or later kernel with containers on:
         super_root_path = '/dev/cgroup'
@@ -106,6 +122,8 @@ def blkio_attr(container_name, attr):
 
 
 def tasks_path(container_name):
+    if unified_hierarchy:
+        return os.path.join(full_path(container_name), 'cgroup.procs')
     return os.path.join(full_path(container_name), 'tasks')
 
 
@@ -121,6 +139,37 @@ def cpus_path(container_name):
     return cpuset_attr(container_name, 'cpus')
 
 
+def controllers(container_name):
+    """Get the controllers a cgroup2 container can enable for its children.
+    """
+    return utils.read_one_line(os.path.join(full_path(container_name),
+                                            'cgroup.controllers')).split()
+
+
+def enable_controllers(container_name, wanted=('cpuset', 'memory', 'io')):
+    """Let the children of a cgroup2 container use the wanted controllers
+       that it has itself.
+    """
+    subtree_control = os.path.join(full_path(container_name),
+                                   'cgroup.subtree_control')
+    enabled = utils.read_one_line(subtree_control).split()
+    available = controllers(container_name)
+    changes = ['+' + c for c in wanted
+               if c in available and c not in enabled]
+    if changes:
+        utils.write_one_line(subtree_control, ' '.join(changes))
+
+
+def tree_root(tree, root):
+    """Get the path, relative to super_root, of container root in the
+       cgroup tree.  All trees are one with cgroup2.
+    """
+    discover_container_style()
+    if unified_hierarchy:
+        return root
+    return os.path.join(tree, root)
+
+
 def container_exists(name):
     return name is not None and os.path.exists(tasks_path(name))
 
@@ -185,6 +234,8 @@ def my_container_name():
 def get_mem_nodes(container_name):
     "Return mem nodes now available to a container, both exclusive & shared"""
     file_name = mems_path(container_name)
+    if unified_hierarchy:
+        file_name += '.effective'
     if os.path.exists(file_name):
         return rangelist_to_set(utils.read_one_line(file_name))
     else:
@@ -232,6 +283,13 @@ def container_bytes(name):
     """Get the memory limit for a given container, in bytes."""
     if fake_numa_containers:
         return nodes_avail_mbytes(get_mem_nodes(name)) << 20
+    elif unified_hierarchy:
+        while name != SUPER_ROOT:
+            limit = utils.read_one_line(memory_path(name) + '.max')
+            if limit != 'max':
+                return int(limit)
+            name = os.path.dirname(name)
+        return root_container_bytes
     else:
         while True:
             file = memory_path(name) + '.limit_in_bytes'
@@ -265,9 +323,228 @@ def mbytes_per_mem_node():
     return utils.rounded_memtotal() / (nodecnt * 1024.0)
 
 
+class numa_topology(object):
+    """Which physical node each fake numa mem node was carved from, and
+       which cpus are near it.
+
+    node_cpus maps each mem node to its set of cpus, and distances maps it
+    to its numa distances to all nodes, in node order.
+    """
+
+    def __init__(self, node_cpus, distances):
+        nodes = sorted(distances)
+        # physical nodes are named by their lowest fake node
+        self.physical = {}
+        for node in nodes:
+            self.physical[node] = min(other for other, distance
+                                      in zip(nodes, distances[node])
+                                      if distance == LOCAL_DISTANCE)
+        self.cpus = {}
+        for node, cpus in node_cpus.items():
+            self.cpus.setdefault(self.physical[node], set()).update(cpus)
+
+
+    def physical_node(self, node):
+        return self.physical.get(node, node)
+
+
+    def nearness(self, physical, cpus):
+        """Get how many of cpus sit on a physical node."""
+        return len(self.cpus.get(physical, set()) & cpus)
+
+
+def get_numa_topology():
+    """Get the numa_topology of the machine, read from sysfs once."""
+    global cached_topology
+    if cached_topology is None:
+        node_cpus = {}
+        distances = {}
+        for node in utils.numa_nodes():
+            path = '/sys/devices/system/node/node%d' % node
+            node_cpus[node] = rangelist_to_set(
+                    utils.read_one_line(os.path.join(path, 'cpulist')))
+            distances[node] = [int(d) for d in utils.read_one_line(
+                    os.path.join(path, 'distance')).split()]
+        cached_topology = numa_topology(node_cpus, distances)
+    return cached_topology
+
+
+def pick_mem_nodes(free, needed_kbytes, cpus, topology):
+    """Pick free mem nodes holding needed_kbytes, near cpus.
+
+    Takes the nodes from the physical node with the most of cpus that can
+    hold them all, and of equally near ones from the fullest, to keep large
+    free stretches for later containers.  Containers that fit in no one
+    physical node spill over from the nearest and emptiest outwards.
+    Returns a sorted list of nodes, or None if free nodes are too few.
+    """
+    by_physical = {}
+    for node in free:
+        by_physical.setdefault(topology.physical_node(node), []).append(node)
+    capacity = dict((physical, sum(node_avail_kbytes(n) for n in nodes))
+                    for physical, nodes in by_physical.items())
+    fits = [physical for physical in by_physical
+            if capacity[physical] >= needed_kbytes]
+    if fits:
+        order = [max(fits, key=lambda p: (topology.nearness(p, cpus),
+                                          -capacity[p], p))]
+    else:
+        order = sorted(by_physical, key=lambda p: (
+                -topology.nearness(p, cpus), -capacity[p], -p))
+
+    picked = []
+    kbytes = 0
+    for physical in order:
+        # Highest node numbers first, as containers always got them.
+        for node in sorted(by_physical[physical], reverse=True):
+            if kbytes >= needed_kbytes:
+                break
+            picked.append(node)
+            kbytes += node_avail_kbytes(node)
+    if kbytes < needed_kbytes:
+        return None
+    return sorted(picked)
+
+
+def allocate_mem_nodes(requests):
+    """Pick the mem nodes of a tree of new fake numa containers at once.
+
+    requests lists (name, parent, mbytes, cpus) top-down, where parent is
+    an existing container or the name of an earlier request.  Each
+    container gets nodes of its parent that none of its siblings hold, on
+    the physical node of its cpus where they fit.  Returns {name: sorted
+    list of nodes}.  Callers hold my_lock('inner') until the containers
+    exist, so that parallel tests cannot pick the same nodes.
+    """
+    need_fake_numa()
+    topology = get_numa_topology()
+    free = {}
+    picked = {}
+    for name, parent, mbytes, cpus in requests:
+        if parent not in free:
+            if parent in picked:
+                free[parent] = set(picked[parent])
+            else:
+                free[parent] = available_exclusive_mem_nodes(parent)
+        needed_kbytes = mbytes * 1024
+        nodes = pick_mem_nodes(free[parent], needed_kbytes, set(cpus),
+                               topology)
+        if nodes is None:
+            if parent in picked:
+                parent_mbytes = nodes_avail_mbytes(picked[parent])
+            else:
+                parent_mbytes = container_mbytes(parent)
+            if mbytes > parent_mbytes:
+                raise error.Error(
+                      "New container's %d Mbytes exceeds "
+                      "parent container's %d Mbyte size"
+                      % (mbytes, parent_mbytes) )
+            else:
+                raise error.Error(
+                      "Existing sibling containers hold "
+                      "%d Mbytes needed by new container"
+                      % (mbytes - nodes_avail_mbytes(free[parent])) )
+        free[parent] -= set(nodes)
+        picked[name] = nodes
+    return picked
+
+
+def get_cpu_cores():
+    """Get {cpu: (socket, cpus of its core)} from sysfs, read once."""
+    global cached_cpu_cores
+    if cached_cpu_cores is None:
+        cached_cpu_cores = {}
+        for path in glob.glob('/sys/devices/system/cpu/cpu[0-9]*/topology'):
+            cpu = int(re.sub(r'.*cpu(\d+)/topology', r'\1', path))
+            socket = int(utils.read_one_line(
+                    os.path.join(path, 'physical_package_id')))
+            siblings = rangelist_to_set(utils.read_one_line(
+                    os.path.join(path, 'thread_siblings_list')))
+            cached_cpu_cores[cpu] = (socket, tuple(sorted(siblings)))
+    return cached_cpu_cores
+
+
+def partition_cpus(cpus, counts):
+    """Split cpus into one set per count, in proportion to the counts.
+
+    Hands out whole cores, at least one per count, each time to the count
+    with the fewest cores per unit so far.  Each set is then placed on the
+    socket with the fewest free cores that can hold it, or else spread
+    over the sockets with the most.  Returns a list of sets of cpus, or
+    None if cpus hold fewer cores than there are counts.
+    """
+    cores = {}
+    for cpu in cpus:
+        socket, siblings = get_cpu_cores().get(cpu, (0, (cpu,)))
+        cores.setdefault((socket, siblings), set()).add(cpu)
+    if not counts:
+        return []
+    if len(cores) < len(counts):
+        return None
+
+    counts = [max(count, 1) for count in counts]
+    shares = [1] * len(counts)
+    for core in xrange(len(cores) - len(counts)):
+        i = max(xrange(len(counts)),
+                key=lambda i: (float(counts[i]) / shares[i], -i))
+        shares[i] += 1
+
+    free = {}
+    for socket, siblings in sorted(cores):
+        free.setdefault(socket, []).append(cores[(socket, siblings)])
+    parts = [None] * len(counts)
+    for i in sorted(xrange(len(counts)), key=lambda i: (-shares[i], i)):
+        fits = [socket for socket in free if len(free[socket]) >= shares[i]]
+        if fits:
+            order = [min(fits, key=lambda socket: (len(free[socket]),
+                                                   socket))]
+        else:
+            order = sorted(free, key=lambda socket: (-len(free[socket]),
+                                                     socket))
+        parts[i] = set()
+        needed = shares[i]
+        for socket in order:
+            while needed and free[socket]:
+                parts[i] |= free[socket].pop(0)
+                needed -= 1
+    return parts
+
+
+def device_irq_cpus(device):
+    """Get the cpus that handle the interrupts of a block device.
+
+    The interrupts are those of the device, or else of the nearest
+    controller above it in sysfs that has any.  Returns an empty set if
+    none are found.
+    """
+    path = os.path.realpath(os.path.join('/sys/block', device, 'device'))
+    irqs = set()
+    while path.startswith('/sys/devices/') and not irqs:
+        msi_irqs = os.path.join(path, 'msi_irqs')
+        if os.path.isdir(msi_irqs):
+            irqs.update(int(irq) for irq in os.listdir(msi_irqs))
+        irq_file = os.path.join(path, 'irq')
+        if os.path.exists(irq_file) and int(utils.read_one_line(irq_file)):
+            irqs.add(int(utils.read_one_line(irq_file)))
+        path = os.path.dirname(path)
+
+    cpus = set()
+    for irq in irqs:
+        for name in ('effective_affinity_list', 'smp_affinity_list'):
+            affinity = '/proc/irq/%d/%s' % (irq, name)
+            if os.path.exists(affinity):
+                cpus |= rangelist_to_set(utils.read_one_line(affinity))
+                break
+    return cpus
+
+
 def get_cpus(container_name):
     """Get the set of cpus in a container."""
     file_name = cpus_path(container_name)
+    if unified_hierarchy:
+        file_name += '.effective'
+        if not os.path.exists(file_name):  # no cpuset controller
+            file_name = '/sys/devices/system/cpu/online'
     if os.path.exists(file_name):
         return rangelist_to_set(utils.read_one_line(file_name))
     else:
@@ -305,7 +582,8 @@ def set_blkio_controls(container_name, device,
     # Setup path to blkio cgroup.
     weight_device = blkio_attr(container_name, 'io_service_level')
     logging.info('weight device: ' + weight_device)
-    if not os.path.exists(weight_device):
+    knobs = cgroup.probe().io_knobs(full_path(container_name))
+    if 'io.io_service_level' not in knobs:
         raise error.Error("Kernel predates blkio features or blkio "
                           "cgroup is mounted separately from cpusets")
 
@@ -317,7 +595,7 @@ def set_blkio_controls(container_name, device,
                   container_name, disk_info)
 
     shared_sync_queues_device = blkio_attr(container_name, 'shared_sync_queues')
-    if not os.path.exists(shared_sync_queues_device):
+    if 'io.shared_sync_queues' not in knobs:
         # This is not fatal, just ignore the value of the flag
         logging.warn("Kernel predates shared sync queues")
         return
@@ -330,9 +608,55 @@ def set_blkio_controls(container_name, device,
                   container_name, shared_sync_queues_str)
 
 
+def set_io_weight(container_name, device,
+                  weight, priority, shared_sync_queues):
+    """Define the io parameters of a cgroup2 container.
+
+    Sets io.bfq.weight when device is scheduled by bfq, else the io.weight
+    of iocost, which both take the v1 weights as they are.  Takes the same
+    args as set_blkio_controls, with high priority mapped to io.prio.class.
+    cgroup2 has no shared sync queues.
+    """
+    number = utils.get_device_id(device)
+    scheduler = utils.read_one_line('/sys/block/%s/queue/scheduler' % device)
+    bfq_weight = os.path.join(full_path(container_name), 'io.bfq.weight')
+    io_weight = os.path.join(full_path(container_name), 'io.weight')
+    knobs = cgroup.probe().io_knobs(full_path(container_name))
+    if '[bfq]' in scheduler and 'io.bfq.weight' in knobs:
+        try:
+            utils.write_one_line(bfq_weight, '%s %d' % (number, weight))
+        except IOError:
+            # kernels before 5.4 only take one weight for all devices
+            utils.write_one_line(bfq_weight, '%d' % weight)
+        weight_file = bfq_weight
+    elif 'io.weight' in knobs:
+        utils.write_one_line(io_weight, '%s %d' % (number, weight))
+        weight_file = io_weight
+    else:
+        raise error.Error('Kernel has neither bfq nor iocost io weights')
+    logging.debug('set %s of %s to %d', os.path.basename(weight_file),
+                  container_name, weight)
+
+    # Priority 1 marks high priority containers; the others are left be,
+    # undoing an earlier high priority of a reused container.
+    prio_class = {1: 'promote-to-rt'}.get(priority, 'no-change')
+    prio_file = os.path.join(full_path(container_name), 'io.prio.class')
+    if 'io.prio.class' not in knobs:
+        if priority == 1:
+            # This is not fatal, just ignore the priority
+            logging.warn('Kernel predates io.prio.class')
+    else:
+        utils.write_one_line(prio_file, prio_class)
+        logging.debug('set io.prio.class of %s to %s',
+                      container_name, prio_class)
+
+    if shared_sync_queues:
+        logging.warn('cgroup2 has no shared sync queues')
+
+
 def create_container_with_specific_mems_cpus(name, mems, cpus):
     need_fake_numa()
-    os.mkdir(full_path(name))
+    cgroup.fs.mkdir(full_path(name))
     utils.write_one_line(cpuset_attr(name, 'mem_hardwall'), '1')
     utils.write_one_line(mems_path(name), ','.join(map(str, mems)))
     utils.write_one_line(cpus_path(name), ','.join(map(str, cpus)))
@@ -343,7 +667,7 @@ def create_container_with_specific_mems_cpus(name, mems, cpus):
 
 def create_container_via_memcg(name, parent, bytes, cpus):
     # create container via direct memcg cgroup writes
-    os.mkdir(full_path(name))
+    cgroup.fs.mkdir(full_path(name))
     nodes = utils.read_one_line(mems_path(parent))
     utils.write_one_line(mems_path(name), nodes)  # inherit parent's nodes
     utils.write_one_line(memory_path(name)+'.limit_in_bytes', str(bytes))
@@ -353,47 +677,45 @@ def create_container_via_memcg(name, parent, bytes, cpus):
                   name, len(cpus), utils.human_format(container_bytes(name)))
 
 
-def _create_fake_numa_container_directly(name, parent, mbytes, cpus):
+def create_container_unified(name, parent, bytes, cpus):
+    # create container in the cgroup2 hierarchy, inheriting parent's mems
+    enable_controllers(parent)
+    cgroup.fs.mkdir(full_path(name))
+    utils.write_one_line(memory_path(name)+'.max', str(bytes))
+    if os.path.exists(cpus_path(name)):
+        utils.write_one_line(cpus_path(name), ','.join(map(str, cpus)))
+    logging.debug('Created cgroup2 container %s,'
+                  ' has %d cpus and %s bytes',
+                  name, len(cpus), utils.human_format(container_bytes(name)))
+
+
+def _create_fake_numa_container_directly(name, parent, mbytes, cpus,
+                                        mems=None):
     need_fake_numa()
+    if mems is not None:  # picked already, under the lock
+        create_container_with_specific_mems_cpus(name, mems, cpus)
+        return
     lockfile = my_lock('inner')   # serialize race between parallel tests
     try:
-        # Pick specific mem nodes for new cpuset's exclusive use
-        # For now, arbitrarily pick highest available node numbers
-        needed_kbytes = mbytes * 1024
-        nodes = sorted(list(available_exclusive_mem_nodes(parent)))
-        kbytes = 0
-        nodecnt = 0
-        while kbytes < needed_kbytes and nodecnt < len(nodes):
-            nodecnt += 1
-            kbytes += node_avail_kbytes(nodes[-nodecnt])
-        if kbytes < needed_kbytes:
-            parent_mbytes = container_mbytes(parent)
-            if mbytes > parent_mbytes:
-                raise error.Error(
-                      "New container's %d Mbytes exceeds "
-                      "parent container's %d Mbyte size"
-                      % (mbytes, parent_mbytes) )
-            else:
-                raise error.Error(
-                      "Existing sibling containers hold "
-                      "%d Mbytes needed by new container"
-                      % ((needed_kbytes - kbytes)//1024) )
-        mems = nodes[-nodecnt:]
-
+        mems = allocate_mem_nodes([(name, parent, mbytes, cpus)])[name]
         create_container_with_specific_mems_cpus(name, mems, cpus)
     finally:
         my_unlock(lockfile)
 
 
-def create_container_directly(name, mbytes, cpus):
+def create_container_directly(name, mbytes, cpus, mems=None):
     parent = os.path.dirname(name)
     if fake_numa_containers:
-        _create_fake_numa_container_directly(name, parent, mbytes, cpus)
+        _create_fake_numa_container_directly(name, parent, mbytes, cpus,
+                                             mems)
+    elif unified_hierarchy:
+        create_container_unified(name, parent, mbytes<<20, cpus)
     else:
         create_container_via_memcg(name, parent, mbytes<<20, cpus)
 
 
-def create_container_cpuset(name, tree, mbytes, cpus=None, root=SUPER_ROOT):
+def create_container_cpuset(name, tree, mbytes, cpus=None, root=SUPER_ROOT,
+                            mems=None):
     """Create a cpuset container and move job's current pid into it.
     Allocate the list "cpus" of cpus to that container
 
@@ -405,11 +727,13 @@ def create_container_cpuset(name, tree, mbytes, cpus=None, root=SUPER_ROOT):
             defaults to all cpus avail with given root
         root = the parent cpuset to nest this new set within
             '': unnested top-level container
+        mems = fake numa mem nodes for the container, picked already by
+            allocate_mem_nodes; by default picked now
     Return:
         name: the name of the container.
     """
     need_mem_containers()
-    croot = os.path.join(tree, root)
+    croot = tree_root(tree, root)
     if not container_exists(croot):
         raise error.Error('Parent container "%s" does not exist' % root)
     if cpus is None:
@@ -425,7 +749,7 @@ def create_container_cpuset(name, tree, mbytes, cpus=None, root=SUPER_ROOT):
         raise error.Error('Container %s already exists. '
                           'Try running test with -c which deletes '
                           'test state.' % name)
-    create_container_directly(cname, mbytes, cpus)
+    create_container_directly(cname, mbytes, cpus, mems)
     return os.path.join(root, name)
 
 
@@ -460,15 +784,23 @@ def create_container_blkio(device, name, tree,
     if shared_sync_queues is None:
         raise ValueError('shared_sync_queues not defined.')
 
-    croot = os.path.join(tree, root)
+    croot = tree_root(tree, root)
 
     cname = os.path.join(croot, name)  # path relative to super_root
+    if unified_hierarchy:
+        # Usually made already, as the same container's cpuset.
+        if not os.path.exists(full_path(cname)):
+            enable_controllers(croot)
+            cgroup.fs.mkdir(full_path(cname))
+        set_io_weight(cname, device, weight, priority, shared_sync_queues)
+        return os.path.join(root, name)
+
     if os.path.exists(full_path(cname)):
         raise error.Error('Container %s already exists. '
                           'Try running test with -c which deletes '
                           'test state.' % cname)
 
-    os.mkdir(full_path(cname))
+    cgroup.fs.mkdir(full_path(cname))
 
     # Initialize blkio container.
     set_blkio_controls(cname, device,
@@ -0,0 +1,111 @@
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# A pool of worker input files that can outlive a single test run.
+# A manifest in the pool directory records, for every file, its size, what
+# kind of content it holds, and the filesystem identity it was written with.
+# Files are named after their content, so files holding different content
+# never get mixed up.  Checking a file before reuse costs one stat.
+
+
+import json, logging, os
+import error
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class input_file_pool(object):
+    """A directory of input files, described by an on-disk manifest.
+
+    Only save writes to the directory, which must exist by then.
+    """
+
+    def __init__(self, pool_dir, device):
+        self.pool_dir = pool_dir
+        self.device = device
+        self.manifest_path = os.path.join(pool_dir, MANIFEST_NAME)
+        self.files = self._load()
+
+
+    def _load(self):
+        """Read the manifest, or start an empty one."""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            return json.load(open(self.manifest_path))
+        except ValueError:
+            logging.warn('Ignoring corrupt input file manifest %s',
+                         self.manifest_path)
+            return {}
+
+
+    def save(self):
+        """Write the manifest, replacing the old one atomically."""
+        tmp_path = self.manifest_path + '.tmp'
+        manifest = open(tmp_path, 'w')
+        try:
+            json.dump(self.files, manifest, indent=1, sort_keys=True)
+        finally:
+            manifest.close()
+        os.rename(tmp_path, self.manifest_path)
+
+
+    def file_name(self, content, prefix, n):
+        """Get the path of the n'th pool file with the given content."""
+        return os.path.join(self.pool_dir, '%s-%s%d' % (content, prefix, n))
+
+
+    def valid_mbytes(self, name, content):
+        """Get the size of the leading part of a file that can be reused.
+
+        The file must hold the expected content and still be the same
+        file on the same device that the manifest recorded, with all of
+        its blocks allocated.  Anything else means it gets rebuilt.
+        """
+        record = self.files.get(os.path.basename(name))
+        if not record or record['content'] != content:
+            return 0
+        try:
+            st = os.stat(name)
+        except OSError:
+            return 0
+        size = record['mbytes'] << 20
+        if (record['device'] != self.device or
+            record['st_dev'] != st.st_dev or
+            record['st_ino'] != st.st_ino or
+            record['mtime'] != st.st_mtime):
+            logging.info('Input file %s changed since it was made', name)
+            return 0
+        if st.st_size < size or st.st_blocks * 512 < size:
+            # Truncated, or holes punched in it.
+            logging.info('Input file %s is missing data', name)
+            return 0
+        return record['mbytes']
+
+
+    def record(self, name, mbytes, content):
+        """Note that name now holds mbytes of content."""
+        if not os.path.exists(name):
+            raise error.Error('Input file %s was not created' % name)
+        st = os.stat(name)
+        self.files[os.path.basename(name)] = {
+            'mbytes': mbytes,
+            'content': content,
+            'device': self.device,
+            'st_dev': st.st_dev,
+            'st_ino': st.st_ino,
+            'mtime': st.st_mtime,
+        }
+        self.save()
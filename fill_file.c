@@ -0,0 +1,199 @@
+/*
+ * fill_file: Fills part of a file with seeded pseudo-random data.
+ *
+ * Copyright 2011 Google Inc.
+ *
+ *   Licensed under the Apache License, Version 2.0 (the "License");
+ *   you may not use this file except in compliance with the License.
+ *   You may obtain a copy of the License at
+ *
+ *       http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *   Unless required by applicable law or agreed to in writing, software
+ *   distributed under the License is distributed on an "AS IS" BASIS,
+ *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ *   See the License for the specific language governing permissions and
+ *   limitations under the License.
+ */
+
+#define _GNU_SOURCE
+
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <sys/time.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <errno.h>
+#include <string.h>
+
+#define MBYTE (1 << 20)
+
+const char *program;
+
+void usage()
+{
+	fprintf(stderr,
+		"Usage: %s [ -s SEED ] [ -b BLOCK_MB ] <filename> "
+		"<start_mb> <end_mb>\n",
+		program);
+}
+
+/*
+ * Fills one megabyte of buf with data that depends only on the seed and
+ * the megabyte's index in the file.  Growing a file later therefore gives
+ * the same contents as writing it in one go.
+ */
+static void fill_mbyte(uint64_t *buf, uint64_t seed, uint64_t index)
+{
+	uint64_t x;
+	size_t i;
+
+	x = seed ^ ((index + 1) * 0x9e3779b97f4a7c15ULL);
+	if (x == 0)
+		x = 1;
+	for (i = 0; i < MBYTE / sizeof(*buf); i++) {
+		/* xorshift64* */
+		x ^= x >> 12;
+		x ^= x << 25;
+		x ^= x >> 27;
+		buf[i] = x * 0x2545f4914f6cdd1dULL;
+	}
+}
+
+/*
+ * Writes megabytes [start_mb, end_mb) of FILENAME, block_mb at a time.
+ *
+ * The range is preallocated first, so the file gets laid out in few extents,
+ * and written with O_DIRECT, so it does not fill the page cache.  Falls back
+ * to buffered writes on filesystems without O_DIRECT support.
+ */
+static int fill_file(char *filename, uint64_t seed, off_t start_mb,
+		     off_t end_mb, int block_mb)
+{
+	char *buffer;
+	int fd, direct, ret;
+	off_t mb, n, i;
+	ssize_t written;
+	struct timeval start_time, finish_time;
+	double seconds;
+
+	if (posix_memalign((void **)&buffer, 4096, (size_t)block_mb * MBYTE)) {
+		fprintf(stderr, "Malloc failed\n");
+		return -1;
+	}
+
+	direct = 1;
+	fd = open(filename, O_WRONLY | O_CREAT | O_DIRECT, 0644);
+	if (fd < 0 && errno == EINVAL) {
+		direct = 0;
+		fd = open(filename, O_WRONLY | O_CREAT, 0644);
+	}
+	if (fd < 0) {
+		fprintf(stderr, "Failed to open file %s: %s\n", filename,
+			strerror(errno));
+		ret = -1;
+		goto out_free;
+	}
+
+	ret = fallocate(fd, 0, start_mb * MBYTE, (end_mb - start_mb) * MBYTE);
+	if (ret < 0 && errno != EOPNOTSUPP) {
+		fprintf(stderr, "fallocate failed: %s\n", strerror(errno));
+		goto out_close;
+	}
+	ret = -1;
+
+	gettimeofday(&start_time, NULL);
+	for (mb = start_mb; mb < end_mb; mb += n) {
+		n = end_mb - mb;
+		if (n > block_mb)
+			n = block_mb;
+		for (i = 0; i < n; i++)
+			fill_mbyte((uint64_t *)(buffer + i * MBYTE), seed,
+				   mb + i);
+
+		written = pwrite(fd, buffer, n * MBYTE, mb * MBYTE);
+		if (written < 0 && errno == EINVAL && direct) {
+			/* O_DIRECT accepted by open but not by the fs. */
+			close(fd);
+			direct = 0;
+			fd = open(filename, O_WRONLY);
+			if (fd < 0) {
+				fprintf(stderr, "Failed to reopen file %s: "
+					"%s\n", filename, strerror(errno));
+				goto out_free;
+			}
+			written = pwrite(fd, buffer, n * MBYTE, mb * MBYTE);
+		}
+		if (written != n * MBYTE) {
+			fprintf(stderr, "write failed: %s\n",
+				written < 0 ? strerror(errno) : "short write");
+			goto out_close;
+		}
+	}
+	if (!direct && fdatasync(fd) < 0) {
+		fprintf(stderr, "fdatasync failed: %s\n", strerror(errno));
+		goto out_close;
+	}
+	gettimeofday(&finish_time, NULL);
+
+	seconds = (finish_time.tv_sec - start_time.tv_sec) +
+		  1e-6 * (finish_time.tv_usec - start_time.tv_usec);
+	printf("wrote %ld MB in %.2f s%s\n", (long)(end_mb - start_mb),
+	       seconds, direct ? "" : " (buffered)");
+	ret = 0;
+
+out_close:
+	close(fd);
+out_free:
+	free(buffer);
+	return ret;
+}
+
+int main(int argc, char **argv)
+{
+	uint64_t seed;
+	int block_mb;
+	off_t start_mb, end_mb;
+	int opt;
+
+	program = argv[0];
+
+	seed = 42;
+	block_mb = 4;
+
+	while ((opt = getopt(argc, argv, "b:s:")) != -1) {
+		switch (opt) {
+		case 'b':
+			block_mb = atoi(optarg);
+			if (block_mb <= 0) {
+				usage();
+				exit(1);
+			}
+			break;
+		case 's':
+			seed = strtoull(optarg, NULL, 0);
+			break;
+		default:
+			usage();
+			exit(1);
+		}
+	}
+
+	if (argc != optind + 3) {
+		usage();
+		exit(1);
+	}
+
+	start_mb = atoll(argv[optind + 1]);
+	end_mb = atoll(argv[optind + 2]);
+	if (start_mb < 0 || end_mb < start_mb) {
+		usage();
+		exit(1);
+	}
+
+	return fill_file(argv[optind], seed, start_mb, end_mb, block_mb) ?
+		1 : 0;
+}
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#   implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+# Microbenchmarks of the harness's own control plane: parsing experiments,
+# creating containers, moving tasks, launching workers and releasing
+# containers, for experiment trees that grow wide or deep.  Runs against
+# the simulator's fake cgroup tree in a temp directory, or with -R against
+# the system's cgroups.  Prints one JSON record per operation and tree.
+#
+# Usage:
+#   harness_bench.py [-R] [-d device] [-j jobs] [-n repeats] [-o file]
+#                    [-s size,...] [-t shape,...]
+
+
+import getopt, json, logging, os, sys, tempfile, time
+import blkcgroup_test_lib, cgroup, simulator, utils
+
+# Tree sizes, in containers, and shapes benchmarked by default.
+SIZES = (2, 10, 100, 1000)
+SHAPES = ('wide', 'deep')
+# Deeper trees would exceed PATH_MAX in the cgroup paths, and Python's
+# recursion limit in the parser.
+MAX_DEPTH = 200
+# Prefix of the benchmark's containers, kept apart from the tests' own.
+BENCH_PREFIX = blkcgroup_test_lib.TEST_CGROUP_PREFIX + 'bench'
+# The command every benchmarked worker runs.
+WORKER_CMD = '/bin/true'
+
+
+def experiment_text(shape, size):
+    """Get an experiment of size containers, all siblings or all nested,
+       with one rdseq worker in each leaf.
+    """
+    if shape == 'wide':
+        return ', '.join(['500 rdseq'] * size)
+    return '500 (' * (size - 1) + '500 rdseq' + ')' * (size - 1)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def record(op, shape, size, seconds, count, latencies=None):
+    """Summarize repeated timings of an operation on count items.
+
+    seconds lists the time each repeat took.  latencies optionally lists
+    the seconds of each single item, over all repeats.
+    """
+    median = percentile(seconds, 0.5)
+    result = {
+        'op': op,
+        'shape': shape,
+        'containers': size,
+        'items': count,
+        'repeats': len(seconds),
+        'best_seconds': min(seconds),
+        'median_seconds': median,
+        'per_item_us': median / count * 1e6,
+        'items_per_second': count / median if median else None,
+    }
+    if latencies:
+        result['p50_us'] = percentile(latencies, 0.5) * 1e6
+        result['p99_us'] = percentile(latencies, 0.99) * 1e6
+    return result
+
+
+class bench(object):
+    """Times control plane operations of a test_harness on device."""
+
+    def __init__(self, device, workdir, repeats, concurrency=1):
+        self.device = device
+        self.workdir = workdir
+        self.repeats = repeats
+        self.concurrency = concurrency
+        self.harness = blkcgroup_test_lib.test_harness('Harness benchmark')
+        self.harness.workdir = workdir
+        self.harness.direct_launch = True
+        self.harness.sampler = None
+
+
+    def parse(self, text):
+        seconds = []
+        for r in xrange(self.repeats):
+            start = time.time()
+            blkcgroup_test_lib.parse_experiment(text)
+            seconds.append(time.time() - start)
+        return seconds
+
+
+    def setup(self, text):
+        """Create an experiment's containers, returning the tree and the
+           seconds it took.
+        """
+        tree = blkcgroup_test_lib.parse_experiment(text)
+        cpu_parent = cgroup.root_cgroup('cpuset')
+        io_parent = cgroup.root_cgroup(blkcgroup_test_lib.BLKIO_CGROUP_NAME)
+        start = time.time()
+        blkcgroup_test_lib.setup_containers(tree, self.device,
+                                            cpu_parent.name, cpu_parent,
+                                            io_parent, BENCH_PREFIX,
+                                            self.concurrency)
+        return tree, time.time() - start
+
+
+    def put_tasks(self, tree):
+        """Move this process through every container of tree and back,
+           returning the seconds for all moves and for each one.
+        """
+        me = [str(os.getpid())]
+        home = cgroup.root_cgroup('cpuset')
+        home_io = cgroup.root_cgroup(blkcgroup_test_lib.BLKIO_CGROUP_NAME)
+        latencies = []
+        start = time.time()
+        for container in blkcgroup_test_lib.all_containers(tree):
+            for accessor in (container['cpu_cgroup'],
+                             container['blkio_cgroup']):
+                before = time.time()
+                accessor.put_tasks(me)
+                latencies.append(time.time() - before)
+        seconds = time.time() - start
+        home.put_tasks(me)
+        home_io.put_tasks(me)
+        return seconds, latencies
+
+
+    def launch(self, tree):
+        """Launch and reap one trivial worker per leaf container."""
+        runners = [[WORKER_CMD, c['cpu_cgroup'], c['blkio_cgroup']]
+                   for c in blkcgroup_test_lib.all_containers(tree)
+                   if 'worker' in c]
+        start = time.time()
+        self.harness.run_worker_processes_in_parallel(runners)
+        seconds = time.time() - start
+        for n in xrange(len(runners)):
+            blkcgroup_test_lib.remove_file(self.harness.worker_output_file(n))
+        return seconds, len(runners)
+
+
+    def release(self, tree):
+        start = time.time()
+        blkcgroup_test_lib.release_containers(tree, self.concurrency)
+        return time.time() - start
+
+
+    def run(self, shape, size):
+        """Benchmark every operation on one tree, returning their records.
+        """
+        text = experiment_text(shape, size)
+        results = [record('parse', shape, size, self.parse(text), size)]
+        setup, moves, launch, release = [], [], [], []
+        latencies = []
+        workers = 0
+        for r in xrange(self.repeats):
+            tree, seconds = self.setup(text)
+            try:
+                setup.append(seconds)
+                seconds, times = self.put_tasks(tree)
+                moves.append(seconds)
+                latencies.extend(times)
+                seconds, workers = self.launch(tree)
+                launch.append(seconds)
+            finally:
+                release.append(self.release(tree))
+        results.append(record('setup_containers', shape, size, setup, size))
+        results.append(record('put_tasks', shape, size, moves, 2 * size,
+                              latencies))
+        results.append(record('launch_workers', shape, size, launch,
+                              workers))
+        results.append(record('release_containers', shape, size, release,
+                              size))
+        return results
+
+
+def usage(argv):
+    """Prints usage information to stderr."""
+    sys.stderr.write('%s [-R] [-d device] [-j jobs] [-n repeats] [-o file] '
+                     '[-s size,...] [-t shape,...]\n'
+                     '-R: Benchmarks against the system\'s cgroups, instead '
+                     'of a fake cgroup tree\n'
+                     '-d device: Disk to set io weights for, with -R\n'
+                     '-j jobs: Creates and releases this many containers '
+                     'of a level at once (default 1)\n'
+                     '-n repeats: Times each operation this often (default '
+                     '3)\n'
+                     '-o file: Writes the JSON results to file, not stdout\n'
+                     '-s size,...: Tree sizes in containers (default %s)\n'
+                     '-t shape,...: Tree shapes, wide and/or deep (default '
+                     'both)\n' % (argv[0], ','.join(map(str, SIZES))))
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'Rd:hj:n:o:s:t:', ['help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(argv)
+        return 2
+
+    real = False
+    device = None
+    repeats = 3
+    concurrency = 1
+    output = None
+    sizes = SIZES
+    shapes = SHAPES
+    for o, a in opts:
+        if o == '-R':
+            real = True
+        elif o == '-d':
+            device = a
+        elif o == '-j':
+            concurrency = int(a)
+        elif o == '-n':
+            repeats = int(a)
+        elif o == '-o':
+            output = a
+        elif o == '-s':
+            sizes = [int(s) for s in a.split(',')]
+        elif o == '-t':
+            shapes = a.split(',')
+        elif o in ('-h', '--help'):
+            usage(argv)
+            return 0
+    if args or repeats < 1 or set(shapes) - set(SHAPES) or (real and
+                                                           not device):
+        usage(argv)
+        return 2
+
+    # Per-container log lines would swamp the timings.
+    blkcgroup_test_lib.setup_logging()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tmpdir = tempfile.mkdtemp(prefix='harness_bench')
+    fs = None
+    try:
+        if real:
+            blkcgroup_test_lib.delete_test_containers(BENCH_PREFIX)
+        else:
+            device = simulator.SIM_DEVICE
+            os.mkdir(os.path.join(tmpdir, 'cgroup'))
+            fs = simulator.fake_cgroupfs(os.path.join(tmpdir, 'cgroup'),
+                                         cpus=8, memory_bytes=1 << 40)
+            fs.install()
+        runner = bench(device, tmpdir, repeats, concurrency)
+        results = []
+        for shape in shapes:
+            for size in sizes:
+                if shape == 'deep' and size > MAX_DEPTH:
+                    continue
+                results.extend(runner.run(shape, size))
+    finally:
+        if fs:
+            fs.uninstall()
+        utils.remove_tree(tmpdir)
+
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if output:
+        out = open(output, 'w')
+        try:
+            out.write(text + '\n')
+        finally:
+            out.close()
+    else:
+        print text
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
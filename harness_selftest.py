@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#   implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+# Checks of the harness's own logic, runnable without root, disks or
+# cgroups.  Parts that touch cgroups run against the simulator's fake
+# cgroup tree.
+#
+# Usage:
+#   harness_selftest.py [unittest options]
+
+
+import os, tempfile, unittest
+import blkcgroup_test_lib, cgroup, results_db, simulator, stats_sampler
+import utils
+
+
+def service_time(values):
+    return values['time']
+
+
+class convergence_monitor_test(unittest.TestCase):
+
+    def monitor(self, stops):
+        return stats_sampler.convergence_monitor(
+                [[('a', 500), ('b', 500)], [('c', 500), ('d', 500)]],
+                service_time, tolerance=50, duration=10, max_seconds=None,
+                stop=lambda: stops.append(True))
+
+
+    def feed(self, monitor, stops, counters, seconds):
+        """Feed monitor one sample a second of counters(t), until it stops.
+           Returns the time it stopped at, or None.
+        """
+        samples = []
+        for t in xrange(seconds):
+            samples.append((float(t), dict((name, {'time': value})
+                                           for name, value
+                                           in counters(t).items())))
+            monitor.check(samples)
+            if stops:
+                return monitor.stopped_at
+        return None
+
+
+    def test_late_shares_need_a_whole_window(self):
+        # c and d get no service until t=20, then equal service at once,
+        # so their shares are steady from the moment they exist.
+        def counters(t):
+            late = max(0, t - 19) * 10
+            return {'a': t * 10, 'b': t * 10, 'c': late, 'd': late}
+        stops = []
+        monitor = self.monitor(stops)
+        self.assertEqual(self.feed(monitor, stops, counters, 60), 30.0)
+        self.assertTrue(monitor.converged)
+
+
+    def test_steady_shares_converge_after_duration(self):
+        def counters(t):
+            return {'a': t * 10, 'b': t * 10, 'c': t * 5, 'd': t * 5}
+        stops = []
+        monitor = self.monitor(stops)
+        self.assertEqual(self.feed(monitor, stops, counters, 60), 11.0)
+
+
+class results_db_test(unittest.TestCase):
+
+    def record(self, db, verdict, trial_verdicts):
+        run_id = db.start_run('test', 'sim0', {})
+        for trial, passed in enumerate(trial_verdicts):
+            db.record_trial(run_id, 0, '500 rdrand, 500 rdrand', trial,
+                            passed, 30, 35, 100.0, 10.0, [])
+        db.record_experiment(run_id, 0, '500 rdrand, 500 rdrand', verdict,
+                             30, 35, len(trial_verdicts))
+        return run_id
+
+
+    def test_compare_uses_experiment_verdict(self):
+        db = results_db.results_db(':memory:')
+        baseline = self.record(db, True, [True, False, True])
+        same = self.record(db, True, [False, True, True])
+        failed = self.record(db, False, [True, True, True])
+        self.assertEqual(db.compare(baseline, same), ([], []))
+        self.assertEqual(db.compare(baseline, failed)[1],
+                         [(0, '500 rdrand, 500 rdrand',
+                           'FAILED, used to pass')])
+
+
+class plan_cgroup_ops_test(unittest.TestCase):
+
+    EXPERIMENT = '600 (500 rdrand, 500 rdrand), 400 rdrand'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='blkcgroup_selftest')
+        self.fs = simulator.fake_cgroupfs(self.tmpdir, 8, 4 << 30)
+        self.fs.install()
+
+
+    def tearDown(self):
+        self.fs.uninstall()
+        utils.remove_tree(self.tmpdir)
+
+
+    def check_plan_matches_setup(self, exper):
+        ops = blkcgroup_test_lib.plan_cgroup_ops(exper, simulator.SIM_DEVICE)
+        blkcgroup_test_lib.setup_containers(
+                exper, simulator.SIM_DEVICE, '',
+                cgroup.root_cgroup('cpuset'),
+                cgroup.root_cgroup(blkcgroup_test_lib.BLKIO_CGROUP_NAME))
+        for op in ops:
+            if op.startswith('mkdir '):
+                self.assertTrue(os.path.isdir(op[len('mkdir '):]), op)
+                continue
+            path, value = op.split(' = ', 1)
+            self.assertTrue(path.startswith(self.tmpdir), op)
+            self.assertTrue(os.path.exists(path), op)
+            if not value.startswith('<'):
+                self.assertEqual(utils.read_one_line(path), value)
+        return ops
+
+
+    def test_shared_cpus(self):
+        exper = blkcgroup_test_lib.parse_experiment(self.EXPERIMENT)
+        self.check_plan_matches_setup(exper)
+
+
+    def test_partitioned_cpus(self):
+        exper = blkcgroup_test_lib.parse_experiment(self.EXPERIMENT)
+        blkcgroup_test_lib.assign_cpus(exper, set(range(8)))
+        ops = self.check_plan_matches_setup(exper)
+        self.assertFalse([op for op in ops if '<cpus of' in op])
+
+
+if __name__ == '__main__':
+    unittest.main()
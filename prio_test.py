@@ -27,45 +27,34 @@
 
 import logging
 import os
-import blkcgroup_test_lib
+import blkcgroup_test_lib, blkio_stats
+
+def device_stat(container, attr, device):
+    stat = blkio_stats.parse_stat(container['blkio_cgroup'].get_attr(attr))
+    return stat.get(device, {})
+
 
 def dump_wait_histo(container, worker, device):
-    for line in container['blkio_cgroup'].get_attr('io_wait_time_histo'):
-        parts = line.split()
-        # Line format is
-        # device direction <10ms 10-20 20-50 50-100 100-200 200-500...
-        if parts[0] == device:
-            int_parts = map(int, parts[2:])
-            total = reduce(lambda x, y: x+y, int_parts)
-            if total == 0:
-                continue
-            over_50 = total - int_parts[0] - int_parts[1] - int_parts[2]
-            over_100 = over_50 - int_parts[3]
-
-            mode = parts[1]
-            logging.info('container %s %s %s wait: %f%% > 50ms, %f%% > 100ms' %
-                         (container['name'], worker, mode,
-                          over_50 * 100.0 / total, over_100 * 100.0 / total))
+    # Histogram buckets are <10ms 10-20 20-50 50-100 100-200 200-500...
+    histos = device_stat(container, 'io_wait_time_histo', device)
+    for mode, buckets in sorted(histos.items()):
+        total = sum(buckets)
+        if total == 0:
+            continue
+        over_50 = total - buckets[0] - buckets[1] - buckets[2]
+        over_100 = over_50 - buckets[3]
+
+        logging.info('container %s %s %s wait: %f%% > 50ms, %f%% > 100ms' %
+                     (container['name'], worker, mode,
+                      over_50 * 100.0 / total, over_100 * 100.0 / total))
 
 
 def get_preempt_count_stats(container, worker, device):
-    d = {}
-    for line in container['blkio_cgroup'].get_attr('preempt_count_self'):
-        parts = line.split()
-        if parts[0] == device:
-            k = parts[1]
-            d[k] = parts[2]
-    return d
+    return device_stat(container, 'preempt_count_self', device)
 
 
 def get_preempt_throttle_stats(container, worker, device):
-    d = {}
-    for line in container['blkio_cgroup'].get_attr('preempt_throttle_self'):
-        parts = line.split()
-        if parts[0] == device:
-            k = parts[1]
-            d[k] = parts[2]
-    return d
+    return device_stat(container, 'preempt_throttle_self', device)
 
 
 def dump_exp_stats(tree, device):
@@ -90,20 +79,20 @@ def dump_exp_stats(tree, device):
 EXPERIMENTS = [
     # Preemption-only test cases. We don't care about isolation here, we just
     # want to make sure we can preempt without being throttled.
-    ('450p rdrand.delay400, 50 rdrand.delay2', 1000),
-    ('450p rdrand.delay400, 50 rdrand.delay2*4', 1000),
+    ('900p rdrand.delay400, 100 rdrand.delay2', 1000),
+    ('900p rdrand.delay400, 100 rdrand.delay2*4', 1000),
 
     # Proportion testing to ensure that groups that have priority don't get more
     # time than they should.
-    ('50p rdrand.delay2, 50 rdrand.delay2*4', 35),
-    ('50p rdrand.delay2*4, 50 rdrand.delay2*4', 35),
-    ('50p rdrand, 50 rdrand.delay2*4', 35),
-    ('50p rdrand*8, 50 rdrand.delay2*4', 35),
+    ('500p rdrand.delay2, 500 rdrand.delay2*4', 35),
+    ('500p rdrand.delay2*4, 500 rdrand.delay2*4', 35),
+    ('500p rdrand, 500 rdrand.delay2*4', 35),
+    ('500p rdrand*8, 500 rdrand.delay2*4', 35),
 
     # Use a delay longer than the idle time (8ms) to ensure that if we're
     # idling, we still end up off the service tree.
-    ('50p rdrand.delay9, 50 rdrand.delay2*4', 35),
-    ('50p rdrand.delay9, 50 rdrand.delay9', 35),
+    ('500p rdrand.delay9, 500 rdrand.delay2*4', 35),
+    ('500p rdrand.delay9, 500 rdrand.delay9', 35),
 
 ]
 
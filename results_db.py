@@ -0,0 +1,316 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#   implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+# A local SQLite store of test results.  Every run records the environment
+# it ran in, every experiment the harness's verdict over all its trials, and
+# every trial its achieved shares, throughput and duration, so that later
+# runs can be compared against a baseline run.
+#
+# Usage:
+#   results_db.py dbfile runs
+#   results_db.py [-e err] [-t pct] dbfile compare baseline_run [run]
+
+
+import getopt, glob, json, os, sqlite3, sys, time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    started REAL,
+    device TEXT,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    run_id INTEGER REFERENCES runs(id),
+    exper_num INTEGER,
+    experiment TEXT,
+    passed INTEGER,
+    mean_error REAL,
+    allowed_error INTEGER,
+    trials INTEGER
+);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    exper_num INTEGER,
+    experiment TEXT,
+    trial INTEGER,
+    passed INTEGER,
+    max_error REAL,
+    allowed_error INTEGER,
+    throughput REAL,
+    seconds REAL
+);
+CREATE TABLE IF NOT EXISTS shares (
+    trial_id INTEGER REFERENCES trials(id),
+    container TEXT,
+    weight INTEGER,
+    achieved REAL
+);
+"""
+
+# Defaults for what compare calls a regression: losing more than this
+# fraction of throughput, or this many more weight units of max DTF error.
+THROUGHPUT_TOLERANCE = 0.1
+ERROR_TOLERANCE = 10
+
+
+def read_sys_file(path):
+    """Get the stripped contents of a sysfs or procfs file, or None."""
+    try:
+        return open(path).read().strip()
+    except IOError:
+        return None
+
+
+def environment_fingerprint(device, seq_read_mb):
+    """Describe what the results of a run on device depend on."""
+    queue = '/sys/block/%s/queue' % device
+    scheduler = read_sys_file(os.path.join(queue, 'scheduler')) or ''
+    if '[' in scheduler:
+        # 'noop deadline [cfq]' lists the choices, bracketing the active one.
+        scheduler = scheduler.split('[', 1)[1].split(']', 1)[0]
+    tunables = {}
+    for path in glob.glob(os.path.join(queue, 'iosched', '*')):
+        tunables[os.path.basename(path)] = read_sys_file(path)
+    model = ' '.join(filter(None, [
+            read_sys_file('/sys/block/%s/device/vendor' % device),
+            read_sys_file('/sys/block/%s/device/model' % device)]))
+    return {
+        'kernel': os.uname()[2],
+        'scheduler': scheduler,
+        'iosched': tunables,
+        'device_model': model,
+        'seq_read_mb': seq_read_mb,
+    }
+
+
+class results_db(object):
+    """Results of test runs, in an SQLite database file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+
+    def start_run(self, title, device, fingerprint):
+        """Record a new run, returning its id."""
+        cursor = self.db.execute(
+                'INSERT INTO runs (title, started, device, fingerprint) '
+                'VALUES (?, ?, ?, ?)',
+                (title, time.time(), device,
+                 json.dumps(fingerprint, sort_keys=True)))
+        self.db.commit()
+        return cursor.lastrowid
+
+
+    def record_trial(self, run_id, exper_num, experiment, trial, passed,
+                     max_error, allowed_error, throughput, seconds, shares):
+        """Record one trial of an experiment.
+
+        shares lists (container name, weight, achieved share) triples.
+        """
+        cursor = self.db.execute(
+                'INSERT INTO trials (run_id, exper_num, experiment, trial, '
+                'passed, max_error, allowed_error, throughput, seconds) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, exper_num, experiment, trial, int(passed),
+                 max_error, allowed_error, throughput, seconds))
+        self.db.executemany(
+                'INSERT INTO shares (trial_id, container, weight, achieved) '
+                'VALUES (?, ?, ?, ?)',
+                [(cursor.lastrowid, name, weight, achieved)
+                 for name, weight, achieved in shares])
+        self.db.commit()
+
+
+    def record_experiment(self, run_id, exper_num, experiment, passed,
+                          mean_error, allowed_error, trials):
+        """Record the verdict over all trials of an experiment."""
+        self.db.execute(
+                'INSERT INTO experiments (run_id, exper_num, experiment, '
+                'passed, mean_error, allowed_error, trials) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (run_id, exper_num, experiment, int(passed), mean_error,
+                 allowed_error, trials))
+        self.db.commit()
+
+
+    def runs(self):
+        """Get (id, title, started, device, trial count) of all runs."""
+        return self.db.execute(
+                'SELECT runs.id, title, started, device, COUNT(trials.id) '
+                'FROM runs LEFT JOIN trials ON trials.run_id = runs.id '
+                'GROUP BY runs.id ORDER BY runs.id').fetchall()
+
+
+    def latest_run(self):
+        row = self.db.execute('SELECT MAX(id) FROM runs').fetchone()
+        return row[0]
+
+
+    def fingerprint(self, run_id):
+        row = self.db.execute('SELECT fingerprint FROM runs WHERE id = ?',
+                              (run_id,)).fetchone()
+        if row is None:
+            raise ValueError('no run %s in %s' % (run_id, self.path))
+        return json.loads(row[0])
+
+
+    def experiment_summary(self, run_id):
+        """Get each experiment's string, mean throughput, mean max DTF
+           error and verdict, keyed by experiment number.
+
+        The verdict is the one the harness reached over all trials.  Runs
+        recorded before verdicts were kept only have the trials' own, so
+        there an experiment passed if all of its trials did.
+        """
+        summary = {}
+        for row in self.db.execute(
+                'SELECT exper_num, MIN(experiment), AVG(throughput), '
+                'AVG(max_error), MIN(passed) FROM trials WHERE run_id = ? '
+                'GROUP BY exper_num', (run_id,)):
+            exper_num, experiment, throughput, max_error, passed = row
+            summary[exper_num] = {
+                'experiment': experiment,
+                'throughput': throughput,
+                'max_error': max_error,
+                'passed': bool(passed),
+            }
+        for exper_num, passed in self.db.execute(
+                'SELECT exper_num, passed FROM experiments WHERE run_id = ?',
+                (run_id,)):
+            if exper_num in summary:
+                summary[exper_num]['passed'] = bool(passed)
+        return summary
+
+
+    def compare(self, baseline_run, run,
+                throughput_tolerance=THROUGHPUT_TOLERANCE,
+                error_tolerance=ERROR_TOLERANCE):
+        """Compare a run against a baseline run.
+
+        Returns the fingerprint fields that differ, as (field, baseline
+        value, value) triples, and the regressions, as (exper_num,
+        experiment, description) triples, for experiments both runs ran
+        under the same number.
+        """
+        old_env = self.fingerprint(baseline_run)
+        new_env = self.fingerprint(run)
+        changes = [(key, old_env.get(key), new_env.get(key))
+                   for key in sorted(set(old_env) | set(new_env))
+                   if old_env.get(key) != new_env.get(key)]
+
+        old = self.experiment_summary(baseline_run)
+        new = self.experiment_summary(run)
+        regressions = []
+        for exper_num in sorted(set(old) & set(new)):
+            before = old[exper_num]
+            after = new[exper_num]
+            experiment = after['experiment']
+            if before['experiment'] != experiment:
+                continue
+            if (before['throughput'] and after['throughput'] <
+                before['throughput'] * (1 - throughput_tolerance)):
+                regressions.append((exper_num, experiment,
+                                    'throughput %.1f MB/s, was %.1f MB/s' %
+                                    (after['throughput'],
+                                     before['throughput'])))
+            if after['max_error'] > before['max_error'] + error_tolerance:
+                regressions.append((exper_num, experiment,
+                                    'max DTF error %.1f, was %.1f' %
+                                    (after['max_error'],
+                                     before['max_error'])))
+            if before['passed'] and not after['passed']:
+                regressions.append((exper_num, experiment,
+                                    'FAILED, used to pass'))
+        return changes, regressions
+
+
+def usage(argv):
+    """Prints usage information to stderr."""
+    sys.stderr.write('%s dbfile runs\n'
+                     '%s [-e err] [-t pct] dbfile compare baseline_run '
+                     '[run]: Compares a run, by default the latest one, '
+                     'against a baseline run\n'
+                     '-e err: Max DTF error increase that is a regression '
+                     '(default %d)\n'
+                     '-t pct: Throughput loss in percent that is a '
+                     'regression (default %d)\n'
+                     % (argv[0], argv[0], ERROR_TOLERANCE,
+                        THROUGHPUT_TOLERANCE * 100))
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'e:ht:', ['help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(argv)
+        return 2
+
+    error_tolerance = ERROR_TOLERANCE
+    throughput_tolerance = THROUGHPUT_TOLERANCE
+    for o, a in opts:
+        if o == '-e':
+            error_tolerance = float(a)
+        elif o == '-t':
+            throughput_tolerance = float(a) / 100
+        elif o in ('-h', '--help'):
+            usage(argv)
+            return 0
+
+    if len(args) < 2 or not os.path.exists(args[0]):
+        usage(argv)
+        return 2
+    db = results_db(args[0])
+
+    if args[1] == 'runs' and len(args) == 2:
+        for run_id, title, started, device, trials in db.runs():
+            print '%d\t%s\t%s\t%s\t%d trials' % (
+                    run_id, time.strftime('%Y-%m-%d %H:%M',
+                                          time.localtime(started)),
+                    device, title, trials)
+        return 0
+
+    if args[1] != 'compare' or len(args) not in (3, 4):
+        usage(argv)
+        return 2
+    baseline_run = int(args[2])
+    if len(args) == 4:
+        run = int(args[3])
+    else:
+        run = db.latest_run()
+
+    changes, regressions = db.compare(baseline_run, run,
+                                      throughput_tolerance, error_tolerance)
+    for key, before, after in changes:
+        print 'environment changed: %s %s, was %s' % (key, after, before)
+    for exper_num, experiment, description in regressions:
+        print 'REGRESSION in experiment %d (%s): %s' % (exper_num,
+                                                        experiment,
+                                                        description)
+    print 'run %d vs baseline run %d: %d regressions' % (run, baseline_run,
+                                                         len(regressions))
+    return int(bool(regressions))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -4,6 +4,10 @@ import os
 import sys
 import errno
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import blkio_stats
+
 
 class Container(object):
   CGROUP_MNT = '/dev/cgroup'
@@ -75,33 +79,23 @@ class Container(object):
 
   def create_device_value_dict(self, lines):
     """
-       Parse the output into a dict with the strucure { 'device' => 'value' ... }
-       Example { 'sda' => '5000' }
+       Parse the output into a dict with the strucure { 'device' => value ... }
+       Example { 'sda' => 5000 }
     """
     ret = {}
-    for i in lines:
-      parts = i.split()
-      ret[parts[0]] = parts[1]
+    for device, values in blkio_stats.parse_stat(lines).items():
+      if '' in values:
+        ret[device] = values['']
     return ret
 
   def create_device_cat_value_dict(self, lines):
     """
        Parse the output into a multi-level dictionary with the structure:
        { 'device' => { 'category' => 'value' ... } ... }
-       Example: { 'sda' => { 'Sync' => '100', 'Async' => '200' } }
+       Example: { 'sda' => { 'Sync' => 100, 'Async' => 200 } }
     """
-    ret = {}
-    for i in lines:
-      parts = i.split()
-      device = parts[0]
-      if device != 'Total':
-        # Put in an empty dict on the first iteration.
-        if device not in ret:
-          ret[device] = {}
-
-        cat_val_dict = ret[device]
-        cat_val_dict[parts[1]] = parts[2]
-
+    ret = blkio_stats.parse_stat(lines)
+    ret.pop('', None)  # the Total over all devices
     return ret
 
   def get_io_avg_queue_size_self(self):
@@ -0,0 +1,596 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#   implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+# Runs the test harness against a simulated disk, without root, disks or
+# cgroups.  A fake cgroup tree in a temp directory stands in for /dev/cgroup,
+# and a discrete-event model of a proportional-share disk scheduler stands
+# in for the workers, so that the whole run_experiments pipeline of parsing,
+# container setup, running, measuring and scoring takes seconds.
+#
+# Usage:
+#   simulator.py [-s seed] test_script.py [test options]
+# runs an existing test script, such as regression_test.py, simulated.
+
+
+import bisect, getopt, logging, os, random, sys, tempfile
+import blkcgroup_test_lib, cgroup, cpuset, error, utils
+
+# Name of the simulated disk.
+SIM_DEVICE = 'sim0'
+
+# Per worker type: KB per request, and the mean and standard deviation of
+# the time the disk takes to serve one, in milliseconds.
+SERVICE_TIMES = {
+    'rdseq': (1024, 10.0, 1.0),
+    'rdrand': (64, 8.0, 3.0),
+    'wrseq': (1024, 12.5, 2.0),
+    'io_load_read': (64, 8.0, 3.0),
+    'io_load_write': (64, 9.0, 3.0),
+}
+
+# Longest think time, in seconds, that the disk idles for, as cfq's
+# slice_idle does for sync queues.
+SLICE_IDLE = 0.008
+
+# Counters that the fake io cgroups get, all in the Read/Write/Total style.
+COUNTERS = ('io_service_time', 'io_service_bytes', 'io_serviced',
+            'io_wait_time', 'io_merged')
+# Upper bounds, in ms, of all but the last io_wait_time_histo bucket.
+WAIT_HISTO_MS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# Per device attributes that the model has no use for, and keeps at 0.
+ZERO_ATTRS = ('preempt_count_self', 'preempt_throttle_self',
+              'unaccounted_time')
+
+
+class fake_cgroupfs(cgroup.cgroup_fs):
+    """A v1 cgroup tree of ordinary directories, with a cpuset and an io
+       hierarchy, whose new cgroups get the attribute files the test uses.
+    """
+
+    def __init__(self, root, cpus, memory_bytes):
+        self.root = root
+        self.cpus = cpus
+        self.memory_bytes = memory_bytes
+        os.mkdir(os.path.join(root, 'cpuset'))
+        os.mkdir(os.path.join(root, 'io'))
+        utils.write_one_line(os.path.join(root, 'memory.limit_in_bytes'),
+                             str(memory_bytes))
+        self.populate(os.path.join(root, 'cpuset'))
+        self.populate(os.path.join(root, 'io'))
+
+
+    def hierarchy(self, path):
+        """Get 'cpuset' or 'io', for the hierarchy holding path."""
+        return os.path.relpath(path, self.root).split(os.sep)[0]
+
+
+    def populate(self, path):
+        utils.write_one_line(os.path.join(path, 'tasks'), '')
+        if self.hierarchy(path) == 'cpuset':
+            utils.write_one_line(os.path.join(path, 'cpuset.cpus'),
+                                 '0-%d' % (self.cpus - 1))
+            utils.write_one_line(os.path.join(path, 'cpuset.mems'), '0')
+            utils.write_one_line(os.path.join(path, 'memory.limit_in_bytes'),
+                                 str(cpuset.NO_LIMIT))
+            return
+        utils.write_one_line(os.path.join(path, 'io.io_service_level'),
+                             '%s 2 0 50' % SIM_DEVICE)
+        utils.write_one_line(os.path.join(path, 'io.shared_sync_queues'), '0')
+        for attr in ZERO_ATTRS:
+            utils.write_one_line(os.path.join(path, 'io.' + attr),
+                                 '%s 0' % SIM_DEVICE)
+        write_counters(path, dict((attr, (0, 0)) for attr in COUNTERS), 0,
+                       empty_wait_histo())
+
+
+    def mkdir(self, path):
+        os.mkdir(path)
+        self.populate(path)
+
+
+    def rmdir(self, path):
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                raise OSError(16, 'Device or resource busy', path)
+        utils.remove_tree(path)
+
+
+    def install(self):
+        """Make cgroup and cpuset use this tree instead of the system's."""
+        cgroup.fs = self
+        cgroup.cached_capabilities = cgroup.capabilities([
+                ('cgroup', os.path.join(self.root, 'cpuset'), ['cpuset']),
+                ('cgroup', os.path.join(self.root, 'io'), ['io'])])
+        cpuset.super_root_path = self.root
+        cpuset.cpuset_prefix = 'cpuset.'
+        cpuset.unified_hierarchy = False
+        cpuset.fake_numa_containers = False
+        cpuset.mem_isolation_on = True
+        cpuset.root_container_bytes = self.memory_bytes
+
+
+    def uninstall(self):
+        cgroup.fs = cgroup.cgroup_fs()
+        cgroup.cached_capabilities = None
+        cpuset.super_root_path = ''
+
+
+def empty_wait_histo():
+    """Get (read, write) io_wait_time_histo buckets, all 0."""
+    return ([0] * (len(WAIT_HISTO_MS) + 1), [0] * (len(WAIT_HISTO_MS) + 1))
+
+
+def wait_histo_bucket(seconds):
+    """Get the io_wait_time_histo bucket of a request that waited seconds.
+    """
+    return bisect.bisect_right(WAIT_HISTO_MS, seconds * 1000)
+
+
+def write_counters(path, counters, timeslice_used, wait_histo):
+    """Write an io cgroup's counter files.
+
+    counters maps each of COUNTERS to (read, write) values, and wait_histo
+    holds the read and write io_wait_time_histo buckets.
+    """
+    for attr, (read, write) in counters.items():
+        utils.write_one_line(os.path.join(path, 'io.' + attr),
+                             '%s Read %d\n%s Write %d\n%s Total %d\nTotal %d'
+                             % (SIM_DEVICE, read, SIM_DEVICE, write,
+                                SIM_DEVICE, read + write, read + write))
+    utils.write_one_line(os.path.join(path, 'io.timeslice_used'),
+                         '%s %d' % (SIM_DEVICE, timeslice_used))
+    read, write = wait_histo
+    lines = ['%s %s %s' % (SIM_DEVICE, category,
+                           ' '.join(str(n) for n in buckets))
+             for category, buckets in (('Read', read), ('Write', write),
+                                       ('Total', [r + w for r, w
+                                                  in zip(read, write)]))]
+    utils.write_one_line(os.path.join(path, 'io.io_wait_time_histo'),
+                         '\n'.join(lines))
+
+
+class sim_worker(object):
+    """One simulated worker: a number of requests of one type, issued one
+       at a time, with an optional think time after each.
+    """
+
+    def __init__(self, spec, mbytes, rng):
+        kind = spec.split('.', 1)[0]
+        variant = ''
+        if '.' in spec:
+            variant = spec.split('.', 1)[1]
+        self.kind = kind
+        self.group = None  # the leaf sim_group it runs in
+        self.rng = rng
+        self.write = kind in ('wrseq', 'io_load_write')
+        self.kbytes, self.mean_ms, self.stddev_ms = SERVICE_TIMES[kind]
+        self.think = 0.0
+        if variant.startswith('delay'):
+            self.think = int(variant[5:]) / 1000.0
+
+        # The same amounts of work as the real workers get.
+        if kind == 'rdseq':
+            self.requests = mbytes
+        elif kind == 'rdrand':
+            self.requests = (mbytes << 4) // 8
+        elif kind == 'wrseq' and variant == 'sync':
+            self.requests = mbytes // 3
+        elif kind == 'wrseq' and variant != 'dir':
+            self.requests = mbytes * 2
+        elif kind == 'wrseq':
+            self.requests = mbytes
+        else:
+            self.requests = None  # io_load runs until it is ended
+        self.ready_at = 0.0
+        self.exit_time = None
+
+
+    def service_time(self):
+        """Draw the seconds the disk takes for this worker's next request."""
+        ms = self.rng.gauss(self.mean_ms, self.stddev_ms)
+        return max(ms, self.mean_ms / 10) / 1000.0
+
+
+class sim_group(object):
+    """The simulated scheduling state of one io cgroup.
+
+    Workers only live in leaf groups.  The workers of a cgroup are kept in
+    a hidden leaf child, so that they compete with its nested cgroups as
+    one more sibling of the cgroup's own weight.
+    """
+
+    def __init__(self, path, parent, weight, priority):
+        self.path = path
+        self.parent = parent
+        self.weight = weight
+        self.priority = priority
+        self.children = []
+        self.workers = []
+        self.leaf = None
+        self.vtime = 0.0
+        self.active = False
+        self.next_worker = 0
+        # Counters include those of nested groups, like the kernel's.
+        self.counters = dict((attr, [0, 0]) for attr in COUNTERS)
+        self.timeslice_used = 0
+        self.wait_histo = empty_wait_histo()
+
+
+    def add_worker(self, worker):
+        if self.leaf is None:
+            self.leaf = sim_group(self.path, self, self.weight,
+                                  self.priority)
+            self.children.append(self.leaf)
+        self.leaf.workers.append(worker)
+        worker.group = self.leaf
+
+
+    def ready_workers(self, now):
+        return [w for w in self.workers
+                if w.exit_time is None and w.ready_at <= now]
+
+
+    def backlogged(self, now, awaited=None):
+        """Tell whether the group has requests ready, or holds the worker
+           awaited by an idling disk.
+        """
+        if self.workers:
+            return bool(self.ready_workers(now)) or (
+                    awaited is not None and awaited.group is self)
+        return any(c.backlogged(now, awaited) for c in self.children)
+
+
+class disk_model(object):
+    """A discrete-event model of a disk shared in proportion to weights.
+
+    Every level of the cgroup tree runs start-time fair queueing among its
+    backlogged groups, with high priority groups going first among those
+    with the same virtual time.  After serving a worker that thinks for up
+    to SLICE_IDLE, the disk idles for it while its group is next in line.
+    Each dispatch serves one request of one worker, for a service
+    time drawn from its type's distribution, and charges it to the worker's
+    group and all its ancestors.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.now = 0.0
+        # the worker the disk may idle for, after serving it
+        self.awaited = None
+
+
+    def pick(self, group):
+        """Choose the worker that gets the disk next below group."""
+        if group.workers:
+            ready = group.ready_workers(self.now)
+            if not ready:
+                return self.awaited
+            group.next_worker = (group.next_worker + 1) % len(ready)
+            return ready[group.next_worker]
+
+        backlogged = [c for c in group.children
+                      if c.backlogged(self.now, self.awaited)]
+        if not backlogged:
+            return None
+        # A group that was idle does not get to claim the service it missed,
+        # unless it has high priority: that gets it served first when it
+        # comes back, until it has caught up with its weight.
+        active = [c for c in backlogged if c.active]
+        for c in group.children:
+            if c not in backlogged:
+                c.active = False
+            elif not c.active:
+                if active and c.priority != 1:
+                    c.vtime = max(c.vtime, min(a.vtime for a in active))
+                c.active = True
+        # Like cfq's group scheduling, weights decide the share even of
+        # high priority groups; priority only decides who goes first.
+        chosen = min(backlogged, key=lambda c: (c.vtime, c.priority))
+        return self.pick(chosen)
+
+
+    def dispatch(self, worker):
+        """Serve one request of worker."""
+        seconds = worker.service_time()
+        category = int(worker.write)
+        wait = self.now - worker.ready_at
+        group = worker.group
+        while group:
+            group.counters['io_service_time'][category] += int(seconds * 1e9)
+            group.counters['io_service_bytes'][category] += worker.kbytes << 10
+            group.counters['io_serviced'][category] += 1
+            group.counters['io_wait_time'][category] += int(wait * 1e9)
+            group.wait_histo[category][wait_histo_bucket(wait)] += 1
+            group.timeslice_used += int(seconds * 1000)
+            group.vtime += seconds / group.weight
+            group = group.parent
+        if worker.requests is not None:
+            worker.requests -= 1
+        self.now += seconds
+        worker.ready_at = self.now + worker.think
+        self.awaited = None
+        if 0 < worker.think <= SLICE_IDLE and worker.requests != 0:
+            self.awaited = worker
+
+
+    def idle(self, worker):
+        """Keep the disk idle until worker is ready, charging the time to
+           its group like service time, but for the counters.
+        """
+        seconds = worker.ready_at - self.now
+        group = worker.group
+        while group:
+            group.timeslice_used += int(seconds * 1000)
+            group.vtime += seconds / group.weight
+            group = group.parent
+        self.now = worker.ready_at
+        self.awaited = None
+
+
+    def run(self, workers, kill_slower=False, timeout=None):
+        """Run workers until they are all done, or until the first one is
+           with kill_slower.  The timeout, in seconds, only applies with
+           kill_slower, as in worker_supervisor.  Endless io_load workers
+           get ended once no other workers are left.
+
+           Returns the time the first worker finished, or the timeout ended
+           them all.
+        """
+        end_time = None
+        while True:
+            live = [w for w in workers if w.exit_time is None]
+            if not [w for w in live if w.requests is not None]:
+                break
+            if kill_slower and timeout and self.now >= timeout:
+                end_time = self.now
+                break
+            worker = self.pick(self.root)
+            if worker is not None and worker.ready_at > self.now:
+                self.idle(worker)
+                continue
+            if worker is None:
+                # Everyone is thinking; skip ahead to the next request.
+                self.now = min(w.ready_at for w in live)
+                continue
+            self.dispatch(worker)
+            if worker.requests == 0:
+                worker.exit_time = self.now
+                if end_time is None:
+                    end_time = self.now
+                    if kill_slower:
+                        break
+        for w in workers:
+            if w.exit_time is None:
+                w.exit_time = self.now
+        if end_time is None:
+            end_time = self.now
+        return end_time
+
+
+class simulated_harness(blkcgroup_test_lib.test_harness):
+    """A test_harness that runs its experiments against a disk_model and a
+       fake cgroup tree, on a simulated clock.
+
+       seed makes the service times of every run repeatable.
+    """
+
+    def __init__(self, title, post_experiment_cb=None, seed=0, cpus=8,
+                 memory_mbytes=16384):
+        super(simulated_harness, self).__init__(title, post_experiment_cb)
+        self.seed = seed
+        self.sim_cpus = cpus
+        self.sim_memory_bytes = memory_mbytes << 20
+        self.sim_time = 0.0
+        self.clock = lambda: self.sim_time
+        self.fs = None
+
+
+    def run_experiments(self, experiments, seq_read_mb, workvol=None,
+                        **kwargs):
+        """Like test_harness.run_experiments, with the work directory and the
+           cgroup tree in a temp directory, unless workvol says otherwise.
+        """
+        if kwargs.get('sample_interval') or kwargs.get(
+                'steady_state_start') is not None or kwargs.get(
+                'converge_tolerance') is not None:
+            raise error.Error('The simulator takes no samples while workers '
+                              'run')
+        tmpdir = tempfile.mkdtemp(prefix='blkcgroup_sim')
+        if workvol is None:
+            workvol = tmpdir
+        if not isinstance(workvol, basestring):
+            raise error.Error('The simulator runs on one disk')
+        cgroup_root = os.path.join(tmpdir, 'cgroup')
+        os.mkdir(cgroup_root)
+        self.fs = fake_cgroupfs(cgroup_root, self.sim_cpus,
+                                self.sim_memory_bytes)
+        self.fs.install()
+        self.rng = random.Random(self.seed)
+        try:
+            super(simulated_harness, self).run_experiments(
+                    experiments, seq_read_mb, workvol, **kwargs)
+        finally:
+            self.fs.uninstall()
+            utils.remove_tree(tmpdir)
+
+
+    def disk_device(self, workvol, google_hacks):
+        return SIM_DEVICE
+
+
+    def setup_workvol(self, workvol, google_hacks):
+        """Prepare the scratch directory, on a simulated disk."""
+        self.workdir = os.path.join(workvol, 'blkcgroup_test_tmp')
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+        elif not self.resume:
+            utils.empty_dir(self.workdir)
+        self.device = self.disk_device(workvol, google_hacks)
+        self.input_pool = self.open_input_pool(workvol)
+        if not os.path.exists(self.input_pool.pool_dir):
+            os.makedirs(self.input_pool.pool_dir)
+        logging.debug('Simulating IO on disk %s', self.device)
+
+
+    def check_plan(self, plans, input_mbytes, workvol):
+        pass  # nothing gets written, and container memory is make-believe
+
+
+    def provision_input_files(self):
+        # Simulated workers read nothing, so input files need no data.
+        for name, mbytes in self.pending_input_files.items():
+            self.existing_input_files[name] = mbytes
+        self.pending_input_files = {}
+
+
+    def evict_caches(self):
+        pass
+
+
+    def setup_worker(self, worker, mbytes):
+        """Account for the worker's files, then describe it for the model
+           as 'worker mbytes', instead of as a command.
+        """
+        cmd = super(simulated_harness, self).setup_worker(worker, mbytes)
+        if not cmd:
+            return ''
+        return '%s %d' % (worker, mbytes)
+
+
+    def sim_groups(self, runners):
+        """Build the sim_group tree of the io cgroups of runners, with the
+           weights and priorities the harness set in them.
+        """
+        mount = cgroup.mount_point(blkcgroup_test_lib.BLKIO_CGROUP_NAME)
+        root = sim_group(mount, None, 1, 0)
+        groups = {mount: root}
+
+        def group_of(path):
+            if path not in groups:
+                parent = group_of(os.path.dirname(path))
+                level = utils.read_one_line(
+                        os.path.join(path, 'io.io_service_level')).split()
+                # 'device priority 0 weight/10'; prio 1 goes first.
+                group = sim_group(path, parent, int(level[3]) * 10,
+                                  {1: 0}.get(int(level[1]), 1))
+                parent.children.append(group)
+                groups[path] = group
+            return groups[path]
+
+        workers = []
+        for cmd, cpu_cgroup, blkio_cgroup in runners:
+            spec, mbytes = cmd.split()
+            worker = sim_worker(spec, int(mbytes), self.rng)
+            group_of(blkio_cgroup.path).add_worker(worker)
+            workers.append(worker)
+        return root, groups, workers
+
+
+    def run_worker_processes_in_parallel(self, runners, kill_slower=False,
+                                         timeout=None):
+        """Run the experiment's workers in the disk model, then publish
+           what each io cgroup got in its counter files.
+        """
+        root, groups, workers = self.sim_groups(runners)
+        model = disk_model(root)
+        self.release_time = self.sim_time
+        end_time = model.run(workers, kill_slower, timeout)
+        self.first_exit_time = self.release_time + end_time
+        self.worker_exit_times = dict(
+                (n, self.release_time + w.exit_time)
+                for n, w in enumerate(workers))
+        self.sim_time += max([w.exit_time for w in workers] or [0])
+        self.start_spread = 0.0
+        logging.info('Simulated %d workers for %.1f seconds',
+                     len(workers), self.sim_time - self.release_time)
+
+        for path, group in groups.items():
+            old = read_counters(path)
+            counters = dict((attr, (old[attr][0] + read,
+                                    old[attr][1] + write))
+                            for attr, (read, write)
+                            in group.counters.items())
+            wait_histo = [[o + n for o, n in zip(old_buckets, buckets)]
+                          for old_buckets, buckets
+                          in zip(old['io_wait_time_histo'],
+                                 group.wait_histo)]
+            write_counters(path, counters,
+                           old['timeslice_used'] + group.timeslice_used,
+                           wait_histo)
+
+
+def read_counters(path):
+    """Get the counters of a fake io cgroup, as write_counters takes them.
+    """
+    counters = {}
+    for attr in COUNTERS:
+        values = {}
+        for line in open(os.path.join(path, 'io.' + attr)).readlines():
+            parts = line.split()
+            if len(parts) == 3:
+                values[parts[1]] = int(parts[2])
+        counters[attr] = (values.get('Read', 0), values.get('Write', 0))
+    used = utils.read_one_line(os.path.join(path, 'io.timeslice_used'))
+    counters['timeslice_used'] = int(used.split()[1])
+    histo = {}
+    for line in open(os.path.join(path, 'io.io_wait_time_histo')):
+        parts = line.split()
+        histo[parts[1]] = [int(n) for n in parts[2:]]
+    counters['io_wait_time_histo'] = (histo['Read'], histo['Write'])
+    return counters
+
+
+def usage(argv):
+    """Prints usage information to stderr."""
+    sys.stderr.write('%s [-s seed] test_script.py [test options]: Runs a '
+                     'test script against a simulated disk\n'
+                     '-s seed: Seeds the simulated service times (default '
+                     '0)\n' % argv[0])
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hs:', ['help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(argv)
+        return 2
+
+    seed = 0
+    for o, a in opts:
+        if o == '-s':
+            seed = int(a)
+        elif o in ('-h', '--help'):
+            usage(argv)
+            return 0
+    if not args:
+        usage(argv)
+        return 2
+
+    # The script builds its harness from blkcgroup_test_lib, so give it
+    # simulated ones.
+    def harness(title, post_experiment_cb=None):
+        return simulated_harness(title, post_experiment_cb, seed)
+    blkcgroup_test_lib.test_harness = harness
+    sys.argv = args
+    execfile(args[0], {'__name__': '__main__'})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
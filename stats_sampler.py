@@ -0,0 +1,178 @@
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# Periodic snapshots of the io cgroup counters of a set of containers, taken
+# by a background thread while an experiment's workers run.
+
+
+import logging, threading, time
+import cgroup
+
+# io cgroup counters sampled by default.
+DEFAULT_ATTRS = ('io_service_time', 'io_service_bytes', 'io_serviced',
+                 'timeslice_used')
+
+
+class stats_sampler(object):
+    """Samples io counters of containers every interval seconds.
+
+    containers is a list of (name, io cgroup accessor) pairs.  Each sample
+    is a (time, {name: {attr: lines}}) pair, appended to samples.  If set,
+    on_sample gets called with the samples list after every new sample.
+    The counter files stay open until stop.
+    """
+
+    def __init__(self, containers, interval, attrs=DEFAULT_ATTRS):
+        self.containers = containers
+        self.interval = interval
+        self.reader = cgroup.attr_reader(containers, attrs)
+        for attr in sorted(self.reader.missing):
+            # Not provided by this kernel.
+            logging.warn('Cannot sample %s of all containers', attr)
+        self.samples = []
+        self.on_sample = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+
+    def sample(self):
+        """Take one snapshot of all containers' counters now."""
+        now = time.time()
+        snapshot = self.reader.read()
+        for name, blkio_cgroup in self.containers:
+            snapshot.setdefault(name, {})
+        self.samples.append((now, snapshot))
+        if self.on_sample and not self._stopped.is_set():
+            self.on_sample(self.samples)
+
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+    def start(self):
+        """Take a first sample, then keep sampling in the background."""
+        self.sample()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """Stop sampling, taking one last sample."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.sample()
+        self.reader.close()
+
+
+    def window(self, start, end):
+        """Get the first and last samples taken between start and end.
+
+        Returns None unless there are at least two such samples.
+        """
+        inside = [s for s in self.samples if start <= s[0] <= end]
+        if len(inside) < 2:
+            return None
+        return inside[0], inside[-1]
+
+
+class convergence_monitor(object):
+    """Ends an experiment once the shares of all containers have settled.
+
+    groups lists the sibling groups of an experiment, each a list of
+    (name, weight) pairs.  service_time gets the service time counter from
+    one container's sampled values.  A container's running share is its
+    service time since the first sample, scaled to its siblings' total
+    weight, just like the achieved DTF that experiments get scored with.
+
+    Once every share has stayed within a band of tolerance for duration
+    seconds, or max_seconds after the first sample, stop gets called.
+    Install check as a stats_sampler's on_sample.
+    """
+
+    def __init__(self, groups, service_time, tolerance, duration,
+                 max_seconds, stop):
+        self.groups = groups
+        self.service_time = service_time
+        self.tolerance = tolerance
+        self.duration = duration
+        self.max_seconds = max_seconds
+        self.stop = stop
+        self.history = []  # (time, {name: share}) for samples with shares
+        self.stopped_at = None
+        self.converged = False
+
+
+    def shares(self, first, last):
+        """Get the running shares between two snapshots, or None if some
+           sibling group has not received any service yet.
+        """
+        shares = {}
+        for group in self.groups:
+            deltas = [self.service_time(last[name]) -
+                      self.service_time(first[name]) for name, w in group]
+            total_time = sum(deltas)
+            if total_time <= 0:
+                return None
+            total_weight = sum(w for name, w in group)
+            for (name, weight), delta in zip(group, deltas):
+                shares[name] = delta * total_weight / float(total_time)
+        return shares
+
+
+    def check(self, samples):
+        """Look at the newest sample and stop the experiment if it is done.
+        """
+        if self.stopped_at is not None:
+            return
+        first_time = samples[0][0]
+        now, last = samples[-1]
+        shares = self.shares(samples[0][1], last)
+        if shares is not None:
+            self.history.append((now, shares))
+
+        if self.max_seconds and now - first_time >= self.max_seconds:
+            logging.info('Shares did not converge in %.1f seconds',
+                         now - first_time)
+        elif not self._settled(now, first_time):
+            return
+        else:
+            self.converged = True
+            logging.info('Shares converged within %s after %.1f seconds',
+                         self.tolerance, now - first_time)
+        self.stopped_at = now
+        self.stop()
+
+
+    def _settled(self, now, first_time):
+        """True if all shares stayed in their band for the last duration."""
+        if now - first_time < self.duration:
+            return False
+        # Shares only exist once every group got service, which may have
+        # been well after the first sample.
+        if not self.history or self.history[0][0] > now - self.duration:
+            return False
+        recent = [shares for t, shares in self.history
+                  if t >= now - self.duration]
+        if len(recent) < 2:
+            return False
+        for name in recent[-1]:
+            values = [shares[name] for shares in recent]
+            if max(values) - min(values) > self.tolerance:
+                return False
+        return True
@@ -13,13 +13,33 @@
 #   limitations under the License.
 
 
-import glob, logging, math, os, re, subprocess
+import ctypes, errno, glob, logging, math, os, re, shutil, signal, subprocess
 import error
 
+libc = ctypes.CDLL(None, use_errno=True)
+
+POSIX_FADV_DONTNEED = 4
+PROT_READ = 1
+MAP_SHARED = 1
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+libc.posix_fadvise64.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64, ctypes.c_int]
+libc.mmap64.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                        ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+libc.mmap64.restype = ctypes.c_void_p
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.pread64.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                        ctypes.c_int64]
+libc.pread64.restype = ctypes.c_ssize_t
+
 # Returns total memory in kb
 def read_from_meminfo(key):
-    meminfo = system_output('grep %s /proc/meminfo' % key)
-    return int(re.search(r'\d+', meminfo).group(0))
+    for line in open('/proc/meminfo'):
+        if line.startswith(key):
+            return int(re.search(r'\d+', line).group(0))
+    raise error.Error('%s not found in /proc/meminfo' % key)
 
 
 def memtotal():
@@ -89,10 +109,85 @@ def human_format(number):
     return "%.2fG" % gig
 
 
+def sync():
+    """Writes back all dirty pages to disk, like sync(1)."""
+    libc.sync()
+
+
 def drop_caches():
     """Writes back all dirty pages to disk and clears all the caches."""
-    system("sync")
-    system("echo 3 > /proc/sys/vm/drop_caches")
+    sync()
+    try:
+        write_one_line('/proc/sys/vm/drop_caches', '3')
+    except IOError, e:
+        raise error.Error('Cannot drop caches: %s' % e)
+
+
+def resident_pages(fd, size):
+    """Count the pages of the first size bytes of an open file that are in
+       the page cache.
+    """
+    if not size:
+        return 0
+    addr = libc.mmap64(None, size, PROT_READ, MAP_SHARED, fd, 0)
+    if addr == MAP_FAILED:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    try:
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        vec = ctypes.create_string_buffer((size + page_size - 1) // page_size)
+        if libc.mincore(addr, size, vec):
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return sum(ord(c) & 1 for c in vec.raw)
+    finally:
+        libc.munmap(addr, size)
+
+
+def evict_file(path):
+    """Writes back one file's dirty pages and drops it from the page cache.
+
+    Returns how many of its pages are still cached afterwards, eg because
+    some process has them mapped.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        ret = libc.posix_fadvise64(fd, 0, 0, POSIX_FADV_DONTNEED)
+        if ret:
+            raise OSError(ret, os.strerror(ret))
+        return resident_pages(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def kill_pid(pid, signum=signal.SIGTERM):
+    """Send a signal to a process that may have already exited."""
+    try:
+        os.kill(pid, signum)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def remove_tree(path):
+    """Remove a file or directory tree if it exists, like rm -rf."""
+    def failed(function, name, exc_info):
+        if exc_info[1].errno != errno.ENOENT:
+            raise error.Error('Cannot remove %s: %s' % (name, exc_info[1]))
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, onerror=failed)
+    else:
+        try:
+            os.remove(path)
+        except OSError, e:
+            failed(os.remove, path, (OSError, e, None))
+
+
+def empty_dir(path):
+    """Remove everything inside a directory, like rm -rf path/*."""
+    for name in glob.glob(os.path.join(path, '*')):
+        remove_tree(name)
 
 
 def read_one_line(filename):
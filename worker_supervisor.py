@@ -0,0 +1,117 @@
+# Copyright 2011 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# Supervision of an experiment's worker processes from the harness process.
+# A SIGCHLD handler wakes the supervisor through a pipe, so it notices each
+# worker's exit, and the end of the run, within milliseconds.
+
+
+import errno, fcntl, logging, os, select, signal, time
+import utils
+
+
+class worker_supervisor(object):
+    """Waits for a set of worker processes, all children of this process.
+
+    Records when each worker exited in exit_times.  end_time is the end of
+    the measurement: when the first worker exited, or when the timeout ran
+    out.  With kill_slower, that also ends all remaining workers.  The
+    timeout only applies with kill_slower, counted in seconds from start.
+    """
+
+    def __init__(self, pids, kill_slower=False, timeout=None):
+        self.pids = set(pids)
+        self.kill_slower = kill_slower
+        self.timeout = timeout
+        self.exit_times = {}
+        self.exit_status = {}
+        self.end_time = None
+        self.timed_out = False
+
+
+    def _reap(self):
+        """Collect all workers that have exited since the last call."""
+        for pid in self.pids - set(self.exit_times):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if not done:
+                continue
+            now = time.time()
+            self.exit_times[pid] = now
+            self.exit_status[pid] = status
+            if self.end_time is None:
+                logging.debug('worker pid %d finished first', pid)
+                self._end(now)
+
+
+    def _end(self, now):
+        """End the measurement, and with kill_slower, all workers."""
+        self.end_time = now
+        if not self.kill_slower:
+            return
+        survivors = self.pids - set(self.exit_times)
+        if survivors:
+            logging.debug('killing %d slower workers', len(survivors))
+        for pid in survivors:
+            utils.kill_pid(pid)
+
+
+    def run(self, start=None):
+        """Wait until all workers have exited.
+
+        start is when the workers were let go, by default now.
+        """
+        if start is None:
+            start = time.time()
+        deadline = None
+        if self.kill_slower and self.timeout:
+            deadline = start + self.timeout
+
+        wake_r, wake_w = os.pipe()
+        for fd in (wake_r, wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        old_handler = signal.signal(signal.SIGCHLD,
+                                    lambda signum, frame: None)
+        old_wakeup_fd = signal.set_wakeup_fd(wake_w)
+        try:
+            # Workers that exited before the handler was in place.
+            self._reap()
+            while len(self.exit_times) < len(self.pids):
+                wait = None
+                if deadline is not None and self.end_time is None:
+                    wait = max(0, deadline - time.time())
+                try:
+                    select.select([wake_r], [], [], wait)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                try:
+                    while os.read(wake_r, 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                self._reap()
+                if (deadline is not None and self.end_time is None and
+                    time.time() >= deadline):
+                    logging.debug('timeout after %s seconds, ending workers',
+                                  self.timeout)
+                    self.timed_out = True
+                    self._end(time.time())
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            signal.signal(signal.SIGCHLD, old_handler)
+            os.close(wake_r)
+            os.close(wake_w)